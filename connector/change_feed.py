@@ -0,0 +1,148 @@
+# change_feed.py
+#
+# Row-level changes between consecutive imports of a table. The keys that
+# were inserted, updated or deleted are computed set-based in MariaDB by
+# joining the newly loaded staging table to the table it replaces on the
+# primary key, and stored in the table's change table _changes_<table>:
+#
+#   import_run   the import that made the change (Table.import_run)
+#   change_type  'insert', 'update' or 'delete'
+#   <key>        the primary key columns of the changed row
+#   old_hash     MD5 of the row before the import, NULL for inserts
+#   new_hash     MD5 of the row after the import, NULL for deletes
+
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def get_change_table_name(table_name):
+    return f'_changes_{table_name}'[:64]
+
+
+def get_table_columns(cursor, table_name):
+    """Return (column name, column type) of every column of a table, in order."""
+    cursor.execute("""
+        SELECT COLUMN_NAME, COLUMN_TYPE
+        FROM information_schema.columns
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY ORDINAL_POSITION
+    """, [table_name])
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+def get_primary_key(cursor, table_name):
+    cursor.execute("""
+        SELECT COLUMN_NAME
+        FROM information_schema.statistics
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = 'PRIMARY'
+        ORDER BY SEQ_IN_INDEX
+    """, [table_name])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def ensure_change_table(cursor, table_name, primary_key_columns, column_types):
+    """
+    Create the change table of a table, recreating it if the primary key
+    has changed since it was created. Returns its name.
+    """
+    change_table = get_change_table_name(table_name)
+    key_columns = [(col, column_types[col]) for col in primary_key_columns]
+
+    # The key columns sit between change_type and old_hash
+    existing_columns = get_table_columns(cursor, change_table)
+    if existing_columns and existing_columns[2:-2] != key_columns:
+        logger.info(f"Primary key of {table_name} changed, recreating {change_table}")
+        cursor.execute(f'DROP TABLE `{change_table}`')
+        existing_columns = []
+
+    if not existing_columns:
+        # BLOB/TEXT key columns can only be indexed on a prefix
+        index_columns = [f'`{col}`(255)' if col_type.endswith('text') else f'`{col}`' for col, col_type in key_columns]
+        cursor.execute(f"""
+            CREATE TABLE `{change_table}` (
+                `import_run` INT NOT NULL,
+                `change_type` ENUM('insert', 'update', 'delete') NOT NULL,
+                {', '.join(f'`{col}` {col_type} NOT NULL' for col, col_type in key_columns)},
+                `old_hash` CHAR(32) NULL,
+                `new_hash` CHAR(32) NULL,
+                PRIMARY KEY (`import_run`, {', '.join(index_columns)})
+            )
+        """)
+    return change_table
+
+
+def row_hash_sql(alias, column_names):
+    # JSON_ARRAY keeps NULLs and empty strings apart, unlike CONCAT_WS
+    return f"MD5(JSON_ARRAY({', '.join(f'{alias}.`{col}`' for col in column_names)}))"
+
+
+def record_changes(cursor, table_name, old_table, new_table, primary_key_columns, import_run):
+    """
+    Record the keys inserted, updated and deleted between old_table (the data
+    being replaced, None on the first import) and new_table as import run
+    import_run. Both tables must have the same columns and primary key.
+    Returns the number of changes per change type, or None if no change feed
+    could be computed.
+    """
+    if not primary_key_columns:
+        logger.warning(f"No change feed for {table_name}: it has no primary key")
+        return None
+
+    new_columns = get_table_columns(cursor, new_table)
+    if old_table is not None:
+        if get_table_columns(cursor, old_table) != new_columns or get_primary_key(cursor, old_table) != primary_key_columns:
+            logger.warning(f"No change feed for {table_name} run {import_run}: its columns or primary key changed")
+            return None
+
+    change_table = ensure_change_table(cursor, table_name, primary_key_columns, dict(new_columns))
+    # A rerun of a failed import may already have recorded some changes
+    cursor.execute(f'DELETE FROM `{change_table}` WHERE import_run = %s', [import_run])
+
+    column_names = [col for col, col_type in new_columns]
+    key_list = ', '.join(f'`{col}`' for col in primary_key_columns)
+    new_keys = ', '.join(f'n.`{col}`' for col in primary_key_columns)
+    old_keys = ', '.join(f'o.`{col}`' for col in primary_key_columns)
+    join_condition = ' AND '.join(f'o.`{col}` = n.`{col}`' for col in primary_key_columns)
+    insert_sql = f'INSERT INTO `{change_table}` (import_run, change_type, {key_list}, old_hash, new_hash)'
+
+    if old_table is None:
+        statements = {
+            'insert': f"{insert_sql} SELECT %s, 'insert', {new_keys}, NULL, {row_hash_sql('n', column_names)} FROM `{new_table}` n",
+        }
+    else:
+        statements = {
+            'insert': f"""
+                {insert_sql}
+                SELECT %s, 'insert', {new_keys}, NULL, {row_hash_sql('n', column_names)}
+                FROM `{new_table}` n LEFT JOIN `{old_table}` o ON {join_condition}
+                WHERE o.`{primary_key_columns[0]}` IS NULL
+            """,
+            'update': f"""
+                {insert_sql}
+                SELECT %s, 'update', {new_keys}, {row_hash_sql('o', column_names)}, {row_hash_sql('n', column_names)}
+                FROM `{new_table}` n JOIN `{old_table}` o ON {join_condition}
+                WHERE {row_hash_sql('o', column_names)} <> {row_hash_sql('n', column_names)}
+            """,
+            'delete': f"""
+                {insert_sql}
+                SELECT %s, 'delete', {old_keys}, {row_hash_sql('o', column_names)}, NULL
+                FROM `{old_table}` o LEFT JOIN `{new_table}` n ON {join_condition}
+                WHERE n.`{primary_key_columns[0]}` IS NULL
+            """,
+        }
+
+    changes = {}
+    for change_type, sql in statements.items():
+        cursor.execute(sql, [import_run])
+        changes[change_type] = cursor.rowcount
+
+    # Keep the changes of the most recent imports only
+    cursor.execute(
+        f'DELETE FROM `{change_table}` WHERE import_run <= %s',
+        [import_run - settings.CONNECTOR_CHANGE_FEED_RUNS],
+    )
+
+    logger.info(f"Changes in {table_name} run {import_run}: {changes}")
+    return changes
@@ -39,11 +39,13 @@ class JobForm(forms.ModelForm):
 class ScriptForm(forms.ModelForm):
     class Meta:
         model = Script
-        fields = ['name', 'content', 'table_name', 'order_exec', 'import_enabled']
+        fields = ['name', 'content', 'table_name', 'file_glob', 'row_filter', 'order_exec', 'import_enabled']
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control'}),
             'content': forms.Textarea(attrs={'rows': 20, 'cols': 80, 'class': 'form-control'}),
             'table_name': forms.TextInput(attrs={'class': 'form-control'}),
+            'file_glob': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Leave empty to import the latest data file'}),
+            'row_filter': forms.TextInput(attrs={'class': 'form-control', 'placeholder': "e.g. status == 'active' and cost > 100"}),
             'order_exec': forms.NumberInput(attrs={'class': 'form-control', 'style': 'max-width: 80px;'}),
             'import_enabled': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
         }
@@ -64,7 +66,7 @@ class ScriptForm(forms.ModelForm):
 ScriptFormSet = forms.inlineformset_factory(
     Job, Script,
     form=ScriptForm,
-    fields=['name', 'content', 'table_name', 'order_exec', 'import_enabled'],
+    fields=['name', 'content', 'table_name', 'file_glob', 'row_filter', 'order_exec', 'import_enabled'],
     extra=1,
     can_delete=True
 )
@@ -138,7 +140,7 @@ class CustomColumnForm(forms.ModelForm):
 
     class Meta:
         model = Column
-        fields = ('column_name', 'override_column_name', 'override_data_type', 'detected_data_type', 'primary_key', 'foreign_key_reference', 'is_unique')
+        fields = ('column_name', 'override_column_name', 'override_data_type', 'detected_data_type', 'primary_key', 'secondary_index', 'include', 'dictionary_encode', 'foreign_key_reference', 'is_unique')
         widgets = {
             'column_name': forms.TextInput(attrs={'class': 'form-control', 'readonly': 'readonly'}),
             'override_column_name': forms.TextInput(attrs={'class': 'form-control'}),
@@ -146,6 +148,9 @@ class CustomColumnForm(forms.ModelForm):
             'detected_data_type': forms.TextInput(attrs={'class': 'form-control', 'readonly': 'readonly'}),
             'foreign_key_reference': forms.Select(attrs={'class': 'form-control'}),
             'primary_key': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+            'secondary_index': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+            'include': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
+            'dictionary_encode': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
             'is_unique': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
         }
 
@@ -158,4 +163,25 @@ class CustomEditTableForm(forms.Form):
     run_transform = forms.BooleanField(
         required=False,
         widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+    snapshot_retention = forms.IntegerField(
+        min_value=0,
+        initial=0,
+        widget=forms.NumberInput(attrs={'class': 'form-control', 'style': 'max-width: 80px;'})
+    )
+    snapshot_format = forms.ChoiceField(
+        choices=Table.SNAPSHOT_FORMAT_CHOICES,
+        widget=forms.Select(attrs={'class': 'form-control', 'style': 'max-width: 160px;'})
+    )
+    change_feed = forms.BooleanField(
+        required=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+    transform_incremental = forms.BooleanField(
+        required=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
+    )
+    transform_full_recompute = forms.BooleanField(
+        required=False,
+        widget=forms.CheckboxInput(attrs={'class': 'form-check-input'})
     )
\ No newline at end of file
@@ -2,25 +2,42 @@
 
 import tempfile
 import os
+import glob
+import hashlib
+import json
 import subprocess
 import logging
+import multiprocessing
 import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from datetime import timedelta
+from scheduler.scheduler import run_once
 from .models import Job, Table, Column
+from .readers import (
+    get_file_format, is_data_file, read_column_names, read_sample_data,
+    infer_column_types, read_and_convert_file, iter_data_batches, get_filter_columns,
+)
+from .parallel_csv import iter_csv_batches, split_csv_file, UnsafeSplitError
+from .profiler import DataProfile, find_key_candidates
+from .snapshots import take_snapshot, save_snapshot, apply_snapshot_retention
+from .change_feed import record_changes
+from .transforms import run_transform, save_row_hashes, drop_row_hashes
 import pandas as pd
 import numpy as np
-import re
 import psycopg2
-from dateutil.parser import parse, ParserError
 from django.conf import settings
 from django.db.models import Q
-from django.db import connections
-import csv
+from django.db import connections, transaction, IntegrityError
 
 logger = logging.getLogger(__name__)
 
+# Bookkeeping table in the itam database. Internal tables use the names the
+# report schema mapper skips, see reports.schema_mapper.INTERNAL_TABLE_PATTERN
+CHECKPOINT_TABLE = '_import_checkpoints'
+
 
 def find_latest_data_file():
     base_dir = settings.BASE_DIR
@@ -30,7 +47,7 @@ def find_latest_data_file():
     latest_time = 0
 
     for filename in os.listdir(base_dir):
-        if filename.lower().endswith(('.xlsx', '.csv', '.json')):
+        if is_data_file(filename):
             file_path = os.path.join(base_dir, filename)
             creation_time = os.path.getmtime(file_path)
             if one_minute_ago <= creation_time <= now:
@@ -41,6 +58,92 @@ def find_latest_data_file():
     return latest_file
 
 
+def find_data_files(script, since=None):
+    """
+    Return the data files to import for a script. A script with a file_glob
+    gets every matching file modified since `since` (the script's start time),
+    otherwise the single latest data file in BASE_DIR.
+    """
+    if not script.file_glob:
+        file_path = find_latest_data_file()
+        return [file_path] if file_path else []
+
+    if since is None:
+        since = time.time() - 120
+
+    pattern = os.path.join(settings.BASE_DIR, script.file_glob)
+    return sorted(
+        file_path for file_path in glob.glob(pattern, recursive=True)
+        if is_data_file(file_path) and os.path.getmtime(file_path) >= since
+    )
+
+
+def use_parallel_csv(file_paths):
+    return (
+        len(file_paths) == 1
+        and get_file_format(file_paths[0]) == ('.csv', None)
+        and settings.CONNECTOR_IMPORT_WORKERS > 1
+        and os.path.getsize(file_paths[0]) >= settings.CONNECTOR_PARALLEL_CSV_MIN_SIZE
+    )
+
+
+def use_chunked_reader(file_paths):
+    # JSON is always parsed incrementally. Compressed CSV can't be split into
+    # byte ranges, so it is decompressed and converted as a stream of chunks
+    if len(file_paths) != 1:
+        return False
+    file_format, compression = get_file_format(file_paths[0])
+    return file_format in ('.json', '.ndjson') or (compression is not None and file_format == '.csv')
+
+
+def check_file_schemas(file_paths):
+    """
+    Return the column names shared by all files, raising a ValueError if any
+    file's header differs from the first one.
+    """
+    column_names = read_column_names(file_paths[0])
+    mismatched = [file_path for file_path in file_paths[1:] if read_column_names(file_path) != column_names]
+    if mismatched:
+        raise ValueError(
+            f"Columns of {', '.join(os.path.basename(f) for f in mismatched)} "
+            f"do not match {os.path.basename(file_paths[0])}: {column_names}"
+        )
+    return column_names
+
+
+def read_combined_sample(file_paths, nrows=500000, usecols=None):
+    # Take an equal share of the sample from every file so type inference
+    # sees all of them
+    nrows_per_file = max(nrows // len(file_paths), 1000)
+    return pd.concat([read_sample_data(file_path, nrows_per_file, usecols) for file_path in file_paths], ignore_index=True)
+
+
+def read_data_files(file_paths, original_column_names, inferred_types, column_mapping, date_formats=None, row_filter=None):
+    """
+    Read and convert all data files into one DataFrame, parsing multiple files
+    in parallel across a process pool.
+    """
+    if len(file_paths) == 1:
+        return read_and_convert_file(file_paths[0], original_column_names, inferred_types, column_mapping, date_formats, row_filter)
+
+    max_workers = min(len(file_paths), settings.CONNECTOR_IMPORT_WORKERS)
+    logger.info(f"Reading {len(file_paths)} files with {max_workers} worker processes")
+
+    # Use spawn so workers don't inherit the scheduler's threads and locks
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        frames = list(executor.map(
+            read_and_convert_file,
+            file_paths,
+            repeat(original_column_names),
+            repeat(inferred_types),
+            repeat(column_mapping),
+            repeat(date_formats),
+            repeat(row_filter),
+        ))
+
+    return pd.concat(frames, ignore_index=True)
+
+
 # First, get the associated Table object using a more robust method
 def get_table(script):
     return script.tables.filter(Q(table_name__isnull=False) & ~Q(table_name=''))\
@@ -48,39 +151,12 @@ def get_table(script):
                         .first()
 
 
-def get_column_names(script):
-    file_path = find_latest_data_file()
+def get_column_names(script, file_path=None):
+    file_path = file_path or find_latest_data_file()
     if not file_path:
         raise ValueError("No suitable data file found")
-    
-    if file_path.lower().endswith('.csv'):
-        encodings_to_try = ['utf-8-sig', 'utf-8', 'latin-1']
-        for encoding in encodings_to_try:
-            try:
-                with open(file_path, 'r', newline='', encoding=encoding) as f:
-                    reader = csv.reader(f)
-                    header = next(reader)
-                return header
-            except UnicodeDecodeError:
-                continue
-        raise ValueError(f"Unable to read CSV file header with any of the attempted encodings: {encodings_to_try}")
-    
-    elif file_path.lower().endswith('.xlsx'):
-        try:
-            df = pd.read_excel(file_path, nrows=0)
-            return df.columns.tolist()
-        except Exception as e:
-            raise ValueError(f"Error reading Excel file header: {str(e)}")
-    
-    elif file_path.lower().endswith('.json'):
-        try:
-            df = pd.read_json(file_path, nrows=0)
-            return df.columns.tolist()
-        except Exception as e:
-            raise ValueError(f"Error reading JSON file structure: {str(e)}")
-    
-    else:
-        raise ValueError(f"Unsupported file type: {file_path}")
+
+    return read_column_names(file_path)
 
 
 def get_override_column_names(script, original_column_names):
@@ -96,103 +172,213 @@ def get_override_column_names(script, original_column_names):
     return final_column_names
 
 
-def set_table_primary_key(script, job, original_column_names):
-    if not script.table_name or script.import_enabled == 0 or not script.table_name.strip():
-        logger.warning(f"Skipping SQL import for script {script.name}: table_name is empty or None")
-        return True, "SQL import skipped: no table name provided", None
-
-    try:
-        logger.info(f"Setting primary key for table {script.table_name}")
-
-        # Get original column names
-        # original_column_names = get_column_names(script)
-        
-        # Get final column names (with overrides applied)
-        final_column_names = get_override_column_names(script, original_column_names)
-        
-        # Create a mapping between original and final column names
-        column_mapping = dict(zip(original_column_names, final_column_names))
-
-        # Get all columns marked as primary key for this script and table
-        primary_key_columns = Column.objects.filter(
-            script=script,
-            table_name=script.table_name,
-            primary_key=True
-        ).values_list('column_name', flat=True)
-
-        if not primary_key_columns:
-            logger.warning(f"No primary key columns found for table {script.table_name}")
-            return True, None
-
-        # Map the primary key columns to their final names (with overrides)
-        final_pk_columns = [column_mapping.get(col, col) for col in primary_key_columns]
-
-        # Convert final column names to a comma-separated string for the SQL query
-        pk_columns_str = ', '.join(f'`{col}`' for col in final_pk_columns)
-
-        # Connect to the database using Django's connection
-        with connections['itam'].cursor() as cursor:
-            # Check if the table exists
-            cursor.execute(f"""
-                SELECT COUNT(*)
-                FROM information_schema.tables 
-                WHERE table_name = %s
-            """, [script.table_name])
-            table_exists = cursor.fetchone()[0] > 0
-
-            if not table_exists:
-                logger.error(f"Table {script.table_name} does not exist")
-                return False, f"Table {script.table_name} does not exist"
-
-            # Remove existing primary key constraint if it exists
-            cursor.execute(f"""
-                SELECT CONSTRAINT_NAME
-                FROM information_schema.TABLE_CONSTRAINTS
-                WHERE TABLE_NAME = %s AND CONSTRAINT_TYPE = 'PRIMARY KEY'
-            """, [script.table_name])
-            constraint = cursor.fetchone()
-            
-            if constraint:
-                cursor.execute(f"""
-                    ALTER TABLE `{script.table_name}`
-                    DROP PRIMARY KEY
-                """)
-
-            # Add new primary key constraint using the final (possibly overridden) column names
-            cursor.execute(f"""
-                ALTER TABLE `{script.table_name}` 
-                ADD PRIMARY KEY ({pk_columns_str});
-            """)
+def get_included_columns(script, column_names):
+    """
+    Return the columns to import, in file order: every column whose Column
+    object has not been excluded. New columns are included by default.
+    """
+    excluded = set(
+        Column.objects.filter(script=script, table_name=script.table_name, include=False)
+                      .values_list('column_name', flat=True)
+    )
+    included_columns = [col for col in column_names if col not in excluded]
+    if not included_columns:
+        raise ValueError(f"All columns of {script.table_name} are excluded from the import")
+    return included_columns
+
+
+def get_date_formats(script):
+    """Return the stored date format of each known date column of the script's table."""
+    return dict(
+        Column.objects.filter(script=script, table_name=script.table_name)
+                      .exclude(date_format='')
+                      .values_list('column_name', 'date_format')
+    )
+
+
+def save_date_formats(script, date_formats):
+    """
+    Store the detected date formats on the script's Column objects so later
+    imports can parse with them directly. Columns that are no longer dates
+    have their format cleared.
+    """
+    for column in Column.objects.filter(script=script, table_name=script.table_name):
+        date_format = date_formats.get(column.column_name, '')
+        if column.date_format != date_format:
+            column.date_format = date_format
+            column.save(update_fields=['date_format'])
+            logger.info(f"Stored date format for {script.table_name}.{column.column_name}: {date_format or 'none'}")
+
+
+def get_key_columns(script, column_mapping):
+    """
+    Return the final (override-applied) names of the declared primary key
+    columns and secondary index columns for the script's table.
+    """
+    columns = Column.objects.filter(
+        script=script,
+        table_name=script.table_name
+    ).filter(Q(primary_key=True) | Q(secondary_index=True)).order_by('id')
+
+    primary_key_columns = []
+    index_columns = []
+    for column in columns:
+        if column.column_name not in column_mapping:
+            logger.warning(f"Key column {column.column_name} is not present in the data file for {script.table_name} or is excluded")
+            continue
+        final_name = column_mapping[column.column_name]
+        if column.primary_key:
+            primary_key_columns.append(final_name)
+        elif column.secondary_index:
+            index_columns.append(final_name)
+
+    return primary_key_columns, index_columns
+
+
+def get_dictionary_columns(script, column_mapping, inferred_types):
+    """
+    Return the final names of the columns to store dictionary encoded. Only
+    VARCHAR columns can be encoded, since their values key the lookup table.
+    """
+    columns = Column.objects.filter(
+        script=script,
+        table_name=script.table_name,
+        dictionary_encode=True,
+    ).order_by('id')
+
+    dictionary_columns = []
+    for column in columns:
+        if column.column_name not in column_mapping:
+            continue
+        if not inferred_types[column.column_name].startswith('VARCHAR'):
+            logger.warning(f"Not dictionary encoding {script.table_name}.{column.column_name}: only VARCHAR columns can be encoded, found {inferred_types[column.column_name]}")
+            continue
+        dictionary_columns.append(column_mapping[column.column_name])
+    return dictionary_columns
+
+
+def check_primary_key(df, primary_key_columns):
+    """
+    Raise a ValueError if the primary key columns contain NULLs or duplicate
+    values, so the import fails before any DDL runs.
+    """
+    if not primary_key_columns:
+        return
+
+    null_keys = df[primary_key_columns].isna().any(axis=1)
+    if null_keys.any():
+        raise ValueError(f"Primary key ({', '.join(primary_key_columns)}) contains NULL values in {int(null_keys.sum())} rows")
+
+    duplicate_keys = df.duplicated(subset=primary_key_columns, keep=False)
+    if duplicate_keys.any():
+        examples = df.loc[duplicate_keys, primary_key_columns].drop_duplicates().head(5).to_dict('records')
+        raise ValueError(f"Primary key ({', '.join(primary_key_columns)}) has {int(duplicate_keys.sum())} rows with duplicate values, e.g. {examples}")
+
+
+def hash_keys(df, primary_key_columns):
+    return pd.util.hash_pandas_object(df[primary_key_columns], index=False).to_numpy()
+
+
+def check_streamed_primary_key(file_path, plan):
+    """
+    Check the primary key of a file that is loaded in batches, as
+    check_primary_key does for a file read whole, so the import fails before
+    any DDL runs. Only the key columns and the columns the row filter needs
+    are read, and only a 64-bit hash of every key is kept; the rows whose
+    hashes collide are read again to tell duplicates from hash collisions.
+    """
+    primary_key_columns = plan['primary_key_columns']
+    key_mapping = {orig: final for orig, final in plan['column_mapping'].items() if final in primary_key_columns}
+    filter_columns = get_filter_columns(plan['row_filter'], plan['original_column_names']) if plan['row_filter'] else []
+    read_columns = [col for col in plan['original_column_names'] if col in key_mapping or col in filter_columns]
+
+    def key_batches():
+        return iter_data_batches(
+            file_path,
+            read_columns,
+            plan['inferred_types'],
+            key_mapping,
+            chunksize=settings.CONNECTOR_IMPORT_CHUNK_ROWS,
+            date_formats=plan['date_formats'],
+            row_filter=plan['row_filter'],
+        )
 
-        logger.info(f"Successfully set primary key for table {script.table_name}: {pk_columns_str}")
-        return True, None
-    except Exception as e:
-        logger.error(f"Error setting primary key for job {job.id}, script {script.name}: {str(e)}", exc_info=True)
-        return False, f"Error setting primary key: {str(e)}"
+    hashes = []
+    for batch in key_batches():
+        null_keys = batch[primary_key_columns].isna().any(axis=1)
+        if null_keys.any():
+            raise ValueError(f"Primary key ({', '.join(primary_key_columns)}) contains NULL values in {file_path}")
+        hashes.append(hash_keys(batch, primary_key_columns))
+    if not hashes:
+        return
+
+    unique_hashes, counts = np.unique(np.concatenate(hashes), return_counts=True)
+    colliding = unique_hashes[counts > 1]
+    if len(colliding):
+        candidates = pd.concat(
+            [batch[np.isin(hash_keys(batch, primary_key_columns), colliding)] for batch in key_batches()],
+            ignore_index=True,
+        )
+        check_primary_key(candidates, primary_key_columns)
 
 
-def execute_transform_script(script, job):
+def estimate_row_count(table_name):
+    """
+    Return InnoDB's row estimate for a table from information_schema.TABLES
+    instead of scanning it with COUNT(*).
+    """
+    with connections['itam'].cursor() as cursor:
+        cursor.execute("""
+            SELECT TABLE_ROWS
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, [table_name])
+        row = cursor.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def recount_table_rows(table_id):
+    """
+    Replace a table's estimated row_count with an exact COUNT(*). Intended to
+    run as a scheduler job, see schedule_row_recount.
+    """
     try:
-        table = get_table(script)    
-
-        if not table.run_transform or not table.transform_script:
-            return True, None, None
-
-        logger.info(f"Executing transform script for {script.name}")
-        
-        # Connect to the database using Django's connection
-        with connections['itam'].cursor() as cursor:
-            # Execute the transform script
-            cursor.execute(table.transform_script)
-        
-        logger.info(f"Successfully executed transform script for {script.name}")
-        return True, f"Transform script for {script.name} executed successfully", None
+        table = Table.objects.get(id=table_id)
+        table.row_count = get_row_count(table.table_name)
+        table.save(update_fields=['row_count'])
+        logger.info(f"Exact row count for {table.table_name}: {table.row_count}")
     except Exception as e:
-        logger.error(f"Error during transform script execution for job {job.id}, script {script.name}: {str(e)}", exc_info=True)
-        return False, None, f"Error during transform script execution: {str(e)}"
-
-
-def update_table_metadata(script, job):
+        logger.error(f"Error recounting rows for table {table_id}: {str(e)}", exc_info=True)
+    finally:
+        connections.close_all()
+
+
+def schedule_row_recount(table):
+    # Replaces a recount of the table that has not started yet
+    run_once(recount_table_rows, [table.id], f'connector_recount_{table.id}')
+    logger.info(f"Scheduled background row recount for {table.table_name}")
+
+
+def refresh_row_count(table, recount=None):
+    """
+    Set the row_count of a table changed outside the importer to the InnoDB
+    estimate. With recount (by default CONNECTOR_BACKGROUND_RECOUNT) the
+    estimate is replaced by an exact count in a scheduler job.
+    """
+    if recount is None:
+        recount = settings.CONNECTOR_BACKGROUND_RECOUNT
+    table.row_count = estimate_row_count(table.table_name)
+    table.save(update_fields=['row_count'])
+    logger.info(f"Estimated row count for {table.table_name}: {table.row_count}")
+    if recount:
+        schedule_row_recount(table)
+
+
+def update_table_metadata(script, job, row_count):
+    """
+    Record the import on the Table object. row_count is the number of rows
+    in the imported table, as counted by the loader.
+    """
     if not script.table_name or script.import_enabled == 0 or not script.table_name.strip():
         logger.warning(f"Skipping table metadata update for script {script.name}: table_name is empty or None")
         return True, None
@@ -212,13 +398,8 @@ def update_table_metadata(script, job):
         if table.row_count:
             table.row_count_prev = table.row_count
         
-        # 3. Get current row count from the imported table
-        with connections['itam'].cursor() as cursor:
-            cursor.execute(f'SELECT COUNT(*) FROM `{script.table_name}`')
-            current_row_count = cursor.fetchone()[0]
-        
-        # Update row_count with the current count
-        table.row_count = current_row_count
+        # 3. Use the loader's row count
+        table.row_count = row_count
         
         # Save the changes
         table.save()
@@ -230,7 +411,21 @@ def update_table_metadata(script, job):
         return False, f"Error updating table metadata: {str(e)}"
 
 
-def update_column_metadata(script, job, original_column_names, file_path):
+def get_unique_columns(cursor, table_name, column_mapping):
+    """
+    Return {original name: is unique} for columns of an imported table, given
+    as {original name: column name}. The distinct values of all of them are
+    counted in one scan of the table; a column holding NULLs is not unique.
+    """
+    if not column_mapping:
+        return {}
+    distinct_counts = ', '.join(f'COUNT(DISTINCT `{col}`)' for col in column_mapping.values())
+    cursor.execute(f'SELECT COUNT(*), {distinct_counts} FROM `{table_name}`')
+    row_count, *counts = cursor.fetchone()
+    return {orig: count == row_count for orig, count in zip(column_mapping, counts)}
+
+
+def update_column_metadata(script, job, original_column_names):
     if not script.table_name or script.import_enabled == 0 or not script.table_name.strip():
         logger.warning(f"Skipping column metadata update for script {script.name}: table_name is empty or None")
         return True, None
@@ -238,16 +433,6 @@ def update_column_metadata(script, job, original_column_names, file_path):
     try:
         logger.info(f"Updating column metadata for script {script.name}")
         
-        # Read the CSV file
-        df = pd.read_csv(file_path, nrows=None, dtype=str, encoding='utf-8-sig', header=0)
-
-        # Dictionary to store results of uniqueness check
-        unique_columns = {}
-
-        # Iterate through each column and check for uniqueness
-        for column in df.columns:
-            unique_columns[column] = df[column].nunique() == len(df)
-
         current_column_names = get_override_column_names(script, original_column_names)
         logger.info(f"Current column names (with overrides): {current_column_names}")
 
@@ -280,10 +465,19 @@ def update_column_metadata(script, job, original_column_names, file_path):
             cursor.execute(f"""
                 SELECT column_name, data_type
                 FROM information_schema.columns
-                WHERE table_name = %s
+                WHERE table_schema = DATABASE() AND table_name = %s
             """, [script.table_name])
             db_column_types = dict(cursor.fetchall())
 
+            # Uniqueness is counted in the loaded table rather than by reading
+            # the data files again; excluded columns are never unique candidates
+            included_columns = get_included_columns(script, original_column_names)
+            unique_columns = get_unique_columns(cursor, script.table_name, {
+                orig_name: curr_name
+                for orig_name, curr_name in zip(original_column_names, current_column_names)
+                if orig_name in included_columns and curr_name in db_column_types
+            })
+
         # Create new Column objects for new columns
         for orig_name, curr_name in columns_to_add:
             Column.objects.create(
@@ -322,255 +516,581 @@ def update_column_metadata(script, job, original_column_names, file_path):
         return False, f"Error updating column metadata: {str(e)}"
 
 
-def execute_sql_import(script, job):
-    if not script.table_name or script.import_enabled == 0 or not script.table_name.strip():
-        logger.warning(f"Skipping SQL import for script {script.name}: table_name is empty or None")
-        return True, "SQL import skipped: no table name provided", None
-
-    try:
-        # Find the latest data file
-        file_path = find_latest_data_file()
-        if not file_path:
-            raise ValueError("No suitable data file found")
+def prepare_import(script, file_paths, save_formats=True):
+    """
+    Work out everything needed to read the data files: column names, inferred
+    types, date formats and declared keys. Returns the import plan as a dict.
+
+    Only the included columns end up in column_mapping. original_column_names
+    lists the columns to read: the included ones plus any excluded column the
+    script's row filter refers to.
+    """
+    # All files must share the same columns
+    file_column_names = check_file_schemas(file_paths)
+    included_columns = get_included_columns(script, file_column_names)
+    row_filter = script.row_filter.strip()
+    filter_columns = get_filter_columns(row_filter, file_column_names) if row_filter else []
+    original_column_names = [col for col in file_column_names if col in included_columns or col in filter_columns]
+
+    # Get final column names for the included columns
+    final_column_names = get_override_column_names(script, included_columns)
+    column_mapping = dict(zip(included_columns, final_column_names))
+    if len(original_column_names) < len(file_column_names):
+        logger.info(f"Reading {len(original_column_names)} of {len(file_column_names)} columns")
+
+    # Read the sample data across all files
+    df_sample = read_combined_sample(file_paths, usecols=original_column_names)
+
+    # Rename columns in the sample DataFrame
+    df_sample.columns = original_column_names
+
+    # Infer column types using the sample, reusing stored date formats
+    inferred_types, date_formats = infer_column_types(df_sample, get_date_formats(script))
+    if save_formats:
+        save_date_formats(script, date_formats)
+
+    primary_key_columns, index_columns = get_key_columns(script, column_mapping)
+    dictionary_columns = get_dictionary_columns(script, column_mapping, inferred_types)
+
+    # The types of the loaded table, where dictionary encoded columns hold
+    # integer surrogates
+    table_types = dict(inferred_types)
+    for orig_col, final_col in column_mapping.items():
+        if final_col in dictionary_columns:
+            table_types[orig_col] = 'INT'
+
+    return {
+        'original_column_names': original_column_names,
+        'column_mapping': column_mapping,
+        'row_filter': row_filter,
+        'inferred_types': inferred_types,
+        'date_formats': date_formats,
+        'primary_key_columns': primary_key_columns,
+        'index_columns': index_columns,
+        'dictionary_columns': dictionary_columns,
+        'table_types': table_types,
+        'df_sample': df_sample,
+    }
+
+
+def read_import_batches(file_paths, plan, check_keys=True, checkpoint=None, split=True):
+    """
+    Return the converted data as an iterable of DataFrames, choosing the
+    parallel, chunked or whole-file reader for the given files. With a
+    checkpoint, the chunks it has already loaded are skipped. split=False
+    reads a large CSV sequentially, for when its byte ranges failed to parse.
+    """
+    skip_chunks = checkpoint['chunks_loaded'] if checkpoint else 0
+
+    # Files loaded in batches have their primary key checked in a first
+    # pass; a resumed import was checked when it started
+    streamed = use_chunked_reader(file_paths) or use_parallel_csv(file_paths)
+    if streamed and check_keys and not skip_chunks and plan['primary_key_columns']:
+        check_streamed_primary_key(file_paths[0], plan)
+
+    # A checkpoint without a byte offset was written by the sequential reader
+    boundaries = None
+    if split and use_parallel_csv(file_paths) and not (skip_chunks and checkpoint['byte_offset'] is None):
+        try:
+            boundaries = split_csv_file(file_paths[0], settings.CONNECTOR_PARALLEL_CSV_CHUNK_SIZE, start=checkpoint['byte_offset'] if skip_chunks else 0)
+        except UnsafeSplitError as e:
+            logger.warning(f"Reading {file_paths[0]} sequentially: {str(e)}")
+
+    if boundaries is not None:
+        # Huge single CSV: parse byte ranges in worker processes and load
+        # the batches as they arrive
+        logger.info(f"Reading {file_paths[0]} in parallel byte ranges")
+        return iter_csv_batches(
+            file_paths[0],
+            boundaries,
+            plan['original_column_names'],
+            plan['inferred_types'],
+            plan['column_mapping'],
+            max_workers=settings.CONNECTOR_IMPORT_WORKERS,
+            date_formats=plan['date_formats'],
+            row_filter=plan['row_filter'],
+        )
 
-        logger.info(f"File path: {file_path}")
+    if streamed:
+        logger.info(f"Reading {file_paths[0]} in batches of {settings.CONNECTOR_IMPORT_CHUNK_ROWS} rows")
+        return iter_data_batches(
+            file_paths[0],
+            plan['original_column_names'],
+            plan['inferred_types'],
+            plan['column_mapping'],
+            chunksize=settings.CONNECTOR_IMPORT_CHUNK_ROWS,
+            date_formats=plan['date_formats'],
+            row_filter=plan['row_filter'],
+            skip_chunks=skip_chunks,
+        )
 
-        # Read the sample data
-        df_sample = read_sample_data(file_path)
+    # Now read the entire data using the inferred dtypes
+    df = read_data_files(
+        file_paths,
+        plan['original_column_names'],
+        plan['inferred_types'],
+        plan['column_mapping'],
+        plan['date_formats'],
+        plan['row_filter'],
+    )
 
-        # Get original and final column names
-        original_column_names = get_column_names(script)
-        final_column_names = get_override_column_names(script, original_column_names)
-        column_mapping = dict(zip(original_column_names, final_column_names))
+    logger.info(f"DataFrame shape: {df.shape}")
+    logger.info(f"DataFrame columns: {df.columns.tolist()}")
 
-        # Rename columns in the sample DataFrame
-        df_sample.columns = original_column_names
+    # Validate the declared primary key before touching the database
+    if check_keys:
+        check_primary_key(df, plan['primary_key_columns'])
 
-        # Infer column types using the sample
-        inferred_types = infer_column_types(df_sample)
+    # Load in key order, in chunks that can be checkpointed
+    if plan['primary_key_columns']:
+        df = df.sort_values(by=plan['primary_key_columns'], kind='mergesort', ignore_index=True)
+    chunk_rows = settings.CONNECTOR_IMPORT_CHUNK_ROWS
+    return (df.iloc[start:start + chunk_rows] for start in range(skip_chunks * chunk_rows, len(df), chunk_rows))
 
-        # Now read the entire file using the inferred dtypes
-        df = read_full_data(file_path, original_column_names, inferred_types)
 
-        # Rename columns in the full DataFrame using the mapping
-        df.rename(columns=column_mapping, inplace=True)
+def execute_sql_import(script, job, file_paths=None):
+    if not script.table_name or script.import_enabled == 0 or not script.table_name.strip():
+        logger.warning(f"Skipping SQL import for script {script.name}: table_name is empty or None")
+        return True, "SQL import skipped: no table name provided", None, 0
 
-        # Convert columns to appropriate types after reading
-        for orig_col, final_col in column_mapping.items():
-            df[final_col] = convert_column_type(df[final_col], inferred_types[orig_col])
+    try:
+        # Find the data files produced by the script
+        file_paths = file_paths or find_data_files(script)
+        if not file_paths:
+            raise ValueError("No suitable data file found")
 
-        logger.info(f"DataFrame shape: {df.shape}")
-        logger.info(f"DataFrame columns: {df.columns.tolist()}")
+        logger.info(f"File paths: {file_paths}")
+
+        plan = prepare_import(script, file_paths)
+        primary_key_columns = plan['primary_key_columns']
+        dictionary_columns = plan['dictionary_columns']
+        staging_table = get_staging_table_name(script.table_name)
+
+        table, created = Table.objects.get_or_create(script=script, table_name=script.table_name)
+        transform = table.run_transform and bool(table.transform_script)
+        if transform and dictionary_columns:
+            # The staging table of an encoded table holds integer surrogates
+            raise ValueError("Transform scripts are not supported on tables with dictionary encoded columns")
+
+        # Dictionary encoded tables keep the data in an internal table of
+        # integer surrogates, exposed under the table name by a view
+        data_table = get_encoded_table_name(script.table_name) if dictionary_columns else script.table_name
+
+        checkpoint = {
+            'table_name': script.table_name,
+            'file_paths': file_paths,
+            'file_fingerprint': fingerprint_files(file_paths),
+            'plan_fingerprint': fingerprint_plan(plan),
+            'chunks_loaded': 0,
+            'rows_loaded': 0,
+            'byte_offset': None,
+        }
 
         # Database operations
         with connections['itam'].cursor() as cursor:
             # Set the character set to UTF-8
             cursor.execute("SET NAMES utf8mb4;")
-            
-            # Check if the table exists and delete it if it does
-            if table_exists(cursor, script.table_name):
-                logger.info(f"Table '{script.table_name}' already exists. Deleting it.")
-                cursor.execute(f'DROP TABLE IF EXISTS `{script.table_name}`')
+            ensure_checkpoint_table(cursor)
+
+            # Resume an unfinished import of the same files with the same plan
+            previous = get_checkpoint(cursor, script.table_name)
+            resume = bool(
+                previous
+                and previous['file_fingerprint'] == checkpoint['file_fingerprint']
+                and previous['plan_fingerprint'] == checkpoint['plan_fingerprint']
+                and get_table_type(cursor, staging_table) == 'BASE TABLE'
+            )
+            if resume:
+                checkpoint = previous
 
-            # Create the table with inferred types and final column names
-            create_table(cursor, script.table_name, column_mapping, inferred_types)
+            # Read the data first: the primary key is validated here, before
+            # any DDL runs or a checkpoint is saved
+            batches = read_import_batches(file_paths, plan, checkpoint=checkpoint)
 
-            # Insert data
-            insert_data(cursor, df, script.table_name)
+            if resume:
+                logger.info(f"Resuming import of {script.table_name} after {checkpoint['chunks_loaded']} chunks ({checkpoint['rows_loaded']} rows)")
+            else:
+                # Load into a fresh staging table; the live table stays readable
+                drop_table_or_view(cursor, staging_table)
+                create_table(cursor, staging_table, plan['column_mapping'], plan['table_types'], primary_key_columns, plan['index_columns'])
+                save_checkpoint(cursor, checkpoint)
 
-        # Verify the data was inserted
-        row_count = get_row_count(script.table_name)
-        logger.info(f"Rows in table after insert: {row_count}")
+            # Insert data, committing a checkpoint with every chunk
+            def load(batches):
+                if dictionary_columns:
+                    batches = encode_batches(cursor, batches, script.table_name, dictionary_columns)
+                return load_batches(cursor, batches, staging_table, primary_key_columns, checkpoint)
 
-        logger.info(f"Successfully imported {len(df)} rows into {script.table_name}")
-        return True, f"Successfully imported {len(df)} rows into {script.table_name}", None
+            try:
+                try:
+                    rows_loaded = load(batches)
+                except UnsafeSplitError as e:
+                    # A byte range failed to parse, so the ranges already
+                    # loaded may be split wrongly too: start over sequentially
+                    logger.warning(f"Reloading {file_paths[0]} sequentially: {str(e)}")
+                    cursor.execute(f'TRUNCATE TABLE `{staging_table}`')
+                    checkpoint.update(chunks_loaded=0, rows_loaded=0, byte_offset=None)
+                    save_checkpoint(cursor, checkpoint)
+                    rows_loaded = load(read_import_batches(file_paths, plan, check_keys=False, checkpoint=checkpoint, split=False))
+            except IntegrityError:
+                # InnoDB can still reject keys the check let through, e.g.
+                # ones differing only in case under a case-insensitive
+                # collation. That would fail every resume the same way, so
+                # the import starts over once the file is fixed
+                drop_table_or_view(cursor, staging_table)
+                delete_checkpoint(cursor, script.table_name)
+                raise
+
+            # Transform the staging table before it replaces the live table.
+            # On failure the checkpoint is kept, so a rerun only repeats the
+            # transform on the loaded staging table
+            transform_report = None
+            if transform:
+                transform_report, incremental, transform_seconds = run_transform(
+                    cursor, table, staging_table, primary_key_columns, full=table.transform_full_recompute
+                )
+                cursor.execute(f'SELECT COUNT(*) FROM `{staging_table}`')
+                rows_loaded = cursor.fetchone()[0]
+
+            live_type = get_table_type(cursor, script.table_name)
+
+            # Diff the new data against the data it replaces, which for a
+            # dictionary encoded table is the encoded table behind the view
+            changes = None
+            if table.change_feed:
+                old_table = None
+                if live_type:
+                    old_table = get_encoded_table_name(script.table_name) if live_type == 'VIEW' else script.table_name
+                changes = record_changes(cursor, script.table_name, old_table, staging_table, primary_key_columns, table.import_run + 1)
+
+            # Keep the import being replaced if the table has a snapshot retention
+            keep_as, snapshot = None, None
+            if table.snapshot_retention and live_type:
+                keep_as, snapshot = take_snapshot(cursor, table, live_type)
+
+            if dictionary_columns:
+                swap_staging_table(cursor, staging_table, data_table)
+                # Build the view under the now free staging name and swap it in
+                create_dictionary_view(cursor, staging_table, data_table, script.table_name, plan['column_mapping'], dictionary_columns)
+                swap_staging_table(cursor, staging_table, script.table_name, keep_as)
+            else:
+                swap_staging_table(cursor, staging_table, script.table_name, keep_as)
+                drop_table_or_view(cursor, get_encoded_table_name(script.table_name))
+            if transform_report is not None and primary_key_columns:
+                save_row_hashes(cursor, script.table_name)
+            else:
+                drop_row_hashes(cursor, script.table_name)
+            delete_checkpoint(cursor, script.table_name)
+
+            if snapshot:
+                save_snapshot(snapshot)
+            apply_snapshot_retention(cursor, table)
+            table.import_run += 1
+            update_fields = ['import_run']
+            if transform_report is not None:
+                table.transform_report = transform_report
+                update_fields.append('transform_report')
+                if not incremental:
+                    table.transform_full_seconds = transform_seconds
+                    table.transform_full_recompute = False
+                    update_fields += ['transform_full_seconds', 'transform_full_recompute']
+            table.save(update_fields=update_fields)
+
+        message = f"Successfully imported {rows_loaded} rows into {script.table_name}"
+        if changes is not None:
+            message += f" ({changes.get('insert', 0)} inserted, {changes.get('update', 0)} updated, {changes.get('delete', 0)} deleted)"
+        if transform_report:
+            message += f"\nTransform script:\n{transform_report}"
+        logger.info(message)
+        return True, message, None, rows_loaded
     except Exception as e:
         logger.error(f"Error during import for job {job.id}: {str(e)}", exc_info=True)
-        return False, None, f"Error during import: {str(e)}"
-
-def read_sample_data(file_path, nrows=500000):
-    if file_path.lower().endswith('.csv'):
-        return pd.read_csv(file_path, nrows=nrows, dtype=str, encoding='utf-8-sig')
-    elif file_path.lower().endswith('.xlsx'):
-        return pd.read_excel(file_path, nrows=nrows, dtype=str)
-    elif file_path.lower().endswith('.json'):
-        return pd.read_json(file_path, nrows=nrows, dtype=str, encoding='utf-8-sig')
-    else:
-        raise ValueError("Invalid file type")
-
-def infer_column_types(df_sample):
-    inferred_types = {}
-    for col in df_sample.columns:
-        if df_sample[col].isnull().all():
-            inferred_types[col] = 'TEXT'
-        elif is_likely_integer(df_sample[col]):
-            inferred_types[col] = determine_integer_type(df_sample[col])
-        elif is_likely_float(df_sample[col]):
-            inferred_types[col] = 'DOUBLE'
-        elif is_likely_date(df_sample[col]):
-            # Determine if it's a DATETIME or DATE
-            sample = df_sample[col].head(100)  # Sample for performance
-            if pd.to_datetime(sample, errors='coerce').dt.time.ne(pd.Timestamp('00:00:00').time()).any():
-                inferred_types[col] = 'DATETIME'
-            else:
-                inferred_types[col] = 'DATE'
-        else:
-            inferred_types[col] = determine_string_type(df_sample[col])
-    return inferred_types
+        return False, None, f"Error during import: {str(e)}", 0
 
-def is_likely_integer(series):
-    # Remove any completely empty entries
-    series = series.dropna()
-    
-    if series.empty:
-        return False
 
-    try:
-        # Try to convert to numeric
-        numeric_series = pd.to_numeric(series, errors='raise')
-        
-        # Check if all values are integers
-        is_integer = numeric_series.apply(lambda x: x.is_integer()).all()
-        
-        # Check if all values are within the INT range
-        in_range = ((numeric_series >= -2147483648) & (numeric_series <= 2147483647)).all()
-        
-        return is_integer and in_range
-    except ValueError:
-        # If conversion to numeric fails, it's not an integer column
-        return False
+def profile_data_files(script, job, file_paths):
+    """
+    Run the import pipeline up to the point of loading and report the
+    proposed DDL, column statistics, primary key candidates and an estimated
+    load time. Nothing is written to the itam database.
+    """
+    if not script.table_name or not script.table_name.strip():
+        return True, f"Profile of {script.name} skipped: no table name provided", None
 
-def is_likely_float(series):
     try:
-        # Remove any completely empty entries
-        series = series.dropna()
-        
-        if series.empty:
-            return False
-        
-        # Check for dashes in any non-null value
-        if series.astype(str).str.contains('-', regex=False).any():
-            return False
-        
-        float_series = pd.to_numeric(series, errors='coerce')
-        
-        # Check if all non-null values can be converted to float
-        all_float = not float_series.isnull().any()
-        
-        # Check if there are any alphabetic characters
-        no_alpha = not series.astype(str).str.contains(r'[a-zA-Z]').any()
-        
-        # Check if it's not an integer series
-        not_integer = not is_likely_integer(series)
-        
-        return all_float and no_alpha and not_integer
-    except:
-        return False
+        start_time = time.time()
+        plan = prepare_import(script, file_paths, save_formats=False)
 
-def is_likely_date(series):
-    # Remove any completely empty entries
-    series = series.dropna()
-    
-    if series.empty:
-        return False
+        key_candidates = find_key_candidates(plan['df_sample'], plan['column_mapping'], plan['primary_key_columns'])
 
-    # Sample the series to reduce processing time
-    sample_size = min(1000, len(series))
-    sample = series.sample(n=sample_size) if len(series) > sample_size else series
+        def profile_batches(split=True):
+            profile = DataProfile(plan['column_mapping'], plan['inferred_types'], plan['date_formats'], key_candidates)
+            for batch in read_import_batches(file_paths, plan, check_keys=False, split=split):
+                profile.update(batch)
+            return profile
 
-    # Common date and datetime formats to try
-    date_formats = [
-        '%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y',
-        '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
-        '%d/%m/%Y %H:%M:%S', '%m/%d/%Y %H:%M:%S',
-    ]
-
-    # Try parsing with specific formats first
-    for date_format in date_formats:
-        if pd.to_datetime(sample, format=date_format, errors='coerce').notna().all():
-            return True
+        try:
+            profile = profile_batches()
+        except UnsafeSplitError as e:
+            logger.warning(f"Profiling {file_paths[0]} sequentially: {str(e)}")
+            profile = profile_batches(split=False)
+
+        # The DDL of the table the import would load, which for dictionary
+        # encoded columns is the internal table behind the view
+        data_table = get_encoded_table_name(script.table_name) if plan['dictionary_columns'] else script.table_name
+        create_table_sql = build_create_table_sql(
+            data_table,
+            plan['column_mapping'],
+            plan['table_types'],
+            plan['primary_key_columns'],
+            plan['index_columns'],
+        )
+        report = profile.report(
+            script.table_name,
+            file_paths,
+            create_table_sql,
+            read_seconds=time.time() - start_time,
+            load_rows_per_second=settings.CONNECTOR_LOAD_ROWS_PER_SECOND,
+        )
+        return True, report, None
+    except Exception as e:
+        logger.error(f"Error during profile for job {job.id}, script {script.name}: {str(e)}", exc_info=True)
+        return False, None, f"Error during profile: {str(e)}"
+
+def get_staging_table_name(table_name):
+    return f'_staging_{table_name}'[:64]
+
+
+def fingerprint_files(file_paths, sample_size=64 * 1024):
+    """
+    Identify the exact data files of an import by path, size, modification
+    time and a hash of their first and last bytes.
+    """
+    digest = hashlib.sha256()
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        digest.update(f"{os.path.abspath(file_path)}|{stat.st_size}|{stat.st_mtime_ns}|".encode())
+        with open(file_path, 'rb') as f:
+            digest.update(f.read(sample_size))
+            if stat.st_size > 2 * sample_size:
+                f.seek(stat.st_size - sample_size)
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def fingerprint_plan(plan):
+    """
+    Hash everything that decides how the data is split into chunks and
+    converted, so a checkpoint is only resumed with the same import plan.
+    """
+    key = {name: value for name, value in plan.items() if name != 'df_sample'}
+    key['chunk_rows'] = settings.CONNECTOR_IMPORT_CHUNK_ROWS
+    key['parallel_chunk_size'] = settings.CONNECTOR_PARALLEL_CSV_CHUNK_SIZE
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def ensure_checkpoint_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{CHECKPOINT_TABLE}` (
+            `table_name` VARCHAR(64) NOT NULL PRIMARY KEY,
+            `file_paths` TEXT NOT NULL,
+            `file_fingerprint` CHAR(64) NOT NULL,
+            `plan_fingerprint` CHAR(64) NOT NULL,
+            `chunks_loaded` INT NOT NULL,
+            `rows_loaded` BIGINT NOT NULL,
+            `byte_offset` BIGINT NULL,
+            `updated_at` DATETIME NOT NULL
+        )
+    """)
 
-    # If specific formats fail, use a more flexible approach on a smaller sample
-    small_sample = sample.head(100)  # Limit to 100 items for the expensive check
 
-    def is_date(x):
-        try:
-            if re.match(r'^\d+(\.\d+)?$', str(x)):
-                float_val = float(x)
-                if 0 <= float_val <= 3155760000:
-                    return True
-            parse(str(x), fuzzy=False)
-            return True
-        except (ValueError, OverflowError, ParserError):
-            return False
-
-    # Check if at least 90% of the small sample are valid dates
-    valid_dates = small_sample.apply(is_date)
-    return valid_dates.sum() / len(valid_dates) >= 0.9
-
-def is_date_only(series):
-    # Remove any completely empty entries
-    series = series.dropna()
-    
-    if series.empty:
-        return False
+def get_checkpoint(cursor, table_name, max_age_hours=None):
+    query = f"""
+        SELECT table_name, file_paths, file_fingerprint, plan_fingerprint, chunks_loaded, rows_loaded, byte_offset
+        FROM `{CHECKPOINT_TABLE}`
+        WHERE table_name = %s
+    """
+    params = [table_name]
+    if max_age_hours is not None:
+        query += " AND updated_at >= NOW() - INTERVAL %s HOUR"
+        params.append(max_age_hours)
+    cursor.execute(query, params)
+    row = cursor.fetchone()
+    if not row:
+        return None
+
+    columns = ['table_name', 'file_paths', 'file_fingerprint', 'plan_fingerprint', 'chunks_loaded', 'rows_loaded', 'byte_offset']
+    checkpoint = dict(zip(columns, row))
+    checkpoint['file_paths'] = json.loads(checkpoint['file_paths'])
+    return checkpoint
+
+
+def save_checkpoint(cursor, checkpoint):
+    cursor.execute(f"""
+        REPLACE INTO `{CHECKPOINT_TABLE}`
+            (table_name, file_paths, file_fingerprint, plan_fingerprint, chunks_loaded, rows_loaded, byte_offset, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+    """, [
+        checkpoint['table_name'],
+        json.dumps(checkpoint['file_paths']),
+        checkpoint['file_fingerprint'],
+        checkpoint['plan_fingerprint'],
+        checkpoint['chunks_loaded'],
+        checkpoint['rows_loaded'],
+        checkpoint['byte_offset'],
+    ])
+
+
+def delete_checkpoint(cursor, table_name):
+    cursor.execute(f'DELETE FROM `{CHECKPOINT_TABLE}` WHERE table_name = %s', [table_name])
+
+
+def find_resumable_files(script):
+    """
+    Return the data files of the script's unfinished import if it checkpointed
+    recently and the files are unchanged, so the job can resume the import
+    without running the script again. Returns an empty list otherwise.
+    """
+    if not script.table_name or script.import_enabled == 0 or not script.table_name.strip():
+        return []
 
     try:
-        date_series = pd.to_datetime(series, errors='coerce')
-        return date_series.notna().any() and (date_series.dt.time == pd.Timestamp('00:00:00').time()).all()
-    except:
-        return False
+        with connections['itam'].cursor() as cursor:
+            ensure_checkpoint_table(cursor)
+            checkpoint = get_checkpoint(cursor, script.table_name, settings.CONNECTOR_IMPORT_RESUME_HOURS)
+        if not checkpoint or not checkpoint['chunks_loaded']:
+            return []
+
+        file_paths = checkpoint['file_paths']
+        if not all(os.path.exists(file_path) for file_path in file_paths):
+            return []
+        if fingerprint_files(file_paths) != checkpoint['file_fingerprint']:
+            logger.info(f"Data files of the unfinished import of {script.table_name} have changed, starting over")
+            return []
+        return file_paths
+    except Exception as e:
+        logger.warning(f"Could not check for an unfinished import of {script.table_name}: {str(e)}")
+        return []
 
-def determine_integer_type(series):
-    series = pd.to_numeric(series, errors='coerce')
-    non_null = series.dropna()
-    min_val, max_val = non_null.min(), non_null.max()
-    if min_val >= -2147483648 and max_val <= 2147483647:
-        return 'INT'
-    else:
-        return 'BIGINT'
-
-def determine_string_type(series):
-    max_length = series.str.len().max()
-    if max_length <= 255:
-        return f'VARCHAR({255})'
-    elif max_length <= 65535:
-        return 'TEXT'
-    elif max_length <= 16777215:
-        return 'MEDIUMTEXT'
+
+def get_table_type(cursor, table_name):
+    """Return 'BASE TABLE' or 'VIEW' for an itam table, or None if it does not exist."""
+    cursor.execute("""
+        SELECT TABLE_TYPE
+        FROM information_schema.tables
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, [table_name])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def drop_table_or_view(cursor, table_name):
+    table_type = get_table_type(cursor, table_name)
+    if table_type == 'VIEW':
+        cursor.execute(f'DROP VIEW `{table_name}`')
+    elif table_type:
+        cursor.execute(f'DROP TABLE `{table_name}`')
+
+
+def swap_staging_table(cursor, staging_table, table_name, keep_as=None):
+    """
+    Replace the live table or view with the loaded staging table (or view)
+    in one atomic rename. With keep_as the replaced table is renamed to it
+    instead of being dropped.
+    """
+    old_table = keep_as or f'_old_{table_name}'[:64]
+    drop_table_or_view(cursor, old_table)
+    if get_table_type(cursor, table_name):
+        cursor.execute(f'RENAME TABLE `{table_name}` TO `{old_table}`, `{staging_table}` TO `{table_name}`')
+        if not keep_as:
+            drop_table_or_view(cursor, old_table)
     else:
-        return 'LONGTEXT'
-
-def read_full_data(file_path, original_column_names, inferred_types):
-    dtype_dict = {}
-    for col, dtype in inferred_types.items():
-        if dtype in ['TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'BIGINT']:
-            dtype_dict[col] = 'Int64'  # Use pandas nullable integer type
-        elif dtype == 'DOUBLE':
-            dtype_dict[col] = 'float64'
+        cursor.execute(f'RENAME TABLE `{staging_table}` TO `{table_name}`')
+    logger.info(f"Swapped {staging_table} in as {table_name}")
+
+
+def get_encoded_table_name(table_name):
+    return f'_enc_{table_name}'[:64]
+
+
+def get_dictionary_table_name(table_name, column_name):
+    return f'_dict_{table_name}_{column_name}'[:64]
+
+
+def load_dictionary(cursor, table_name, column_name):
+    """
+    Create the lookup table of a dictionary encoded column if needed and
+    return its values mapped to their surrogate ids. The lookup table is kept
+    across imports, so a value keeps its id.
+    """
+    dictionary_table = get_dictionary_table_name(table_name, column_name)
+    # A binary no-pad collation keeps values differing only in case or
+    # trailing spaces apart
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS `{dictionary_table}` (
+            `id` INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            `value` VARCHAR(255) CHARACTER SET utf8mb4 COLLATE utf8mb4_nopad_bin NOT NULL,
+            UNIQUE KEY `uq_value` (`value`)
+        )
+    """)
+    cursor.execute(f'SELECT `value`, `id` FROM `{dictionary_table}`')
+    return dict(cursor.fetchall())
+
+
+def encode_column(cursor, values, dictionary_table, dictionary):
+    """
+    Replace the values of a column with their surrogate ids, adding values
+    not seen before to the lookup table.
+    """
+    present = values.notna()
+    text = values[present].astype(str)
+
+    new_values = [value for value in text.unique() if value not in dictionary]
+    if new_values:
+        cursor.executemany(f'INSERT IGNORE INTO `{dictionary_table}` (`value`) VALUES (%s)', [(value,) for value in new_values])
+        chunk_size = 1000
+        for i in range(0, len(new_values), chunk_size):
+            chunk = new_values[i:i + chunk_size]
+            placeholders = ','.join(['%s'] * len(chunk))
+            cursor.execute(f'SELECT `value`, `id` FROM `{dictionary_table}` WHERE `value` IN ({placeholders})', chunk)
+            dictionary.update(cursor.fetchall())
+
+    codes = pd.Series(pd.NA, index=values.index, dtype='Int64')
+    codes[present] = text.map(dictionary).astype('Int64')
+    return codes
+
+
+def encode_batches(cursor, batches, table_name, dictionary_columns):
+    """Yield the batches with every dictionary column replaced by surrogate ids."""
+    dictionaries = {col: load_dictionary(cursor, table_name, col) for col in dictionary_columns}
+    for batch in batches:
+        encoded = {
+            col: encode_column(cursor, batch[col], get_dictionary_table_name(table_name, col), dictionary)
+            for col, dictionary in dictionaries.items()
+        }
+        # assign keeps the batch's attrs, e.g. the checkpoint byte offset
+        yield batch.assign(**encoded)
+
+
+def create_dictionary_view(cursor, view_name, data_table, table_name, column_mapping, dictionary_columns):
+    """
+    Create a view over the encoded data table that joins every dictionary
+    column back to its values, so reports see the table's original shape.
+    """
+    select_columns = []
+    joins = []
+    for i, col in enumerate(column_mapping.values()):
+        if col in dictionary_columns:
+            alias = f'd{i}'
+            select_columns.append(f'{alias}.`value` AS `{col}`')
+            joins.append(f'LEFT JOIN `{get_dictionary_table_name(table_name, col)}` {alias} ON {alias}.`id` = t.`{col}`')
         else:
-            dtype_dict[col] = 'object'
+            select_columns.append(f't.`{col}`')
+
+    create_view_sql = f'CREATE OR REPLACE VIEW `{view_name}` AS SELECT {", ".join(select_columns)} FROM `{data_table}` t {" ".join(joins)}'
+    logger.info(f"Creating dictionary view with SQL: {create_view_sql}")
+    cursor.execute(create_view_sql)
 
-    parse_dates = [col for col, dtype in inferred_types.items() if dtype in ['DATE', 'DATETIME']]
-    
-    if file_path.lower().endswith('.csv'):
-        return pd.read_csv(file_path, dtype=dtype_dict, parse_dates=parse_dates, keep_default_na=False, na_values=[''], encoding='utf-8-sig')
-    elif file_path.lower().endswith('.xlsx'):
-        return pd.read_excel(file_path, dtype=dtype_dict, parse_dates=parse_dates, keep_default_na=False, na_values=[''])
-    elif file_path.lower().endswith('.json'):
-        return pd.read_json(file_path, dtype=dtype_dict, parse_dates=parse_dates, encoding='utf-8-sig')
-    else:
-        raise ValueError("Unsupported file type")
-
-def convert_column_type(series, dtype):
-    if dtype in ['TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'BIGINT']:
-        return pd.to_numeric(series, errors='coerce').astype('Int64')
-    elif dtype == 'DOUBLE':
-        return pd.to_numeric(series, errors='coerce')
-    elif dtype in ['DATE', 'DATETIME']:
-        return pd.to_datetime(series, errors='coerce')
-    else:
-        return series
 
 def table_exists(cursor, table_name):
     cursor.execute("""
@@ -580,9 +1100,28 @@ def table_exists(cursor, table_name):
     """, [table_name])
     return cursor.fetchone()[0] > 0
 
-def create_table(cursor, table_name, column_mapping, inferred_types):
-    columns = [f'`{col}` {inferred_types[orig_col]} NULL' for orig_col, col in column_mapping.items()]
-    create_table_sql = f'CREATE TABLE IF NOT EXISTS `{table_name}` ({", ".join(columns)})'
+def index_column_sql(col, dtype):
+    # BLOB/TEXT columns can only be indexed on a prefix
+    if dtype in ['TEXT', 'MEDIUMTEXT', 'LONGTEXT']:
+        return f'`{col}`(255)'
+    return f'`{col}`'
+
+def build_create_table_sql(table_name, column_mapping, inferred_types, primary_key_columns=None, index_columns=None):
+    primary_key_columns = primary_key_columns or []
+    index_columns = index_columns or []
+    final_types = {col: inferred_types[orig_col] for orig_col, col in column_mapping.items()}
+
+    columns = [f'`{col}` {dtype} {"NOT NULL" if col in primary_key_columns else "NULL"}' for col, dtype in final_types.items()]
+    if primary_key_columns:
+        columns.append(f'PRIMARY KEY ({", ".join(index_column_sql(col, final_types[col]) for col in primary_key_columns)})')
+    for col in index_columns:
+        index_name = f'idx_{col}'[:64]
+        columns.append(f'INDEX `{index_name}` ({index_column_sql(col, final_types[col])})')
+
+    return f'CREATE TABLE IF NOT EXISTS `{table_name}` ({", ".join(columns)})'
+
+def create_table(cursor, table_name, column_mapping, inferred_types, primary_key_columns=None, index_columns=None):
+    create_table_sql = build_create_table_sql(table_name, column_mapping, inferred_types, primary_key_columns, index_columns)
     logger.info(f"Creating table with SQL: {create_table_sql}")
     cursor.execute(create_table_sql)
 
@@ -608,13 +1147,42 @@ def insert_data(cursor, df, table_name):
         chunk = data[i:i + chunk_size]
         cursor.executemany(insert_sql, chunk)
 
+    return len(data)
+
+def load_batches(cursor, batches, table_name, primary_key_columns=None, checkpoint=None):
+    """
+    Insert the batches into table_name and return the total number of rows
+    loaded. With a checkpoint, every batch is committed in one transaction
+    together with the checkpoint row recording it, so a failed import can
+    resume after the last committed batch.
+    """
+    rows_loaded = checkpoint['rows_loaded'] if checkpoint else 0
+    for batch in batches:
+        byte_offset = batch.attrs.get('byte_offset')
+
+        # Sort by the primary key so InnoDB can append to the clustered index in order
+        if primary_key_columns:
+            batch = batch.sort_values(by=primary_key_columns, kind='mergesort', ignore_index=True)
+
+        if checkpoint is None:
+            rows_loaded += insert_data(cursor, batch, table_name)
+        else:
+            with transaction.atomic(using='itam'):
+                rows_loaded += insert_data(cursor, batch, table_name)
+                checkpoint['chunks_loaded'] += 1
+                checkpoint['rows_loaded'] = rows_loaded
+                checkpoint['byte_offset'] = byte_offset
+                save_checkpoint(cursor, checkpoint)
+        logger.debug(f"Loaded {rows_loaded} rows into {table_name}")
+    return rows_loaded
+
 def get_row_count(table_name):
     with connections['itam'].cursor() as cursor:
         cursor.execute(f'SELECT COUNT(*) FROM `{table_name}`')
         return cursor.fetchone()[0]
  
 
-def execute_job_core(job_id):
+def execute_job_core(job_id, profile_only=False):
     job = get_object_or_404(Job, id=job_id)
     
     start_time = time.time()
@@ -626,22 +1194,30 @@ def execute_job_core(job_id):
 
     # Iterate over each script in the parent job
     for script in job.scripts.all().order_by('order_exec'):
-        # Execute the job script
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as temp_file:
-            temp_file.write(script.content)
-            temp_file_path = temp_file.name
-
-        try:
-            result = subprocess.run(["python", "-X", "utf8", temp_file_path], check=True, capture_output=True, text=True)
-            script_output = result.stdout
+        # An unfinished import of unchanged files is resumed without running the script again
+        resume_file_paths = [] if profile_only else find_resumable_files(script)
+        if resume_file_paths:
+            script_output = f"Skipped, resuming the unfinished import of {', '.join(os.path.basename(f) for f in resume_file_paths)}"
             script_error = None
             script_success = True
-        except subprocess.CalledProcessError as e:
-            script_output = e.stdout
-            script_error = e.stderr
-            script_success = False
-        finally:
-            os.unlink(temp_file_path)
+        else:
+            # Execute the job script
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False, encoding='utf-8') as temp_file:
+                temp_file.write(script.content)
+                temp_file_path = temp_file.name
+
+            script_started_at = time.time()
+            try:
+                result = subprocess.run(["python", "-X", "utf8", temp_file_path], check=True, capture_output=True, text=True)
+                script_output = result.stdout
+                script_error = None
+                script_success = True
+            except subprocess.CalledProcessError as e:
+                script_output = e.stdout
+                script_error = e.stderr
+                script_success = False
+            finally:
+                os.unlink(temp_file_path)
 
         output += f"Script {script.name} output:\n{script_output}\n"
         if script_error:
@@ -653,10 +1229,20 @@ def execute_job_core(job_id):
             try:
                 logger.info(f"Starting post-script execution steps for {script.name}")
 
-                file_path = find_latest_data_file()
-                logger.info(f"Found latest data file: {file_path}")
+                file_paths = resume_file_paths or find_data_files(script, since=script_started_at)
+                logger.info(f"Found data files: {file_paths}")
+                if not file_paths:
+                    raise ValueError("No suitable data file found")
+
+                # A profile run reports on the data without touching the table or its metadata
+                if profile_only:
+                    profile_success, profile_output, profile_error = profile_data_files(script, job, file_paths)
+                    output += f"Profile {script.name}:\n{profile_output}\n"
+                    if not profile_success:
+                        raise Exception(f"Profile failed: {profile_error}")
+                    continue
                 
-                column_names = get_column_names(script)
+                column_names = get_column_names(script, file_paths[0])
                 logger.info(f"Retrieved column names: {column_names}")
 
                 # Get or create the Table object
@@ -677,37 +1263,23 @@ def execute_job_core(job_id):
 
                 # Execute SQL import
                 logger.info("Starting SQL import")
-                sql_success, script_output, script_error = execute_sql_import(script, job)
+                sql_success, script_output, script_error, rows_loaded = execute_sql_import(script, job, file_paths)
                 output += f"SQL Import {script.name} output:\n{script_output}\n"
                 if not sql_success:
                     raise Exception(f"SQL Import failed: {script_error}")
 
-                # Execute transform script
-                logger.info("Starting transform script execution")
-                transform_success, transform_output, transform_error = execute_transform_script(script, job)
-                if transform_output:
-                    output += f"Transform Script {script.name} output:\n{transform_output}\n"
-                if not transform_success:
-                    raise Exception(f"Transform script failed: {transform_error}")
-
                 # Update table metadata
                 logger.info("Updating table metadata")
-                metadata_success, metadata_error = update_table_metadata(script, job)
+                metadata_success, metadata_error = update_table_metadata(script, job, rows_loaded)
                 if not metadata_success:
                     raise Exception(f"Failed to update table metadata: {metadata_error}")
 
                 # Update column metadata
                 logger.info("Updating column metadata")
-                column_metadata_success, column_metadata_error = update_column_metadata(script, job, column_names, file_path)
+                column_metadata_success, column_metadata_error = update_column_metadata(script, job, column_names)
                 if not column_metadata_success:
                     raise Exception(f"Failed to update column metadata: {column_metadata_error}")
 
-                # Set primary key
-                logger.info("Setting primary key")
-                pk_success, pk_error = set_table_primary_key(script, job, column_names)
-                if not pk_success:
-                    raise Exception(f"Failed to set primary key: {pk_error}")
-
                 logger.info(f"Successfully completed all post-script execution steps for {script.name}")
 
             except Exception as e:
@@ -722,6 +1294,10 @@ def execute_job_core(job_id):
     end_time = time.time()
     duration = timedelta(seconds=end_time - start_time)
 
+    if profile_only:
+        logger.info(f"Profiled job {job.id}: {job.name} in {duration}")
+        return job, success, output, error
+
     job.last_execution_time = timezone.now()
     job.last_execution_success = success
     job.last_execution_error = error
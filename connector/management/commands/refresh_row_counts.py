@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from connector.models import Table
+from connector.job_execution import refresh_row_count, get_row_count
+
+class Command(BaseCommand):
+    help = 'Refreshes the row counts of imported tables changed outside the importer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tables', nargs='*', help='Table names, all imported tables if omitted')
+        parser.add_argument('--exact', action='store_true', help='Count the rows with COUNT(*) instead of using the InnoDB estimate')
+
+    def handle(self, *args, **options):
+        tables = Table.objects.exclude(table_name__isnull=True).exclude(table_name='')
+        if options['tables']:
+            tables = tables.filter(table_name__in=options['tables'])
+
+        for table in tables:
+            if options['exact']:
+                # Counted here, so the counts are exact when the command returns
+                table.row_count = get_row_count(table.table_name)
+                table.save(update_fields=['row_count'])
+            else:
+                refresh_row_count(table, recount=False)
+            self.stdout.write(f"{table.table_name}: {table.row_count} rows")
+        self.stdout.write(self.style.SUCCESS("Row counts refreshed."))
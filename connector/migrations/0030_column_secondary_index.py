@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0029_alter_script_import_enabled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='column',
+            name='secondary_index',
+            field=models.BooleanField(default=False),
+        ),
+    ]
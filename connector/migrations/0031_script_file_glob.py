@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 10:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0030_column_secondary_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='script',
+            name='file_glob',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
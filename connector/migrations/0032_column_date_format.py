@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 11:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0031_script_file_glob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='column',
+            name='date_format',
+            field=models.CharField(blank=True, default='', max_length=50),
+        ),
+    ]
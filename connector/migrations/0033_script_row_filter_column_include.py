@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-19 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0032_column_date_format'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='column',
+            name='include',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name='script',
+            name='row_filter',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0033_script_row_filter_column_include'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='column',
+            name='dictionary_encode',
+            field=models.BooleanField(default=False),
+        ),
+    ]
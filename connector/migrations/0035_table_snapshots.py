@@ -0,0 +1,45 @@
+# Generated by Django 5.0.7 on 2026-10-19 13:18
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0034_column_dictionary_encode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='import_run',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='snapshot_format',
+            field=models.CharField(choices=[('table', 'Table'), ('parquet', 'Parquet')], default='table', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='snapshot_retention',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='TableSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.PositiveIntegerField()),
+                ('format', models.CharField(choices=[('table', 'Table'), ('parquet', 'Parquet')], max_length=10)),
+                ('location', models.CharField(max_length=1024)),
+                ('row_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='connector.table')),
+            ],
+            options={
+                'ordering': ['-run'],
+                'unique_together': {('table', 'run')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0035_table_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='change_feed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 14:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0036_table_change_feed'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='transform_report',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
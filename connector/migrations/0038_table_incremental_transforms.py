@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-19 15:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connector', '0037_table_transform_report'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='transform_incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='transform_full_recompute',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='table',
+            name='transform_full_seconds',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
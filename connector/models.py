@@ -28,6 +28,8 @@ class Script(models.Model):
     content = models.TextField()
     order_exec = models.PositiveIntegerField()
     table_name = models.CharField(max_length=255, null=True, blank=True)  # New required field
+    file_glob = models.CharField(max_length=255, blank=True, default='')  # e.g. exports/devices_*.csv, relative to BASE_DIR
+    row_filter = models.TextField(blank=True, default='')  # pandas query expression over the original column names, e.g. status == 'active'
     #column_names = models.CharField(max_length=4000, null=True, blank=True) #Should change this to textfield 
     import_enabled = models.BooleanField(default=True)  # New field
     #transform_script = models.TextField(blank=True, null=True)  # New field
@@ -63,6 +65,10 @@ class Script(models.Model):
 
 
 class Table(models.Model):
+    SNAPSHOT_FORMAT_CHOICES = [
+        ('table', 'Table'),
+        ('parquet', 'Parquet'),
+    ]
     script = models.ForeignKey(Script, on_delete=models.CASCADE, related_name='tables')
     table_name = models.CharField(max_length=255, null=True, blank=True)
     last_import = models.DateTimeField(null=True, blank=True)
@@ -70,7 +76,14 @@ class Table(models.Model):
     row_count_prev = models.IntegerField(default=0)
     run_transform = models.BooleanField(default=False)
     transform_script = models.TextField(blank=True, null=True)
-
+    import_run = models.PositiveIntegerField(default=0)  # number of the import currently in the table
+    snapshot_retention = models.PositiveIntegerField(default=0)  # previous imports to keep, 0 keeps none
+    snapshot_format = models.CharField(max_length=10, choices=SNAPSHOT_FORMAT_CHOICES, default='table')
+    change_feed = models.BooleanField(default=False)  # record inserted, updated and deleted keys per import
+    transform_incremental = models.BooleanField(default=False)  # transform only the rows in changed_keys
+    transform_full_recompute = models.BooleanField(default=False)  # transform all rows on the next import
+    transform_full_seconds = models.FloatField(null=True, blank=True)  # duration of the last full transform
+    transform_report = models.TextField(blank=True, default='')  # steps, timings and plans of the last transform
 
     def __str__(self):
         return f"{self.script.name} - {self.table_name}"
@@ -79,6 +92,22 @@ class Table(models.Model):
         unique_together = ('script', 'table_name')
 
 
+class TableSnapshot(models.Model):
+    table = models.ForeignKey(Table, on_delete=models.CASCADE, related_name='snapshots')
+    run = models.PositiveIntegerField()
+    format = models.CharField(max_length=10, choices=Table.SNAPSHOT_FORMAT_CHOICES)
+    location = models.CharField(max_length=1024)  # table name in the itam database or Parquet file path
+    row_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.table.table_name} run {self.run}"
+
+    class Meta:
+        unique_together = ('table', 'run')
+        ordering = ['-run']
+
+
 class Column(models.Model):
     OVERRIDE_DATA_TYPE_CHOICES = [
         ('DATE', 'Date'),
@@ -93,6 +122,7 @@ class Column(models.Model):
     table_name = models.CharField(max_length=255)
     column_name = models.CharField(max_length=255)
     detected_data_type = models.CharField(max_length=255, null=True, blank=True)
+    date_format = models.CharField(max_length=50, blank=True, default='')  # strftime format or epoch unit found at import
     override_data_type = models.CharField(
         max_length=10, 
         choices=OVERRIDE_DATA_TYPE_CHOICES, 
@@ -114,6 +144,9 @@ class Column(models.Model):
         related_name='referencing_columns'
     )
     is_unique = models.BooleanField(default=False)
+    secondary_index = models.BooleanField(default=False)
+    include = models.BooleanField(default=True)  # excluded columns are never read from the data file
+    dictionary_encode = models.BooleanField(default=False)  # store as ids into a lookup table of distinct values
 
     def __str__(self):
         return f"{self.script.name} - {self.table_name}.{self.column_name}"
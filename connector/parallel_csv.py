@@ -0,0 +1,226 @@
+# parallel_csv.py
+#
+# Parallel reader for very large CSV files. The file is split into byte
+# ranges that end on a newline outside any quoted field, and each range is
+# parsed and type-converted in its own worker process. Files that cannot be
+# split safely raise UnsafeSplitError, and are read sequentially instead.
+# Like readers.py this module must not depend on Django.
+
+import io
+import re
+import csv
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from .readers import get_read_dtypes, convert_frame, read_column_names, detect_csv_encoding
+
+# Bytes of a range parsed to check that the range starts on a row
+BOUNDARY_CHECK_BYTES = 1024 * 1024
+
+
+class UnsafeSplitError(ValueError):
+    """The file's quoting does not allow splitting it into byte ranges safely."""
+
+
+def find_stray_quote(data, quotechar=b'"', delimiter=b',', start=0, in_quotes=False):
+    """
+    Return the index of a quote in data[start:] that does not delimit a
+    quoted field (like the one in 12" monitor, or 27",x), or -1. Parsers
+    take such quotes literally, so they throw quote counting off.
+
+    A quoted field opens at a field edge and closes before one, or runs
+    past the end of data. data[start - 1] is the byte before the scanned
+    part, and in_quotes tells whether the scan starts inside a quoted field.
+    """
+    quote = re.escape(quotechar)
+    edge = b'[' + re.escape(delimiter) + b'\\r\\n]'
+    # Quoted text, where quotes are doubled, up to the closing quote or the end of data
+    rest_of_field = b'[^' + quote + b']*(?:' + quote + quote + b'[^' + quote + b']*)*(?:' + quote + b'(?=' + edge + b')|' + quote + b'?\\Z)'
+    quoted_field = re.compile(b'(?<=' + edge + b')' + quote + rest_of_field)
+
+    if in_quotes:
+        match = re.compile(rest_of_field).match(data, start)
+        if match:
+            start = match.end()
+    # Scan with the byte before start as context; at the start of the file
+    # a newline stands in for it
+    text = data[start - 1:] if start else b'\n' + data
+    offset = start - 1
+
+    # Quotes left once the quoted fields are removed are stray
+    if quotechar not in quoted_field.sub(b'', text)[1:]:
+        return -1
+    for match in re.finditer(quoted_field.pattern + b'|(' + quote + b')', text):
+        if match.group(1) and match.start() > 0:
+            return offset + match.start()
+    return -1
+
+
+def find_chunk_boundaries(file_path, chunk_size, block_size=16 * 1024 * 1024, quotechar=b'"', start=0):
+    """
+    Split a CSV file into newline-aligned byte ranges of roughly chunk_size.
+
+    Quote characters are counted in a single sequential pass, so a newline is
+    only used as a boundary when it is outside a quoted field (RFC 4180
+    quoting, where embedded quotes are doubled). The first boundary is the end
+    of the header row and the last one is the file size.
+
+    A non-zero start must be a boundary returned by an earlier call (e.g. a
+    resumed import's byte offset); the scan then begins there and start is
+    the first boundary.
+
+    Raises UnsafeSplitError if a quote inside an unquoted field is found,
+    as the counted quotes then no longer tell where quoted fields are.
+    """
+    if start:
+        boundaries = [start]
+        next_target = start + chunk_size
+    else:
+        boundaries = []
+        next_target = 0  # the first boundary found is the end of the header
+    quote_count = 0
+    offset = start
+    previous_byte = b''
+    carry = b''
+
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        while True:
+            data = f.read(block_size)
+            if not data and not carry:
+                break
+            block = carry + data
+            if data:
+                # Quotes at the end of a block are scanned with the next one:
+                # they may be the first half of a doubled quote
+                carry = block[len(block.rstrip(quotechar)):]
+                block = block[:len(block) - len(carry)]
+                if not block:
+                    continue
+            else:
+                carry = b''
+            block_end = offset + len(block)
+            counted_to = 0
+
+            # The byte before the block tells whether a quote at its start opens a field
+            stray_quote = find_stray_quote(previous_byte + block, quotechar, start=len(previous_byte), in_quotes=quote_count % 2 == 1)
+            if stray_quote != -1:
+                raise UnsafeSplitError(f"Quote inside an unquoted field at byte {offset - len(previous_byte) + stray_quote} of {file_path}")
+            previous_byte = block[-1:]
+
+            while next_target < block_end:
+                newline = block.find(b'\n', max(next_target - offset, counted_to))
+                if newline == -1:
+                    break
+                quote_count += block.count(quotechar, counted_to, newline)
+                counted_to = newline
+                if quote_count % 2 == 0:
+                    boundaries.append(offset + newline + 1)
+                    next_target = offset + newline + 1 + chunk_size
+                else:
+                    # Newline inside a quoted field, keep looking after it
+                    next_target = offset + newline + 1
+
+            quote_count += block.count(quotechar, counted_to)
+            offset = block_end
+
+    if not boundaries:
+        raise ValueError(f"No complete header row found in {file_path}")
+    if boundaries[-1] < offset:
+        boundaries.append(offset)
+    return boundaries
+
+
+def check_chunk_boundaries(file_path, boundaries, field_count, encoding):
+    """
+    Raise UnsafeSplitError unless the first row of every range parses to
+    field_count fields. A range that starts inside a quoted field does not.
+    """
+    with open(file_path, 'rb') as f:
+        for start, end in zip(boundaries, boundaries[1:]):
+            f.seek(start)
+            text = f.read(min(end - start, BOUNDARY_CHECK_BYTES)).decode(encoding, errors='replace')
+            try:
+                first_row = next((row for row in csv.reader(io.StringIO(text, newline='')) if row), None)
+            except csv.Error:
+                first_row = None
+            if first_row is None or len(first_row) != field_count:
+                raise UnsafeSplitError(f"Byte range at {start} of {file_path} does not start with a row of {field_count} fields")
+
+
+def split_csv_file(file_path, chunk_size, start=0):
+    """
+    Return the checked boundaries of the byte ranges a CSV file is read in,
+    see find_chunk_boundaries. Raises UnsafeSplitError when the file must be
+    read sequentially.
+    """
+    boundaries = find_chunk_boundaries(file_path, chunk_size, start=start)
+    check_chunk_boundaries(file_path, boundaries, len(read_column_names(file_path)), detect_csv_encoding(file_path))
+    return boundaries
+
+
+def parse_csv_range(file_path, start, end, original_column_names, inferred_types, column_mapping, date_formats=None, row_filter=None, header=None, encoding='utf-8-sig'):
+    """
+    Parse the rows in bytes [start, end) of a CSV file and convert them to the
+    inferred column types. header is the file's full header row; only the
+    columns in original_column_names are materialized. encoding is the one
+    detect_csv_encoding returns for the file, as for the sequential readers.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    dtype_dict = get_read_dtypes(inferred_types)
+    df = pd.read_csv(
+        io.BytesIO(data),
+        header=None,
+        names=header or original_column_names,
+        usecols=original_column_names,
+        dtype=dtype_dict,
+        keep_default_na=False,
+        na_values=[''],
+        encoding=encoding,
+    )
+    return convert_frame(df, original_column_names, inferred_types, column_mapping, date_formats, row_filter)
+
+
+def iter_csv_batches(file_path, boundaries, original_column_names, inferred_types, column_mapping, max_workers, date_formats=None, row_filter=None):
+    """
+    Yield the converted DataFrame of each byte range between boundaries
+    (see split_csv_file) in file order. At most 2 * max_workers ranges are
+    in flight, so memory stays bounded when the loader is slower than the
+    parsers. Each batch's attrs['byte_offset'] is the end of its range,
+    where a resumed import continues.
+
+    Raises UnsafeSplitError if a range fails to parse: the file's quoting
+    then misled the split, and the file has to be read sequentially.
+    """
+    header = read_column_names(file_path)
+    encoding = detect_csv_encoding(file_path)
+    ranges = list(zip(boundaries, boundaries[1:]))
+
+    def result(pending_range):
+        start, end, future = pending_range
+        try:
+            batch = future.result()
+        except ValueError as e:
+            # pandas' ParserError is a ValueError, as are conversion errors
+            # of fields split in the wrong place
+            raise UnsafeSplitError(f"Byte range {start}-{end} of {file_path} failed to parse: {str(e)}") from e
+        batch.attrs['byte_offset'] = end
+        return batch
+
+    executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+    try:
+        pending = deque()
+        for start, end in ranges:
+            pending.append((start, end, executor.submit(
+                parse_csv_range, file_path, start, end, original_column_names, inferred_types, column_mapping, date_formats, row_filter, header, encoding
+            )))
+            if len(pending) >= max_workers * 2:
+                yield result(pending.popleft())
+        while pending:
+            yield result(pending.popleft())
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,132 @@
+# profiler.py
+#
+# Column statistics for profile-only import runs. The profile is built from
+# the same converted batches the loader would insert, one batch at a time.
+# Like readers.py this module must not depend on Django.
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def is_text_type(data_type):
+    return data_type.startswith('VARCHAR') or data_type.endswith('TEXT')
+
+
+def find_key_candidates(df_sample, column_mapping, primary_key_columns=None):
+    """
+    Return the column sets worth checking for uniqueness over the full data:
+    the declared primary key and every single column that has no NULLs and no
+    duplicates in the sample. Names are final (override-applied) names.
+    """
+    candidates = []
+    if primary_key_columns:
+        candidates.append(tuple(primary_key_columns))
+
+    for orig_col, final_col in column_mapping.items():
+        series = df_sample[orig_col]
+        if series.empty or series.isna().any() or not series.is_unique:
+            continue
+        if (final_col,) not in candidates:
+            candidates.append((final_col,))
+    return candidates
+
+
+class DataProfile:
+    """Streaming column statistics and key uniqueness checks over import batches."""
+
+    def __init__(self, column_mapping, inferred_types, date_formats, key_candidates):
+        self.rows = 0
+        self.batches = 0
+        self.columns = {
+            final_col: {
+                'data_type': inferred_types[orig_col],
+                'date_format': date_formats.get(orig_col, ''),
+                'nulls': 0,
+                'min': None,
+                'max': None,
+                'max_length': 0,
+            }
+            for orig_col, final_col in column_mapping.items()
+        }
+        # Row hashes of each key candidate seen so far; a candidate is dropped
+        # as soon as it has a NULL or a duplicate
+        self.key_hashes = {key: [] for key in key_candidates}
+        self.rejected_keys = {}
+
+    def update(self, batch):
+        self.rows += len(batch)
+        self.batches += 1
+
+        for name, stats in self.columns.items():
+            series = batch[name]
+            stats['nulls'] += int(series.isna().sum())
+            values = series.dropna()
+            if values.empty:
+                continue
+            if is_text_type(stats['data_type']):
+                stats['max_length'] = max(stats['max_length'], int(values.astype(str).str.len().max()))
+            else:
+                low, high = values.min(), values.max()
+                stats['min'] = low if stats['min'] is None else min(stats['min'], low)
+                stats['max'] = high if stats['max'] is None else max(stats['max'], high)
+
+        for key in list(self.key_hashes):
+            frame = batch[list(key)]
+            if frame.isna().any(axis=None):
+                self.reject_key(key, 'NULL values')
+                continue
+            hashes = pd.util.hash_pandas_object(frame, index=False).to_numpy()
+            if len(np.unique(hashes)) < len(hashes):
+                self.reject_key(key, 'duplicate values')
+                continue
+            self.key_hashes[key].append(hashes)
+
+    def reject_key(self, key, reason):
+        del self.key_hashes[key]
+        self.rejected_keys[key] = reason
+
+    def unique_keys(self):
+        for key, parts in list(self.key_hashes.items()):
+            hashes = np.concatenate(parts) if parts else np.array([], dtype=np.uint64)
+            if len(np.unique(hashes)) < len(hashes):
+                self.reject_key(key, 'duplicate values')
+        return list(self.key_hashes)
+
+    def report(self, table_name, file_paths, create_table_sql, read_seconds, load_rows_per_second):
+        unique_keys = self.unique_keys()
+        load_seconds = self.rows / load_rows_per_second if load_rows_per_second else 0
+
+        lines = [
+            f"Profile of {table_name}: {self.rows} rows, {len(self.columns)} columns "
+            f"from {', '.join(os.path.basename(f) for f in file_paths)}",
+            f"Read and convert time: {read_seconds:.1f}s ({self.batches} batches)",
+            f"Estimated load time: {load_seconds:.1f}s at {load_rows_per_second} rows/s",
+            "",
+            "Proposed DDL:",
+            create_table_sql,
+            "",
+            "Columns:",
+        ]
+
+        for name, stats in self.columns.items():
+            null_pct = 100.0 * stats['nulls'] / self.rows if self.rows else 0.0
+            data_type = stats['data_type']
+            if stats['date_format']:
+                data_type += f" ({stats['date_format']})"
+            if is_text_type(stats['data_type']):
+                detail = f"max length {stats['max_length']}"
+            else:
+                detail = f"min {stats['min']}, max {stats['max']}"
+            lines.append(f"  {name}: {data_type}, {null_pct:.1f}% NULL, {detail}")
+
+        lines.append("")
+        lines.append("Primary key candidates:")
+        if unique_keys:
+            lines.extend(f"  ({', '.join(key)})" for key in unique_keys)
+        else:
+            lines.append("  none")
+        for key, reason in self.rejected_keys.items():
+            lines.append(f"  ({', '.join(key)}) rejected: {reason}")
+
+        return "\n".join(lines)
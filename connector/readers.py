@@ -0,0 +1,542 @@
+# readers.py
+#
+# File reading and type inference for the import pipeline. Nothing in here may
+# depend on Django: these functions also run inside import worker processes.
+
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import re
+import pandas as pd
+
+try:
+    from pandas.tseries.api import guess_datetime_format
+except ImportError:  # pandas < 2.2
+    from pandas._libs.tslibs.parsing import guess_datetime_format
+
+
+DATA_FILE_FORMATS = ('.xlsx', '.csv', '.json', '.ndjson')
+
+# Common date and datetime formats to try
+DATE_FORMATS = [
+    '%Y-%m-%d', '%d/%m/%Y', '%m/%d/%Y',
+    '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S',
+    '%d/%m/%Y %H:%M:%S', '%m/%d/%Y %H:%M:%S',
+]
+
+EPOCH_UNITS = {
+    'epoch:s': 's',
+    'epoch:ms': 'ms',
+}
+
+# Ranges of numeric values taken as epoch timestamps of each unit, told apart
+# by magnitude: seconds up to 2070, milliseconds from 1973 (1e11 ms) to 2070
+EPOCH_RANGES = {
+    'epoch:s': (0, 3155760000),
+    'epoch:ms': (1e11, 3155760000000),
+}
+
+# Share of values a stored date format may fail to parse before the column's
+# format is detected again
+DATE_PARSE_FAILURE_THRESHOLD = 0.01
+
+# Encodings tried for CSV files, in order; latin-1 decodes any bytes
+CSV_ENCODINGS = ['utf-8-sig', 'utf-8', 'latin-1']
+
+# A JSON decode error further than this from the end of the read buffer
+# cannot come from a record cut off by the read (the longest partial token,
+# e.g. a \uXXXX escape or a literal, is shorter), so the file is invalid
+JSON_TRUNCATION_MARGIN = 16
+
+# Compressed inputs are decompressed on the fly, never to disk
+COMPRESSION_EXTENSIONS = {
+    '.gz': 'gzip',
+    '.zst': 'zstd',
+}
+
+
+def get_file_format(file_path):
+    """
+    Return (format, compression) for a data file, e.g. ('.csv', 'gzip') for
+    devices.csv.gz or ('.json', None) for devices.json.
+    """
+    name = os.path.basename(file_path).lower()
+    compression = None
+    for extension, codec in COMPRESSION_EXTENSIONS.items():
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+            compression = codec
+            break
+    return os.path.splitext(name)[1], compression
+
+def is_data_file(file_path):
+    file_format, compression = get_file_format(file_path)
+    if file_format == '.xlsx':
+        # xlsx is already a zip archive
+        return compression is None
+    return file_format in DATA_FILE_FORMATS
+
+def open_data_file(file_path, encoding, newline=None):
+    """Open a data file for reading text, decompressing it as a stream."""
+    file_format, compression = get_file_format(file_path)
+    if compression == 'gzip':
+        return gzip.open(file_path, 'rt', encoding=encoding, newline=newline)
+    if compression == 'zstd':
+        import zstandard
+        stream = zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+        return io.TextIOWrapper(stream, encoding=encoding, newline=newline)
+    return open(file_path, 'r', encoding=encoding, newline=newline)
+
+
+def detect_csv_encoding(file_path, sample_size=1024 * 1024):
+    """
+    Return the first of CSV_ENCODINGS that decodes the start of a CSV file.
+    Every CSV reader uses it, so a file decodes the same whichever reader
+    the import chooses.
+    """
+    for encoding in CSV_ENCODINGS:
+        try:
+            with open_data_file(file_path, encoding, newline='') as f:
+                f.read(sample_size)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"Unable to read CSV file with any of the attempted encodings: {CSV_ENCODINGS}")
+
+
+def iter_json_records(file_path, read_size=1024 * 1024):
+    """
+    Yield the records of an NDJSON file or a top-level JSON array one at a
+    time, without loading the whole document.
+    """
+    file_format, compression = get_file_format(file_path)
+
+    with open_data_file(file_path, 'utf-8-sig') as f:
+        if file_format == '.ndjson':
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+            return
+
+        buffer = f.read(read_size).lstrip()
+        if not buffer.startswith('['):
+            # Not a list of records (e.g. column-oriented); fall back to pandas
+            # reading the whole document
+            yield from pd.read_json(file_path, dtype=str, encoding='utf-8-sig').to_dict('records')
+            return
+
+        decoder = json.JSONDecoder()
+        separator = re.compile(r'[\s,]*')
+        pos = 1
+        eof = False
+        while True:
+            pos = separator.match(buffer, pos).end()
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of JSON array in {file_path}")
+                chunk = f.read(read_size)
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+            if buffer[pos] == ']':
+                return
+
+            try:
+                record, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # An unterminated string runs to the end of the buffer
+                truncated = e.pos >= len(buffer) - JSON_TRUNCATION_MARGIN or e.msg.startswith('Unterminated string')
+                if eof or not truncated:
+                    raise ValueError(f"Invalid JSON record in {file_path}: {e}")
+                end = None
+            if end is None or (end == len(buffer) and not eof):
+                # Record continues past the buffer, read more and retry
+                chunk = f.read(read_size)
+                if not chunk and end is None:
+                    raise ValueError(f"Invalid or truncated JSON record in {file_path}")
+                eof = not chunk
+                buffer, pos = buffer[pos:] + chunk, 0
+                continue
+
+            yield record
+            pos = end
+
+def json_value_to_str(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+def json_records_to_frame(records):
+    """
+    Flatten a list of JSON records into a DataFrame of strings. Nested objects
+    become dotted column names (e.g. "os.version"), arrays are kept as JSON.
+    """
+    df = pd.json_normalize(records, sep='.')
+    return df.apply(lambda col: col.map(json_value_to_str, na_action='ignore')).astype(object)
+
+def iter_json_frames(file_path, batch_size, nrows=None, skip=0):
+    records = iter_json_records(file_path)
+    if skip:
+        records = itertools.islice(records, skip, None)
+    if nrows is not None:
+        records = itertools.islice(records, nrows)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        yield json_records_to_frame(batch)
+
+
+def read_column_names(file_path):
+    file_format, compression = get_file_format(file_path)
+
+    if file_format == '.csv':
+        with open_data_file(file_path, detect_csv_encoding(file_path), newline='') as f:
+            return next(csv.reader(f))
+    
+    elif file_format == '.xlsx':
+        try:
+            df = pd.read_excel(file_path, nrows=0)
+            return df.columns.tolist()
+        except Exception as e:
+            raise ValueError(f"Error reading Excel file header: {str(e)}")
+    
+    elif file_format in ('.json', '.ndjson'):
+        try:
+            # Nested records can have sparse keys, so take the union over
+            # the first records rather than just the first one
+            records = list(itertools.islice(iter_json_records(file_path), 10000))
+            return json_records_to_frame(records).columns.tolist()
+        except Exception as e:
+            raise ValueError(f"Error reading JSON file structure: {str(e)}")
+    
+    else:
+        raise ValueError(f"Unsupported file type: {file_path}")
+
+
+def read_sample_data(file_path, nrows=500000, usecols=None):
+    file_format, compression = get_file_format(file_path)
+
+    if file_format == '.csv':
+        return pd.read_csv(file_path, nrows=nrows, dtype=str, encoding=detect_csv_encoding(file_path), usecols=usecols)
+    elif file_format == '.xlsx':
+        return pd.read_excel(file_path, nrows=nrows, dtype=str, usecols=usecols)
+    elif file_format in ('.json', '.ndjson'):
+        frames = list(iter_json_frames(file_path, batch_size=50000, nrows=nrows))
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        return df.reindex(columns=usecols or read_column_names(file_path))
+    else:
+        raise ValueError("Invalid file type")
+
+def infer_column_types(df_sample, date_formats=None):
+    """
+    Infer a MariaDB type for every column of the sample. date_formats holds
+    the formats stored for known date columns; a stored format is reused as
+    long as it parses the sample, otherwise the format is detected again.
+    Returns the inferred types and the date format of every date column.
+    """
+    date_formats = date_formats or {}
+    inferred_types = {}
+    detected_formats = {}
+    for col in df_sample.columns:
+        known_format = date_formats.get(col)
+        if df_sample[col].isnull().all():
+            inferred_types[col] = 'TEXT'
+        elif known_format and date_parse_failure_rate(df_sample[col], known_format) <= DATE_PARSE_FAILURE_THRESHOLD:
+            detected_formats[col] = known_format
+            inferred_types[col] = determine_date_type(df_sample[col], known_format)
+        elif is_likely_integer(df_sample[col]):
+            inferred_types[col] = determine_integer_type(df_sample[col])
+        elif is_likely_float(df_sample[col]):
+            inferred_types[col] = 'DOUBLE'
+        else:
+            date_format = detect_date_format(df_sample[col])
+            if date_format is not None:
+                detected_formats[col] = date_format
+                inferred_types[col] = determine_date_type(df_sample[col], date_format)
+            else:
+                inferred_types[col] = determine_string_type(df_sample[col])
+    return inferred_types, detected_formats
+
+def is_likely_integer(series):
+    # Remove any completely empty entries
+    series = series.dropna()
+    
+    if series.empty:
+        return False
+
+    try:
+        # Try to convert to numeric
+        numeric_series = pd.to_numeric(series, errors='raise')
+        
+        # Check if all values are integers
+        is_integer = numeric_series.apply(lambda x: x.is_integer()).all()
+        
+        # Check if all values are within the INT range
+        in_range = ((numeric_series >= -2147483648) & (numeric_series <= 2147483647)).all()
+        
+        return is_integer and in_range
+    except ValueError:
+        # If conversion to numeric fails, it's not an integer column
+        return False
+
+def is_likely_float(series):
+    try:
+        # Remove any completely empty entries
+        series = series.dropna()
+        
+        if series.empty:
+            return False
+        
+        # Check for dashes in any non-null value
+        if series.astype(str).str.contains('-', regex=False).any():
+            return False
+        
+        float_series = pd.to_numeric(series, errors='coerce')
+        
+        # Check if all non-null values can be converted to float
+        all_float = not float_series.isnull().any()
+        
+        # Check if there are any alphabetic characters
+        no_alpha = not series.astype(str).str.contains(r'[a-zA-Z]').any()
+        
+        # Check if it's not an integer series
+        not_integer = not is_likely_integer(series)
+        
+        return all_float and no_alpha and not_integer
+    except:
+        return False
+
+def parse_dates(series, date_format):
+    """
+    Parse a series of date strings in one vectorized call. date_format is a
+    strftime format, an epoch unit ('epoch:s' or 'epoch:ms') or 'mixed' for
+    values that only parse one by one.
+    """
+    if date_format in EPOCH_UNITS:
+        return pd.to_datetime(pd.to_numeric(series, errors='coerce'), unit=EPOCH_UNITS[date_format], errors='coerce')
+    return pd.to_datetime(series, format=date_format, errors='coerce')
+
+def date_parse_failure_rate(series, date_format):
+    series = series.dropna()
+    if series.empty:
+        return 0.0
+    return parse_dates(series, date_format).isna().mean()
+
+def detect_date_format(series):
+    """
+    Return the date format that parses the column, or None if the column
+    does not hold dates.
+    """
+    # Remove any completely empty entries
+    series = series.dropna()
+    
+    if series.empty:
+        return None
+
+    # Sample the series to reduce processing time
+    sample_size = min(1000, len(series))
+    sample = series.sample(n=sample_size) if len(series) > sample_size else series
+
+    # Try parsing with specific formats first
+    for date_format in DATE_FORMATS:
+        if parse_dates(sample, date_format).notna().all():
+            return date_format
+
+    # If specific formats fail, use a more flexible approach on a smaller sample
+    small_sample = sample.head(100)
+
+    # Numeric values in the range of epoch seconds or milliseconds
+    numeric = pd.to_numeric(small_sample, errors='coerce')
+    for date_format, (low, high) in EPOCH_RANGES.items():
+        if numeric.between(low, high).mean() >= 0.9:
+            return date_format
+
+    # Let pandas guess the format from the first value and check it on the rest
+    guessed_format = guess_datetime_format(str(small_sample.iloc[0]))
+    if guessed_format and parse_dates(small_sample, guessed_format).notna().mean() >= 0.9:
+        return guessed_format
+
+    # Check if at least 90% of the small sample are valid dates
+    if parse_dates(small_sample, 'mixed').notna().mean() >= 0.9:
+        return 'mixed'
+
+    return None
+
+def determine_date_type(series, date_format):
+    # Determine if it's a DATETIME or DATE
+    sample = series.dropna().head(100)  # Sample for performance
+    if parse_dates(sample, date_format).dt.time.ne(pd.Timestamp('00:00:00').time()).any():
+        return 'DATETIME'
+    return 'DATE'
+
+def is_date_only(series):
+    # Remove any completely empty entries
+    series = series.dropna()
+    
+    if series.empty:
+        return False
+
+    try:
+        date_series = pd.to_datetime(series, errors='coerce')
+        return date_series.notna().any() and (date_series.dt.time == pd.Timestamp('00:00:00').time()).all()
+    except:
+        return False
+
+def determine_integer_type(series):
+    series = pd.to_numeric(series, errors='coerce')
+    non_null = series.dropna()
+    min_val, max_val = non_null.min(), non_null.max()
+    if min_val >= -2147483648 and max_val <= 2147483647:
+        return 'INT'
+    else:
+        return 'BIGINT'
+
+def determine_string_type(series):
+    max_length = series.str.len().max()
+    if max_length <= 255:
+        return f'VARCHAR({255})'
+    elif max_length <= 65535:
+        return 'TEXT'
+    elif max_length <= 16777215:
+        return 'MEDIUMTEXT'
+    else:
+        return 'LONGTEXT'
+
+def get_read_dtypes(inferred_types):
+    dtype_dict = {}
+    for col, dtype in inferred_types.items():
+        if dtype in ['TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'BIGINT']:
+            dtype_dict[col] = 'Int64'  # Use pandas nullable integer type
+        elif dtype == 'DOUBLE':
+            dtype_dict[col] = 'float64'
+        else:
+            dtype_dict[col] = 'object'
+
+    return dtype_dict
+
+def read_full_data(file_path, original_column_names, inferred_types):
+    """
+    Read the columns in original_column_names from a data file. Any other
+    columns in the file are skipped by the parser and never materialized.
+    """
+    dtype_dict = get_read_dtypes(inferred_types)
+    file_format, compression = get_file_format(file_path)
+    
+    if file_format == '.csv':
+        return pd.read_csv(file_path, dtype=dtype_dict, keep_default_na=False, na_values=[''], encoding=detect_csv_encoding(file_path), usecols=original_column_names)
+    elif file_format == '.xlsx':
+        return pd.read_excel(file_path, dtype=dtype_dict, keep_default_na=False, na_values=[''], usecols=original_column_names)
+    elif file_format in ('.json', '.ndjson'):
+        # Values stay strings here, convert_column_type does the conversion
+        frames = [frame.reindex(columns=original_column_names) for frame in iter_json_frames(file_path, batch_size=50000)]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=original_column_names)
+    else:
+        raise ValueError("Unsupported file type")
+
+def iter_data_batches(file_path, original_column_names, inferred_types, column_mapping, chunksize, date_formats=None, row_filter=None, skip_chunks=0):
+    """
+    Yield converted DataFrames of up to chunksize rows from a CSV, NDJSON or
+    JSON array file. Compressed files are decompressed as they are read.
+    Batches may be smaller than chunksize when a row filter is set. The first
+    skip_chunks chunks are skipped without being converted, to resume an
+    import.
+    """
+    dtype_dict = get_read_dtypes(inferred_types)
+    file_format, compression = get_file_format(file_path)
+
+    if file_format in ('.json', '.ndjson'):
+        for frame in iter_json_frames(file_path, batch_size=chunksize, skip=skip_chunks * chunksize):
+            frame = frame.reindex(columns=original_column_names)
+            yield convert_frame(frame, original_column_names, inferred_types, column_mapping, date_formats, row_filter)
+        return
+
+    if file_format != '.csv':
+        raise ValueError(f"Chunked reading is not supported for {file_path}")
+
+    # Rows already loaded are skipped by a callable: pandas turns a range of
+    # row numbers into a set, and buffers rows skipped by count, so both grow
+    # with the rows skipped
+    skip_rows = skip_chunks * chunksize
+    skiprows = (lambda row: 0 < row <= skip_rows) if skip_chunks else None
+    reader = pd.read_csv(file_path, dtype=dtype_dict, keep_default_na=False, na_values=[''], encoding=detect_csv_encoding(file_path), usecols=original_column_names, skiprows=skiprows, chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            yield convert_frame(chunk, original_column_names, inferred_types, column_mapping, date_formats, row_filter)
+
+def convert_column_type(series, dtype, date_format=None):
+    if dtype in ['TINYINT', 'SMALLINT', 'MEDIUMINT', 'INT', 'BIGINT']:
+        return pd.to_numeric(series, errors='coerce').astype('Int64')
+    elif dtype == 'DOUBLE':
+        return pd.to_numeric(series, errors='coerce')
+    elif dtype in ['DATE', 'DATETIME']:
+        if pd.api.types.is_datetime64_any_dtype(series):
+            return series
+        return parse_dates(series, date_format or 'mixed')
+    else:
+        return series
+
+def read_and_convert_file(file_path, original_column_names, inferred_types, column_mapping, date_formats=None, row_filter=None):
+    """
+    Read a complete data file, apply the final column names and convert every
+    column to its inferred type. Used as the import worker entry point.
+    """
+    df = read_full_data(file_path, original_column_names, inferred_types)
+    return convert_frame(df, original_column_names, inferred_types, column_mapping, date_formats, row_filter)
+
+def get_filter_columns(row_filter, column_names):
+    """
+    Return the columns a row filter refers to, either by bare name or quoted
+    in backticks for names that are not valid identifiers.
+    """
+    return [
+        col for col in column_names
+        if f'`{col}`' in row_filter or re.search(rf'(?<![\w`]){re.escape(col)}(?![\w`])', row_filter)
+    ]
+
+def apply_row_filter(df, row_filter, inferred_types, date_formats=None):
+    """
+    Keep the rows matching row_filter, a pandas query expression over the
+    original column names, e.g. "status == 'active' and cost > 100". Only the
+    columns the filter refers to are converted to evaluate it; the rest of
+    the batch is converted after the other rows are dropped.
+    """
+    date_formats = date_formats or {}
+    filter_columns = get_filter_columns(row_filter, df.columns)
+    typed = pd.DataFrame(
+        {col: convert_column_type(df[col], inferred_types[col], date_formats.get(col)) for col in filter_columns},
+        index=df.index,
+    )
+    mask = typed.eval(row_filter, engine='python')
+    if not isinstance(mask, pd.Series):
+        raise ValueError(f"Row filter is not a condition on the data columns: {row_filter}")
+    return df.loc[mask.fillna(False).astype(bool)].reset_index(drop=True)
+
+def convert_frame(df, original_column_names, inferred_types, column_mapping, date_formats=None, row_filter=None):
+    """
+    Drop the rows not matching row_filter, keep the columns in column_mapping
+    (other columns may only have been read for the filter), apply the final
+    column names and convert every column to its inferred type.
+    """
+    date_formats = date_formats or {}
+    df.columns = original_column_names
+
+    if row_filter:
+        df = apply_row_filter(df, row_filter, inferred_types, date_formats)
+
+    filter_only_columns = [col for col in original_column_names if col not in column_mapping]
+    if filter_only_columns:
+        df = df.drop(columns=filter_only_columns)
+
+    # Rename columns in the full DataFrame using the mapping
+    df.rename(columns=column_mapping, inplace=True)
+
+    # Convert columns to appropriate types after reading
+    for orig_col, final_col in column_mapping.items():
+        df[final_col] = convert_column_type(df[final_col], inferred_types[orig_col], date_formats.get(orig_col))
+
+    return df
@@ -0,0 +1,155 @@
+# snapshots.py
+#
+# Previous generations of imported tables. Before an import replaces a table
+# with a snapshot retention, the table's current contents are kept as run
+# Table.import_run, either as a renamed table in the itam database or as a
+# zstd-compressed Parquet file under CONNECTOR_SNAPSHOT_DIR. SQL reports query
+# a table format snapshot as table@run.
+
+import os
+import re
+import logging
+from django.conf import settings
+from .models import Table, TableSnapshot
+from .transforms import tokenize_sql
+from .writers import open_query_stream, write_arrow
+
+logger = logging.getLogger(__name__)
+
+# A run of an imported table in report SQL: devices@41, or `devices`@41 where
+# the backtick quoted name is a separate token
+RUN_REFERENCE = re.compile(r'(?<![\w$.@])([A-Za-z_][\w$]*)@(\d+)(?![\w$])')
+RUN_SUFFIX = re.compile(r'@(\d+)(?![\w$])')
+# What is left of a run reference that was not resolved, e.g. itam.devices@41
+UNRESOLVED_RUN = re.compile(r'[\w$`]@\d+(?![\w$])')
+
+
+def get_snapshot_table_name(table_name, run):
+    # Internal name, so the report schema mapper skips it
+    return f'_snap{run}_{table_name}'[:64]
+
+
+def get_snapshot_file_path(table_name, run):
+    return os.path.join(settings.CONNECTOR_SNAPSHOT_DIR, table_name, f'run_{run}.parquet')
+
+
+def write_parquet_snapshot(table_name, file_path):
+    """
+    Stream a table into a Parquet file with a server-side cursor, so the
+    table is never held in memory. Column types come from the table's
+    column definitions, as for report exports. Returns the number of rows
+    written.
+    """
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    columns, batches, fields = open_query_stream(f'SELECT * FROM `{table_name}`')
+    try:
+        rows_written = write_arrow('parquet', columns, fields, batches, file_path, compression='zstd')
+    finally:
+        # Closes the cursor if writing stopped before the last batch
+        batches.close()
+
+    logger.info(f"Wrote {rows_written} rows of {table_name} to {file_path}")
+    return rows_written
+
+
+def take_snapshot(cursor, table, table_type):
+    """
+    Keep the current contents of an imported table before an import replaces
+    them. table_type is the live table's type ('BASE TABLE' or 'VIEW').
+
+    Returns (keep_as, snapshot). A base table kept in table format is renamed
+    by the import's swap, so keep_as is the name the swap should rename it
+    to; otherwise the snapshot has already been written and keep_as is None.
+    The unsaved TableSnapshot is to be saved once the swap has succeeded.
+    """
+    run = table.import_run
+    if table.snapshot_format == 'parquet':
+        file_path = get_snapshot_file_path(table.table_name, run)
+        row_count = write_parquet_snapshot(table.table_name, file_path)
+        return None, TableSnapshot(table=table, run=run, format='parquet', location=file_path, row_count=row_count)
+
+    snapshot_table = get_snapshot_table_name(table.table_name, run)
+    cursor.execute(f'DROP TABLE IF EXISTS `{snapshot_table}`')
+    keep_as = snapshot_table
+    if table_type == 'VIEW':
+        # The view of a dictionary encoded table depends on tables the import
+        # replaces, so its contents are copied instead
+        cursor.execute(f'CREATE TABLE `{snapshot_table}` AS SELECT * FROM `{table.table_name}`')
+        keep_as = None
+    return keep_as, TableSnapshot(table=table, run=run, format='table', location=snapshot_table, row_count=table.row_count)
+
+
+def save_snapshot(snapshot):
+    TableSnapshot.objects.update_or_create(
+        table=snapshot.table,
+        run=snapshot.run,
+        defaults={'format': snapshot.format, 'location': snapshot.location, 'row_count': snapshot.row_count},
+    )
+    logger.info(f"Kept run {snapshot.run} of {snapshot.table.table_name} at {snapshot.location}")
+
+
+def delete_snapshot(cursor, snapshot):
+    if snapshot.format == 'table':
+        cursor.execute(f'DROP TABLE IF EXISTS `{snapshot.location}`')
+    elif os.path.exists(snapshot.location):
+        os.remove(snapshot.location)
+    snapshot.delete()
+
+
+def apply_snapshot_retention(cursor, table):
+    """Delete the snapshots beyond the table's snapshot_retention most recent ones."""
+    for snapshot in table.snapshots.order_by('-run')[table.snapshot_retention:]:
+        logger.info(f"Deleting run {snapshot.run} of {table.table_name} at {snapshot.location}")
+        delete_snapshot(cursor, snapshot)
+
+
+def get_table_as_of(table, run):
+    """
+    Return the name of the itam table holding run `run` of an imported table,
+    for use in SQL. Only the current run and table format snapshots can be
+    queried directly.
+    """
+    if run == table.import_run:
+        return table.table_name
+
+    snapshot = table.snapshots.filter(run=run).first()
+    if snapshot is None:
+        raise ValueError(f"No snapshot of {table.table_name} for run {run}")
+    if snapshot.format != 'table':
+        raise ValueError(
+            f"Run {run} of {table.table_name} is archived as a {snapshot.get_format_display()} file at {snapshot.location}; "
+            f"only snapshots kept in table format can be queried as {table.table_name}@{run}"
+        )
+    return snapshot.location
+
+
+def get_run_table(table_name, run):
+    table = Table.objects.filter(table_name=table_name).first()
+    if table is None:
+        raise ValueError(f"{table_name}@{run} does not refer to an imported table")
+    return get_table_as_of(table, int(run))
+
+
+def resolve_table_runs(sql):
+    """
+    Replace references to a run of an imported table, written table@run
+    (e.g. devices@41 or `devices`@41), with the table holding that run, so
+    a query can compare a table with an earlier import of it. Literals and
+    comments are left alone. Raises ValueError for a run that cannot be
+    queried, e.g. one archived as Parquet, and for a reference qualified
+    with a database name.
+    """
+    parts = []
+    for kind, text in tokenize_sql(sql):
+        if kind == 'code':
+            match = RUN_SUFFIX.match(text)
+            quoted = parts and parts[-1][0] == '`' and not (len(parts) > 1 and parts[-2].endswith('.'))
+            if match and quoted:
+                parts[-1] = f'`{get_run_table(parts[-1][1:-1], match.group(1))}`'
+                text = text[match.end():]
+            text = RUN_REFERENCE.sub(lambda m: f'`{get_run_table(m.group(1), m.group(2))}`', text)
+            unresolved = UNRESOLVED_RUN.search(text) or (RUN_SUFFIX.match(text) and parts and parts[-1][0] == '`')
+            if unresolved:
+                raise ValueError("A run of an imported table is written table@run, without a database name")
+        parts.append(text)
+    return ''.join(parts)
@@ -1,3 +1,470 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import tracemalloc
+from unittest import mock
+import numpy as np
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, override_settings
 
-# Create your tests here.
+from .readers import iter_data_batches, iter_json_records
+from .job_execution import execute_sql_import, fingerprint_files, fingerprint_plan, find_resumable_files, read_import_batches, check_streamed_primary_key, get_unique_columns
+from .models import Job, Script, Table, TableSnapshot
+from .snapshots import resolve_table_runs
+from .change_feed import record_changes
+from .transforms import tokenize_sql, split_sql_statements, point_sql_at_table, split_transform_steps, prepare_changed_keys, get_row_hash_signature
+from .parallel_csv import find_chunk_boundaries, check_chunk_boundaries, split_csv_file, iter_csv_batches, UnsafeSplitError
+
+
+class TempFileTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_file(self, name, data):
+        file_path = os.path.join(self.directory, name)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+
+class ChunkBoundaryTests(TempFileTestCase):
+    def test_boundaries_at_every_row(self):
+        data = b'id,name\n1,a\n2,b\n3,c\n'
+        file_path = self.write_file('rows.csv', data)
+        # Every newline is a boundary with a chunk size of one byte
+        self.assertEqual(find_chunk_boundaries(file_path, 1), [8, 12, 16, 20])
+
+    def test_newlines_in_quoted_fields_are_skipped(self):
+        data = b'id,note\n1,"line one\nline two"\n2,"say ""hi""\n again"\n3,plain\n'
+        file_path = self.write_file('quoted.csv', data)
+        boundaries = find_chunk_boundaries(file_path, 1)
+        row_starts = [data.index(row) for row in (b'1,', b'2,', b'3,')]
+        self.assertEqual(boundaries, row_starts + [len(data)])
+        check_chunk_boundaries(file_path, boundaries, 2, 'utf-8')
+
+    def test_small_blocks(self):
+        # Quotes are counted across block edges
+        data = b'id,note\n1,"a\nb"\n2,"c\n"\n3,d\n'
+        file_path = self.write_file('blocks.csv', data)
+        self.assertEqual(find_chunk_boundaries(file_path, 1, block_size=3), find_chunk_boundaries(file_path, 1))
+
+    def test_start_at_earlier_boundary(self):
+        data = b'id,note\n1,"a\nb"\n2,c\n3,d\n'
+        file_path = self.write_file('resume.csv', data)
+        boundaries = find_chunk_boundaries(file_path, 1)
+        self.assertEqual(find_chunk_boundaries(file_path, 1, start=boundaries[1]), boundaries[1:])
+
+    def test_stray_quote_raises(self):
+        file_path = self.write_file('stray.csv', b'id,item\n1,27" monitor\n2,"quoted"\n')
+        with self.assertRaises(UnsafeSplitError):
+            find_chunk_boundaries(file_path, 1)
+
+    def test_stray_quote_across_block_edge(self):
+        file_path = self.write_file('stray_edge.csv', b'id,item\n1,27" monitor\n')
+        with self.assertRaises(UnsafeSplitError):
+            find_chunk_boundaries(file_path, 1, block_size=12)
+
+    def test_stray_quote_before_delimiter_raises(self):
+        # The quote closing 27" would pair with the one opening the note,
+        # putting a boundary inside the quoted field
+        data = b'id,item,note\n1,27",x\n2,b,"line1\nfoo,bar,baz"\n3,c,d\n'
+        file_path = self.write_file('stray_end.csv', data)
+        with self.assertRaises(UnsafeSplitError):
+            split_csv_file(file_path, 1)
+
+    def test_doubled_quote_across_block_edge(self):
+        data = b'id,note\n' + b''.join(b'%d,"a ""q"" \nb",x\n' % i for i in range(50))
+        file_path = self.write_file('doubled.csv', data)
+        expected = find_chunk_boundaries(file_path, 1)
+        self.assertEqual(len(expected), 51)
+        for block_size in (3, 5, 7, 11, 64):
+            self.assertEqual(find_chunk_boundaries(file_path, 1, block_size=block_size), expected)
+
+    def test_range_parse_failure_raises(self):
+        data = b'id,item,note\n1,27",x\n2,b,"line1\nfoo,bar,baz"\n3,c,d\n'
+        file_path = self.write_file('misplit.csv', data)
+        columns = ['id', 'item', 'note']
+        types = {'id': 'INT', 'item': 'VARCHAR(255)', 'note': 'VARCHAR(255)'}
+        batches = iter_csv_batches(file_path, [13, 32, len(data)], columns, types, dict(zip(columns, columns)), max_workers=1)
+        with self.assertRaises(UnsafeSplitError):
+            list(batches)
+
+    def test_quoted_fields_are_not_stray(self):
+        file_path = self.write_file('edges.csv', b'id,item\n"1","27"" monitor"\r\n"2",""\r\n')
+        self.assertEqual(find_chunk_boundaries(file_path, 1)[-1], os.path.getsize(file_path))
+
+    def test_range_inside_quoted_field_fails_check(self):
+        data = b'id,note\n1,"a\nb"\n3,c\n'
+        file_path = self.write_file('inside.csv', data)
+        # A boundary after the quoted newline starts mid-field
+        boundaries = [data.index(b'1,'), data.index(b'b"'), len(data)]
+        with self.assertRaises(UnsafeSplitError):
+            check_chunk_boundaries(file_path, boundaries, 2, 'utf-8')
+
+    def test_split_latin1_file(self):
+        data = 'id,name\n1,"Müller\nGmbH"\n2,Café\n'.encode('latin-1')
+        file_path = self.write_file('latin1.csv', data)
+        self.assertEqual(split_csv_file(file_path, 1), [8, data.index(b'2,'), len(data)])
+
+
+class CheckpointTests(TempFileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file_path = self.write_file('devices.csv', b'id,name\n1,a\n2,b\n3,c\n4,d\n5,e\n')
+        self.plan = {
+            'original_column_names': ['id', 'name'],
+            'column_mapping': {'id': 'id', 'name': 'name'},
+            'row_filter': '',
+            'inferred_types': {'id': 'INT', 'name': 'VARCHAR(255)'},
+            'date_formats': {},
+            'primary_key_columns': ['id'],
+            'index_columns': [],
+            'dictionary_columns': [],
+            'table_types': {'id': 'INT', 'name': 'VARCHAR(255)'},
+            'df_sample': None,
+        }
+        self.script = mock.Mock(table_name='devices', import_enabled=True)
+
+    def find_resumable_files(self, checkpoint):
+        with mock.patch('connector.job_execution.connections'), \
+                mock.patch('connector.job_execution.get_checkpoint', return_value=checkpoint):
+            return find_resumable_files(self.script)
+
+    def checkpoint(self, **values):
+        checkpoint = {
+            'table_name': 'devices',
+            'file_paths': [self.file_path],
+            'file_fingerprint': fingerprint_files([self.file_path]),
+            'plan_fingerprint': fingerprint_plan(self.plan),
+            'chunks_loaded': 1,
+            'rows_loaded': 2,
+            'byte_offset': None,
+        }
+        checkpoint.update(values)
+        return checkpoint
+
+    def test_file_fingerprint_changes_with_contents(self):
+        fingerprint = fingerprint_files([self.file_path])
+        self.assertEqual(fingerprint_files([self.file_path]), fingerprint)
+
+        stat = os.stat(self.file_path)
+        self.write_file('devices.csv', b'id,name\n1,a\n2,b\n3,c\n4,d\n5,f\n')
+        # Same size and modification time, different bytes
+        os.utime(self.file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertNotEqual(fingerprint_files([self.file_path]), fingerprint)
+
+    def test_plan_fingerprint(self):
+        fingerprint = fingerprint_plan(self.plan)
+        self.assertEqual(fingerprint_plan(dict(self.plan, df_sample='ignored')), fingerprint)
+        self.assertNotEqual(fingerprint_plan(dict(self.plan, inferred_types={'id': 'BIGINT', 'name': 'TEXT'})), fingerprint)
+        with override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=7):
+            self.assertNotEqual(fingerprint_plan(self.plan), fingerprint)
+
+    def test_resume_unchanged_files(self):
+        self.assertEqual(self.find_resumable_files(self.checkpoint()), [self.file_path])
+
+    def test_no_resume_after_file_change(self):
+        checkpoint = self.checkpoint()
+        self.write_file('devices.csv', b'id,name\n1,a\n')
+        self.assertEqual(self.find_resumable_files(checkpoint), [])
+
+    def test_no_resume_without_loaded_chunks(self):
+        self.assertEqual(self.find_resumable_files(self.checkpoint(chunks_loaded=0)), [])
+        self.assertEqual(self.find_resumable_files(None), [])
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2, CONNECTOR_IMPORT_WORKERS=1)
+    def test_resume_skips_loaded_chunks(self):
+        batches = list(read_import_batches([self.file_path], self.plan, checkpoint=self.checkpoint()))
+        self.assertEqual([batch['id'].tolist() for batch in batches], [[3, 4], [5]])
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2, CONNECTOR_IMPORT_WORKERS=1)
+    def test_duplicate_keys_raise_before_loading(self):
+        file_path = self.write_file('duplicates.csv', b'id,name\n1,a\n1,b\n')
+        with self.assertRaises(ValueError):
+            read_import_batches([file_path], self.plan)
+
+    def resume_peak_memory(self, file_path, skip_chunks):
+        tracemalloc.start()
+        try:
+            batches = iter_data_batches(file_path, ['id', 'name'], self.plan['inferred_types'], self.plan['column_mapping'], chunksize=10, skip_chunks=skip_chunks)
+            first_id = next(batches)['id'].iloc[0]
+            batches.close()
+            return first_id, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_resume_memory_stays_flat(self):
+        rows = 200000
+        csv_path = self.write_file('large.csv', b'id,name\n' + b''.join(b'%d,"row\n%d"\n' % (i, i) for i in range(rows)))
+        json_path = self.write_file('large.ndjson', b''.join(b'{"id": %d, "name": "row %d"}\n' % (i, i) for i in range(rows)))
+        for file_path in (csv_path, json_path):
+            first_id, near_peak = self.resume_peak_memory(file_path, 1)
+            self.assertEqual(first_id, 10)
+            first_id, far_peak = self.resume_peak_memory(file_path, rows // 10 - 1)
+            self.assertEqual(first_id, rows - 10)
+            # Skipping 20,000 chunks costs no more memory than skipping one
+            self.assertLess(far_peak, near_peak + 1024 * 1024)
+
+
+class StreamedPrimaryKeyTests(TempFileTestCase):
+    def setUp(self):
+        super().setUp()
+        self.plan = {
+            'original_column_names': ['id', 'name', 'status'],
+            'column_mapping': {'id': 'device_id', 'name': 'name'},
+            'row_filter': "status == 'active'",
+            'inferred_types': {'id': 'INT', 'name': 'VARCHAR(255)', 'status': 'VARCHAR(255)'},
+            'date_formats': {},
+            'primary_key_columns': ['device_id'],
+        }
+
+    def write_devices(self, rows):
+        return self.write_file('devices.ndjson', ''.join(
+            f'{{"id": {device_id}, "name": "host{i}", "status": "{status}"}}\n' for i, (device_id, status) in enumerate(rows)
+        ).encode())
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2)
+    def test_duplicates_across_batches(self):
+        file_path = self.write_devices([(1, 'active'), (2, 'active'), (3, 'active'), (1, 'active')])
+        with self.assertRaisesRegex(ValueError, 'duplicate'):
+            check_streamed_primary_key(file_path, self.plan)
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2)
+    def test_null_keys(self):
+        file_path = self.write_devices([(1, 'active'), ('null', 'active')])
+        with self.assertRaisesRegex(ValueError, 'NULL'):
+            check_streamed_primary_key(file_path, self.plan)
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2)
+    def test_filtered_rows_are_not_checked(self):
+        file_path = self.write_devices([(1, 'active'), (2, 'active'), (1, 'retired')])
+        check_streamed_primary_key(file_path, self.plan)
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2)
+    def test_hash_collisions_are_not_duplicates(self):
+        file_path = self.write_devices([(1, 'active'), (2, 'active'), (3, 'active')])
+        with mock.patch('connector.job_execution.hash_keys', side_effect=lambda df, columns: np.zeros(len(df), dtype=np.uint64)):
+            check_streamed_primary_key(file_path, self.plan)
+
+    @override_settings(CONNECTOR_IMPORT_CHUNK_ROWS=2)
+    def test_checked_before_reading(self):
+        # Raised when the batches are requested, before any DDL can run
+        file_path = self.write_devices([(1, 'active'), (1, 'active')])
+        with self.assertRaises(ValueError):
+            read_import_batches([file_path], self.plan)
+        # A resumed import was checked when it started
+        read_import_batches([file_path], self.plan, checkpoint={'chunks_loaded': 1, 'byte_offset': None})
+
+
+class UniqueColumnTests(SimpleTestCase):
+    def test_distinct_counts_in_one_scan(self):
+        cursor = mock.Mock()
+        cursor.fetchone.return_value = (3, 3, 2)
+        unique = get_unique_columns(cursor, 'devices', {'Device ID': 'device_id', 'Name': 'name'})
+        self.assertEqual(unique, {'Device ID': True, 'Name': False})
+        cursor.execute.assert_called_once_with('SELECT COUNT(*), COUNT(DISTINCT `device_id`), COUNT(DISTINCT `name`) FROM `devices`')
+
+    def test_no_columns(self):
+        cursor = mock.Mock()
+        self.assertEqual(get_unique_columns(cursor, 'devices', {}), {})
+        cursor.execute.assert_not_called()
+
+
+class TableRunTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        script = Script.objects.create(job=Job.objects.create(name='inventory'), name='devices', content='', order_exec=1, table_name='devices')
+        table = Table.objects.create(script=script, table_name='devices', import_run=42)
+        TableSnapshot.objects.create(table=table, run=41, format='table', location='_snap41_devices')
+        TableSnapshot.objects.create(table=table, run=40, format='parquet', location='/snapshots/devices/run_40.parquet')
+
+    def test_runs_are_resolved(self):
+        sql = "SELECT * FROM devices@42 d JOIN `devices`@41 p ON d.id = p.id WHERE d.note = 'devices@41'"
+        self.assertEqual(
+            resolve_table_runs(sql),
+            "SELECT * FROM `devices` d JOIN `_snap41_devices` p ON d.id = p.id WHERE d.note = 'devices@41'",
+        )
+
+    def test_parquet_run_is_rejected(self):
+        with self.assertRaisesRegex(ValueError, 'archived as a Parquet file'):
+            resolve_table_runs("SELECT * FROM devices@40")
+
+    def test_qualified_run_is_rejected(self):
+        for sql in ("SELECT * FROM itam.devices@41", "SELECT * FROM `itam`.`devices`@41"):
+            with self.assertRaisesRegex(ValueError, 'without a database name'):
+                resolve_table_runs(sql)
+
+
+class ChangedKeysTests(SimpleTestCase):
+    STAGED_COLUMNS = [('id', 'int(11)'), ('os', 'varchar(50)')]
+
+    def prepare(self, previous_signature, staged_columns=STAGED_COLUMNS, script='UPDATE devices SET os = TRIM(os);'):
+        table = mock.Mock(table_name='devices', transform_script=script)
+        cursor = mock.Mock()
+        with mock.patch('connector.transforms.get_table_columns', return_value=staged_columns), \
+                mock.patch('connector.transforms.get_table_comment', return_value=previous_signature):
+            return prepare_changed_keys(cursor, table, '_staging_devices', ['id'], True)
+
+    def test_same_staged_columns_are_incremental(self):
+        # Columns the transform added to the live table do not matter
+        signature = get_row_hash_signature(['id', 'os'], ['id'], 'UPDATE devices SET os = TRIM(os);')
+        self.assertEqual(self.prepare(signature), (True, None))
+
+    def test_no_previous_hashes(self):
+        self.assertEqual(self.prepare(None), (False, "no row hashes of a previous transformed import"))
+
+    def test_staged_columns_changed(self):
+        signature = get_row_hash_signature(['id', 'os'], ['id'], 'UPDATE devices SET os = TRIM(os);')
+        staged_columns = self.STAGED_COLUMNS + [('site', 'varchar(20)')]
+        self.assertEqual(self.prepare(signature, staged_columns), (False, "the staged columns or primary key of the table changed"))
+
+    def test_script_changed(self):
+        signature = get_row_hash_signature(['id', 'os'], ['id'], 'UPDATE devices SET os = TRIM(os);')
+        self.assertEqual(self.prepare(signature, script='UPDATE devices SET os = UPPER(os);'), (False, "the transform script changed"))
+
+
+class TransformSqlTests(SimpleTestCase):
+    def point(self, sql):
+        return point_sql_at_table(sql, 'devices', '_staging_devices')
+
+    def test_tokenize(self):
+        sql = "SELECT 'it''s; \\'' , `a``b` # c\n--x -- d\n/* e */ \"f\""
+        self.assertEqual(tokenize_sql(sql), [
+            ('code', 'SELECT '), ('string', "'it''s; \\''"), ('code', ' , '), ('identifier', '`a``b`'),
+            ('code', ' '), ('comment', '# c'), ('code', '\n--x '), ('comment', '-- d'), ('code', '\n'),
+            ('comment', '/* e */'), ('code', ' '), ('string', '"f"'),
+        ])
+
+    def test_split_statements(self):
+        sql = "UPDATE t SET a = ';'; -- only a comment;\n; DELETE FROM t /* ; */"
+        self.assertEqual(split_sql_statements(sql), ["UPDATE t SET a = ';'", 'DELETE FROM t /* ; */'])
+
+    def test_table_positions(self):
+        self.assertEqual(self.point("UPDATE devices SET publisher = TRIM(publisher)"), "UPDATE _staging_devices SET publisher = TRIM(publisher)")
+        self.assertEqual(
+            self.point("SELECT * FROM devices d, `sites` AS s, devices WHERE devices.id = s.id"),
+            "SELECT * FROM _staging_devices d, `sites` AS s, _staging_devices WHERE _staging_devices.id = s.id",
+        )
+
+    def test_quoted_name_and_subquery(self):
+        self.assertEqual(
+            self.point("DELETE FROM `devices` WHERE id IN (SELECT id FROM (devices) JOIN changed_keys k USING (id))"),
+            "DELETE FROM `_staging_devices` WHERE id IN (SELECT id FROM (_staging_devices) JOIN changed_keys k USING (id))",
+        )
+
+    def test_columns_literals_and_comments_are_kept(self):
+        for sql in ("SELECT devices, 'devices' FROM sites -- FROM devices",
+                    "SELECT itam.devices.id FROM other_db.devices"):
+            self.assertEqual(self.point(sql), sql)
+        self.assertEqual(
+            self.point("UPDATE devices SET year = EXTRACT(YEAR FROM installed), devices = 1"),
+            "UPDATE _staging_devices SET year = EXTRACT(YEAR FROM installed), devices = 1",
+        )
+
+    def test_split_steps(self):
+        script = "SET @a = 1;\n-- step: trim\nUPDATE t SET a = TRIM(a);\n  -- STEP:\nDELETE FROM t;\n"
+        self.assertEqual(split_transform_steps(script), [
+            ('Transform script', 'SET @a = 1;\n'),
+            ('trim', '\nUPDATE t SET a = TRIM(a);\n'),
+            ('Step 2', '\nDELETE FROM t;\n'),
+        ])
+
+    def test_no_preamble_step(self):
+        self.assertEqual(split_transform_steps("-- step: one\nUPDATE t SET a = 1;"), [('one', '\nUPDATE t SET a = 1;')])
+
+
+class IntegrityErrorTests(TestCase):
+    def test_rejected_keys_drop_staging_table_and_checkpoint(self):
+        job = Job.objects.create(name='inventory')
+        script = Script.objects.create(job=job, name='devices', content='', order_exec=1, table_name='devices')
+        plan = {'primary_key_columns': ['id'], 'dictionary_columns': [], 'column_mapping': {'id': 'id'}, 'table_types': {'id': 'INT'}, 'index_columns': []}
+        names = ('connections', 'prepare_import', 'fingerprint_files', 'fingerprint_plan', 'ensure_checkpoint_table', 'get_checkpoint',
+                 'get_table_type', 'read_import_batches', 'create_table', 'save_checkpoint', 'load_batches', 'drop_table_or_view', 'delete_checkpoint')
+        with mock.patch.multiple('connector.job_execution', **dict.fromkeys(names, mock.DEFAULT)) as mocks:
+            mocks['prepare_import'].return_value = plan
+            mocks['get_checkpoint'].return_value = None
+            mocks['get_table_type'].return_value = None
+            # InnoDB rejects keys the streamed check let through, e.g. under a case-insensitive collation
+            mocks['load_batches'].side_effect = IntegrityError("Duplicate entry 'ABC' for key 'PRIMARY'")
+            success, message, error, rows_loaded = execute_sql_import(script, job, ['/data/devices.csv'])
+
+        self.assertFalse(success)
+        self.assertIn('Duplicate entry', error)
+        mocks['save_checkpoint'].assert_called_once()
+        mocks['delete_checkpoint'].assert_called_once_with(mock.ANY, 'devices')
+        self.assertEqual(mocks['drop_table_or_view'].call_args_list[-1], mock.call(mock.ANY, '_staging_devices'))
+
+
+class JsonRecordTests(TempFileTestCase):
+    RECORDS = [{'id': 1, 'note': 'a], b'}, {'id': 22, 'os': {'name': 'linux'}}, {'id': 333, 'tags': ['x', 'y']}]
+
+    def test_records_split_across_reads(self):
+        file_path = self.write_file('devices.json', b'[{"id": 1, "note": "a], b"}, {"id": 22, "os": {"name": "linux"}},\n {"id": 333, "tags": ["x", "y"]}]')
+        for read_size in (1, 3, 7, 1024):
+            self.assertEqual(list(iter_json_records(file_path, read_size=read_size)), self.RECORDS)
+
+    def test_number_at_buffer_end(self):
+        file_path = self.write_file('devices.json', b'[{"n": 12345}]')
+        self.assertEqual(list(iter_json_records(file_path, read_size=3)), [{'n': 12345}])
+
+    def test_ndjson(self):
+        file_path = self.write_file('devices.ndjson', b'{"id": 1}\n\n{"id": 2}\n')
+        self.assertEqual(list(iter_json_records(file_path)), [{'id': 1}, {'id': 2}])
+
+    def test_truncated_document(self):
+        for data, message in ((b'[{"id": 1}, {"id": 2', 'truncated JSON record'), (b'[{"id": 1}, {"id": 2}', 'Unexpected end of JSON array')):
+            file_path = self.write_file('truncated.json', data)
+            for read_size in (4, 1024):
+                with self.assertRaisesRegex(ValueError, message):
+                    list(iter_json_records(file_path, read_size=read_size))
+
+    def test_invalid_record_is_not_read_as_truncated(self):
+        # The error is far from the end of the buffer, so reading more cannot fix it
+        file_path = self.write_file('invalid.json', b'[{"id": 1}, {"id" 2}, {"id": 3}]' + b' ' * 100)
+        for read_size in (4, 1024):
+            with self.assertRaisesRegex(ValueError, 'Invalid JSON record'):
+                list(iter_json_records(file_path, read_size=read_size))
+
+    def peak_memory(self, file_path):
+        tracemalloc.start()
+        try:
+            count = sum(1 for record in iter_json_records(file_path, read_size=64 * 1024))
+            return count, tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_stays_flat(self):
+        def write(name, rows):
+            return self.write_file(name, b'[' + b','.join(b'{"id": %d, "name": "row %d"}' % (i, i) for i in range(rows)) + b']')
+
+        small_count, small_peak = self.peak_memory(write('small.json', 10000))
+        large_count, large_peak = self.peak_memory(write('large.json', 200000))
+        self.assertEqual((small_count, large_count), (10000, 200000))
+        # Records are decoded one at a time, so a 20 times larger document costs no more memory
+        self.assertLess(large_peak, small_peak + 1024 * 1024)
+
+
+@override_settings(CONNECTOR_CHANGE_FEED_RUNS=3)
+class ChangeFeedRetentionTests(SimpleTestCase):
+    COLUMNS = [('id', 'int(11)'), ('os', 'varchar(50)')]
+
+    def record(self, old_columns=COLUMNS):
+        cursor = mock.Mock(rowcount=2)
+        with mock.patch('connector.change_feed.get_table_columns', side_effect=[self.COLUMNS, old_columns]), \
+                mock.patch('connector.change_feed.get_primary_key', return_value=['id']), \
+                mock.patch('connector.change_feed.ensure_change_table', return_value='_changes_devices'):
+            return cursor, record_changes(cursor, 'devices', 'devices', '_staging_devices', ['id'], 10)
+
+    def test_old_runs_are_deleted(self):
+        cursor, changes = self.record()
+        self.assertEqual(changes, {'insert': 2, 'update': 2, 'delete': 2})
+        # Changes already recorded by a failed run 10 are replaced
+        self.assertEqual(cursor.execute.call_args_list[0], mock.call('DELETE FROM `_changes_devices` WHERE import_run = %s', [10]))
+        # Runs 8, 9 and 10 are kept
+        self.assertEqual(cursor.execute.call_args_list[-1], mock.call('DELETE FROM `_changes_devices` WHERE import_run <= %s', [7]))
+
+    def test_changed_columns_record_nothing(self):
+        cursor, changes = self.record(old_columns=self.COLUMNS[:1])
+        self.assertIsNone(changes)
+        cursor.execute.assert_not_called()
@@ -0,0 +1,464 @@
+# transforms.py
+#
+# Staged transform pipeline. A table's transform script is split into
+# ordered steps by marker lines:
+#
+#   -- step: normalize publishers
+#   UPDATE devices SET publisher = TRIM(publisher);
+#   DELETE FROM devices WHERE publisher = '';
+#   -- step: derive os family
+#   UPDATE devices SET os_family = SUBSTRING_INDEX(os, ' ', 1);
+#
+# Every step may hold several statements. The importer runs all steps in
+# one transaction against the staging table, before it replaces the live
+# table, with references to the table pointed at the staging table. The
+# timing, row count and query plan of every statement are reported.
+#
+# Incremental transforms only process the rows an import inserted or
+# updated. Their keys are in the changed_keys table, which the script joins
+# to, e.g.
+#
+#   UPDATE devices d JOIN changed_keys k ON k.id = d.id
+#   SET d.os_family = SUBSTRING_INDEX(d.os, ' ', 1);
+#
+# and the other rows are copied from the previous transformed import. Rows
+# count as changed when the hash of their untransformed values differs from
+# the previous import's, kept in _rowhash_<table>. Both hashes cover the
+# untransformed columns of the staging table only, so a transform may add or
+# rename columns. A change of those columns, of the primary key or of the
+# script makes the transform full.
+
+import re
+import json
+import time
+import hashlib
+import logging
+from django.db import transaction
+from .change_feed import get_table_columns, row_hash_sql
+
+logger = logging.getLogger(__name__)
+
+STEP_MARKER = re.compile(r'^[ \t]*--[ \t]*step:[ \t]*(.*?)[ \t]*$', re.IGNORECASE | re.MULTILINE)
+
+# Name of the changed keys table in transform scripts
+CHANGED_KEYS_TABLE = 'changed_keys'
+
+# Statements MariaDB can EXPLAIN
+EXPLAINABLE_STATEMENTS = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# Keywords a table name follows, and functions whose arguments use FROM
+# without naming a table, e.g. EXTRACT(YEAR FROM installed)
+TABLE_KEYWORDS = ('FROM', 'JOIN', 'UPDATE', 'INTO', 'TABLE', 'DELETE')
+FROM_FUNCTIONS = ('EXTRACT', 'TRIM', 'SUBSTRING', 'SUBSTR', 'POSITION', 'OVERLAY')
+SQL_WORD = re.compile(r'[\w$]+|\s+|.', re.DOTALL)
+SQL_NAME = re.compile(r'[A-Za-z_$][\w$]*$')
+
+
+def tokenize_sql(sql):
+    """
+    Split SQL text into (kind, text) parts, where kind is 'code', 'string',
+    'identifier' (backtick quoted) or 'comment', so statements can be split
+    and table names rewritten without touching literals or comments.
+    """
+    parts = []
+    start = i = 0
+    length = len(sql)
+
+    while i < length:
+        char = sql[i]
+        if char in '\'"`':
+            end = i + 1
+            while end < length:
+                if sql[end] == '\\' and char != '`':
+                    end += 2
+                    continue
+                if sql[end] == char:
+                    # A doubled quote is an escaped quote
+                    if end + 1 < length and sql[end + 1] == char:
+                        end += 2
+                        continue
+                    break
+                end += 1
+            end = min(end + 1, length)
+            kind = 'identifier' if char == '`' else 'string'
+        elif char == '#' or (sql.startswith('--', i) and (i + 2 == length or sql[i + 2].isspace())):
+            end = sql.find('\n', i)
+            end = length if end == -1 else end
+            kind = 'comment'
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            end = length if end == -1 else end + 2
+            kind = 'comment'
+        else:
+            i += 1
+            continue
+
+        if i > start:
+            parts.append(('code', sql[start:i]))
+        parts.append((kind, sql[i:end]))
+        start = i = end
+
+    if start < length:
+        parts.append(('code', sql[start:]))
+    return parts
+
+
+def split_sql_statements(sql):
+    """Split SQL text into statements on semicolons outside literals and comments."""
+    statements = []
+    current = []
+
+    def finish():
+        # Skip statements that are only whitespace and comments
+        if any(kind != 'comment' and text.strip() for kind, text in current):
+            statements.append(''.join(text for kind, text in current).strip())
+        current.clear()
+
+    for kind, text in tokenize_sql(sql):
+        if kind != 'code':
+            current.append((kind, text))
+            continue
+        pieces = text.split(';')
+        for piece in pieces[:-1]:
+            current.append((kind, piece))
+            finish()
+        current.append((kind, pieces[-1]))
+    finish()
+    return statements
+
+
+def point_sql_at_table(sql, table_name, target_table):
+    """
+    Replace references to table_name, bare or backtick quoted, with
+    target_table where they name a table: after FROM, JOIN, UPDATE, INTO,
+    TABLE or DELETE, in the comma separated table lists that follow them
+    and as the qualifier of a column (devices.publisher). Columns of the
+    same name, literals, comments and names qualified with a database
+    (e.g. other_db.devices) are left alone.
+    """
+    # Code is split into words and single characters, literals and comments
+    # are kept as they are
+    tokens = []
+    for kind, text in tokenize_sql(sql):
+        if kind == 'code':
+            tokens.extend(('code', word) for word in SQL_WORD.findall(text))
+        else:
+            tokens.append((kind, text))
+
+    significant = [i for i, (kind, text) in enumerate(tokens) if kind != 'comment' and not text.isspace()]
+    position = {i: n for n, i in enumerate(significant)}
+
+    def next_significant(i, count=1):
+        n = position[i] + count
+        return tokens[significant[n]][1] if n < len(significant) else ''
+
+    def rename(kind, text):
+        name = text[1:-1] if kind == 'identifier' else text
+        if name.lower() != table_name.lower():
+            return text
+        return f'`{target_table}`' if kind == 'identifier' else target_table
+
+    expect_table = False  # the next name is in a table position
+    qualified = False     # the next name follows a database name and a dot
+    after_table = 0       # names since the last table, to allow an alias before a comma
+    parens = []           # the word before each open parenthesis
+    previous = ''
+    parts = []
+    for i, (kind, text) in enumerate(tokens):
+        if kind == 'comment' or text.isspace():
+            parts.append(text)
+            continue
+
+        word = text.upper() if kind == 'code' else None
+        is_name = kind == 'identifier' or (kind == 'code' and SQL_NAME.match(text))
+        if word in TABLE_KEYWORDS and not (word == 'FROM' and parens and parens[-1] in FROM_FUNCTIONS):
+            expect_table, qualified, after_table = True, False, 0
+        elif is_name and expect_table:
+            if next_significant(i) == '.':
+                qualified = True
+            else:
+                if not qualified:
+                    text = rename(kind, text)
+                expect_table, qualified, after_table = False, False, 1
+        elif text == '.' and qualified:
+            pass
+        elif text == ',' and after_table:
+            expect_table, after_table = True, 0
+        elif is_name and previous != '.' and next_significant(i) == '.' and next_significant(i, 3) != '.':
+            # The table of table.column, not the database of db.table.column
+            text = rename(kind, text)
+            after_table = 0
+        elif is_name and after_table and after_table < 3 and (after_table == 1 or previous.upper() == 'AS'):
+            # An alias, with or without AS
+            after_table += 1
+        else:
+            if text == '(':
+                parens.append(previous.upper())
+            elif text == ')' and parens:
+                parens.pop()
+            # A subquery or parenthesized join may follow FROM and JOIN
+            expect_table = expect_table and text == '('
+            qualified, after_table = False, 0
+        previous = text
+        parts.append(text)
+    return ''.join(parts)
+
+
+def split_transform_steps(transform_script):
+    """
+    Return the (name, sql) steps of a transform script in order. SQL before
+    the first step marker is a step of its own.
+    """
+    markers = list(STEP_MARKER.finditer(transform_script))
+    steps = []
+    preamble = transform_script[:markers[0].start()] if markers else transform_script
+    if split_sql_statements(preamble):
+        steps.append(('Transform script', preamble))
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(transform_script)
+        steps.append((marker.group(1) or f'Step {i + 1}', transform_script[marker.end():end]))
+    return steps
+
+
+def statement_type(statement):
+    code = ''.join(text for kind, text in tokenize_sql(statement) if kind != 'comment')
+    match = re.match(r'\s*\(?\s*(\w+)', code)
+    return match.group(1).upper() if match else ''
+
+
+def explain_statement(cursor, statement):
+    """Return the query plan of a statement as one line per plan row."""
+    if statement_type(statement) not in EXPLAINABLE_STATEMENTS:
+        return []
+    try:
+        cursor.execute(f'EXPLAIN {statement}')
+        column_names = [col[0] for col in cursor.description]
+        return [
+            ', '.join(f'{name}={value}' for name, value in zip(column_names, row) if value is not None)
+            for row in cursor.fetchall()
+        ]
+    except Exception as e:
+        return [f'unavailable: {str(e)}']
+
+
+def shorten(statement, length=120):
+    statement = ' '.join(statement.split())
+    return statement if len(statement) <= length else statement[:length - 3] + '...'
+
+
+def run_transform_steps(cursor, transform_script, table_name, target_table, changed_keys=None):
+    """
+    Run the steps of a transform script against target_table in one
+    transaction and return a report with the timing, affected rows and plan
+    of every statement. References to changed_keys are pointed at the
+    changed_keys table, if given. Any failing statement rolls back all steps, except
+    for DDL statements, which MariaDB always commits implicitly.
+    """
+    lines = []
+    with transaction.atomic(using='itam'):
+        for step_name, step_sql in split_transform_steps(transform_script):
+            step_sql = point_sql_at_table(step_sql, table_name, target_table)
+            if changed_keys:
+                step_sql = point_sql_at_table(step_sql, CHANGED_KEYS_TABLE, changed_keys)
+            statements = split_sql_statements(step_sql)
+            step_start = time.time()
+            step_lines = []
+            for i, statement in enumerate(statements, 1):
+                plan = explain_statement(cursor, statement)
+                start = time.time()
+                try:
+                    cursor.execute(statement)
+                except Exception as e:
+                    raise Exception(f"Step {step_name}, statement {i} failed: {str(e)}: {shorten(statement)}") from e
+                step_lines.append(f"  [{i}] {time.time() - start:.2f}s, {cursor.rowcount} rows: {shorten(statement)}")
+                step_lines.extend(f"      plan: {row}" for row in plan)
+
+            lines.append(f"Step {step_name}: {len(statements)} statements in {time.time() - step_start:.2f}s")
+            lines.extend(step_lines)
+            logger.info(f"Transform step {step_name} of {table_name} finished in {time.time() - step_start:.2f}s")
+    return "\n".join(lines)
+
+
+def get_row_hash_table_name(table_name):
+    return f'_rowhash_{table_name}'[:64]
+
+
+def get_new_row_hash_table_name(table_name):
+    return f'_newhash_{table_name}'[:64]
+
+
+def get_changed_keys_table_name(table_name):
+    return f'_changed_{table_name}'[:64]
+
+
+def create_key_table(cursor, table_name, key_columns, with_hash=False):
+    """Create a table of primary key values, optionally with a row_hash column."""
+    cursor.execute(f'DROP TABLE IF EXISTS `{table_name}`')
+    # BLOB/TEXT key columns can only be indexed on a prefix
+    index_columns = [f'`{col}`(255)' if col_type.endswith('text') else f'`{col}`' for col, col_type in key_columns]
+    cursor.execute(f"""
+        CREATE TABLE `{table_name}` (
+            {', '.join(f'`{col}` {col_type} NOT NULL' for col, col_type in key_columns)},
+            {'`row_hash` CHAR(32) NOT NULL,' if with_hash else ''}
+            PRIMARY KEY ({', '.join(index_columns)})
+        )
+    """)
+
+
+def get_table_comment(cursor, table_name):
+    """Return the comment of a table, or None if it does not exist."""
+    cursor.execute("""
+        SELECT TABLE_COMMENT
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+    """, [table_name])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def get_row_hash_signature(column_names, primary_key_columns, transform_script):
+    """
+    Signature kept as the comment of a row hash table: a digest of the
+    staged columns and primary key the rows were hashed from, and a digest of
+    the transform script.
+    """
+    columns_digest = hashlib.md5(json.dumps([column_names, primary_key_columns]).encode('utf-8')).hexdigest()
+    script_digest = hashlib.md5(transform_script.encode('utf-8')).hexdigest()
+    return f'{columns_digest} {script_digest}'
+
+
+def prepare_changed_keys(cursor, table, staging_table, primary_key_columns, incremental):
+    """
+    Hash the untransformed rows of the staging table into the new row hash
+    table and fill the changed keys table with the keys the transform has to
+    process: the rows inserted or updated since the last transformed import
+    when incremental, all rows otherwise. Only the staged columns are hashed,
+    as in the previous import's row hashes, so columns the transform adds or
+    renames in the live table do not make rows changed.
+
+    Returns (incremental, reason): an incremental transform falls back to a
+    full one, with the reason why, when the previous import cannot be reused,
+    i.e. when its row hashes are missing or were taken from other columns, on
+    another primary key or for another transform script.
+    """
+    table_name = table.table_name
+    staging_columns = get_table_columns(cursor, staging_table)
+    column_names = [col for col, col_type in staging_columns]
+    column_types = dict(staging_columns)
+    key_columns = [(col, column_types[col]) for col in primary_key_columns]
+    old_hashes = get_row_hash_table_name(table_name)
+    new_hashes = get_new_row_hash_table_name(table_name)
+    changed_keys = get_changed_keys_table_name(table_name)
+
+    create_key_table(cursor, new_hashes, key_columns, with_hash=True)
+    signature = get_row_hash_signature(column_names, primary_key_columns, table.transform_script)
+    cursor.execute(f'ALTER TABLE `{new_hashes}` COMMENT = %s', [signature])
+    key_list = ', '.join(f'`{col}`' for col in primary_key_columns)
+    cursor.execute(f"""
+        INSERT INTO `{new_hashes}` ({key_list}, row_hash)
+        SELECT {', '.join(f's.`{col}`' for col in primary_key_columns)}, {row_hash_sql('s', column_names)}
+        FROM `{staging_table}` s
+    """)
+
+    reason = None
+    if incremental:
+        previous_signature = get_table_comment(cursor, old_hashes)
+        if previous_signature is None:
+            reason = "no row hashes of a previous transformed import"
+        elif previous_signature.split(' ')[0] != signature.split(' ')[0]:
+            reason = "the staged columns or primary key of the table changed"
+        elif previous_signature != signature:
+            reason = "the transform script changed"
+    incremental = incremental and reason is None
+
+    create_key_table(cursor, changed_keys, key_columns)
+    if incremental:
+        join_condition = ' AND '.join(f'o.`{col}` = n.`{col}`' for col in primary_key_columns)
+        cursor.execute(f"""
+            INSERT INTO `{changed_keys}` ({key_list})
+            SELECT {', '.join(f'n.`{col}`' for col in primary_key_columns)}
+            FROM `{new_hashes}` n LEFT JOIN `{old_hashes}` o ON {join_condition}
+            WHERE o.row_hash IS NULL OR o.row_hash <> n.row_hash
+        """)
+    else:
+        cursor.execute(f'INSERT INTO `{changed_keys}` ({key_list}) SELECT {key_list} FROM `{new_hashes}`')
+    return incremental, reason
+
+
+def restore_unchanged_rows(cursor, table_name, staging_table, primary_key_columns):
+    """
+    Replace the rows of the staging table that did not change since the last
+    transformed import with their transformed version from the live table.
+    Rows the last transform deleted stay deleted.
+    """
+    old_hashes = get_row_hash_table_name(table_name)
+    new_hashes = get_new_row_hash_table_name(table_name)
+    column_list = ', '.join(f'`{col}`' for col, col_type in get_table_columns(cursor, staging_table))
+    unchanged = f"""
+        JOIN `{new_hashes}` n ON {' AND '.join(f'n.`{col}` = t.`{col}`' for col in primary_key_columns)}
+        JOIN `{old_hashes}` o ON {' AND '.join(f'o.`{col}` = n.`{col}`' for col in primary_key_columns)}
+        WHERE o.row_hash = n.row_hash
+    """
+    cursor.execute(f'DELETE t FROM `{staging_table}` t {unchanged}')
+    cursor.execute(f'INSERT INTO `{staging_table}` ({column_list}) SELECT {column_list} FROM `{table_name}` t {unchanged}')
+    return cursor.rowcount
+
+
+def run_transform(cursor, table, staging_table, primary_key_columns, full=False):
+    """
+    Transform the staging table of an import with the table's transform
+    script. When the table's transforms are incremental, the script only
+    needs to process the rows in changed_keys; the unchanged rows are then
+    restored from the live table. A full transform puts every key in
+    changed_keys. Tables without a primary key are always transformed in
+    full, without changed_keys.
+
+    Returns (report, incremental, seconds).
+    """
+    start = time.time()
+    incremental = table.transform_incremental and not full
+    changed_keys = None
+    reason = None
+    if not primary_key_columns:
+        incremental = False
+        reason = "the table has no primary key" if table.transform_incremental and not full else None
+    else:
+        incremental, reason = prepare_changed_keys(cursor, table, staging_table, primary_key_columns, incremental)
+        changed_keys = get_changed_keys_table_name(table.table_name)
+    if reason:
+        logger.info(f"Incremental transform of {table.table_name} falls back to a full transform: {reason}")
+
+    with transaction.atomic(using='itam'):
+        steps_report = run_transform_steps(cursor, table.transform_script, table.table_name, staging_table, changed_keys)
+        if incremental:
+            restored = restore_unchanged_rows(cursor, table.table_name, staging_table, primary_key_columns)
+
+    seconds = time.time() - start
+    if changed_keys:
+        cursor.execute(f'SELECT COUNT(*) FROM `{changed_keys}`')
+        changed_rows = cursor.fetchone()[0]
+    if incremental:
+        summary = f"Incremental transform of {changed_rows} changed rows in {seconds:.2f}s, {restored} unchanged rows kept"
+        if table.transform_full_seconds is not None:
+            summary += f" (last full transform: {table.transform_full_seconds:.2f}s)"
+    else:
+        summary = f"Full transform in {seconds:.2f}s" + (f" of {changed_rows} rows" if changed_keys else "")
+        if reason:
+            summary += f" ({reason})"
+    logger.info(f"{summary} for {table.table_name}")
+    return f"{summary}\n{steps_report}", incremental, seconds
+
+
+def save_row_hashes(cursor, table_name):
+    """Keep the row hashes of an import that replaced the live table, for the next incremental transform."""
+    old_hashes = get_row_hash_table_name(table_name)
+    cursor.execute(f'DROP TABLE IF EXISTS `{old_hashes}`, `{get_changed_keys_table_name(table_name)}`')
+    cursor.execute(f'RENAME TABLE `{get_new_row_hash_table_name(table_name)}` TO `{old_hashes}`')
+
+
+def drop_row_hashes(cursor, table_name):
+    cursor.execute(f"""
+        DROP TABLE IF EXISTS `{get_row_hash_table_name(table_name)}`,
+            `{get_new_row_hash_table_name(table_name)}`,
+            `{get_changed_keys_table_name(table_name)}`
+    """)
@@ -16,8 +16,10 @@ urlpatterns = [
 
 
     path('table/<int:table_id>/edit/', views.edit_table, name='table_edit'),
+    path('table/<int:table_id>/refresh-row-count/', views.refresh_table_row_count, name='refresh_table_row_count'),
     path('edit-job/<int:job_id>/', views.edit_job, name='edit_job'),
     path('execute-job/<int:job_id>/', views.execute_job, name='execute_job'),
+    path('profile-job/<int:job_id>/', views.profile_job, name='profile_job'),
     path('job/<int:job_id>/delete/', views.delete_job, name='delete_job'),
     path('table/<int:table_id>/view/', views.table_view, name='table_view'),
 ]
\ No newline at end of file
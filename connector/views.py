@@ -12,7 +12,7 @@ from django.utils import timezone
 from apscheduler.jobstores.base import JobLookupError
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
-from .job_execution import execute_job_core
+from .job_execution import execute_job_core, refresh_row_count
 from django.db import connections
 from django.db.utils import ProgrammingError
 
@@ -172,6 +172,17 @@ def execute_job(request, job_id):
     })
 
 
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def profile_job(request, job_id):
+    job, success, output, error = execute_job_core(job_id, profile_only=True)
+    return JsonResponse({
+        'success': success,
+        'output': output,
+        'error': error
+    })
+
+
 def scheduled_job_execution(job_id):
     execute_job_core(job_id)
     # No need for additional logging here, as it's done in execute_job_core
@@ -279,6 +290,19 @@ def save_table_list(request):
     return redirect('connector:table_list')
 
 
+@require_http_methods(["POST"])
+def refresh_table_row_count(request, table_id):
+    """Refresh the row count of a table changed outside the importer."""
+    table = get_object_or_404(Table, id = table_id)
+    try:
+        refresh_row_count(table)
+        messages.success(request, f'Row count of {table.table_name} estimated at {table.row_count}.')
+    except Exception as e:
+        logger.error(f"Error refreshing row count of {table.table_name}: {str(e)}", exc_info=True)
+        messages.error(request, f'Error refreshing row count: {str(e)}')
+    return redirect('connector:table_edit', table_id = table.id)
+
+
 # https://claude.ai/chat/950437a5-152f-444d-84ff-9bb5866455e8
 def edit_table(request, table_id):
     table = get_object_or_404(Table, id = table_id)
@@ -302,6 +326,11 @@ def edit_table(request, table_id):
             # Update Table
             table.transform_script = form.cleaned_data['transform_script']
             table.run_transform = form.cleaned_data['run_transform']
+            table.snapshot_retention = form.cleaned_data['snapshot_retention']
+            table.snapshot_format = form.cleaned_data['snapshot_format']
+            table.change_feed = form.cleaned_data['change_feed']
+            table.transform_incremental = form.cleaned_data['transform_incremental']
+            table.transform_full_recompute = form.cleaned_data['transform_full_recompute']
             table.save()
 
             # Update Columns
@@ -311,6 +340,9 @@ def edit_table(request, table_id):
                 existing_column.override_data_type = column.override_data_type
                 existing_column.override_column_name = column.override_column_name
                 existing_column.primary_key = column.primary_key
+                existing_column.secondary_index = column.secondary_index
+                existing_column.include = column.include
+                existing_column.dictionary_encode = column.dictionary_encode
                 existing_column.foreign_key_reference = column.foreign_key_reference
                 existing_column.save()
         else:
@@ -325,6 +357,11 @@ def edit_table(request, table_id):
         initial_data = {
             'transform_script': table.transform_script,
             'run_transform': table.run_transform,
+            'snapshot_retention': table.snapshot_retention,
+            'snapshot_format': table.snapshot_format,
+            'change_feed': table.change_feed,
+            'transform_incremental': table.transform_incremental,
+            'transform_full_recompute': table.transform_full_recompute,
         }
         form = CustomEditTableForm(initial = initial_data)
         column_formset = ColumnFormSet(
@@ -0,0 +1,227 @@
+# writers.py
+#
+# Query results streamed out of the itam database on a server-side cursor and
+# written as Parquet files or Arrow IPC streams. Report exports and Parquet
+# snapshots both write through here, so the reports app depends on connector
+# and not the other way round.
+
+import io
+import logging
+from MySQLdb.cursors import SSCursor
+from MySQLdb.constants import FIELD_TYPE, FLAG
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Rows fetched from the server-side cursor and written per chunk
+STREAM_BATCH_ROWS = 5000
+
+# Parquet compression codecs offered for exports; the first is the default
+PARQUET_COMPRESSIONS = ('zstd', 'snappy')
+
+# Rows per Parquet row group; fetched batches are buffered up to this size, as
+# small row groups compress and scan poorly
+PARQUET_ROW_GROUP_ROWS = 256 * 1024
+
+
+def open_query_stream(query, params=None):
+    """
+    Run a query on an unbuffered server-side cursor (MySQLdb SSCursor) and
+    return its column names, an iterator over batches of row tuples and the
+    column fields: the cursor description of each column with its flags
+    appended, from which typed formats take their column types. Rows are
+    read from the server as the batches are consumed, so memory stays
+    constant however large the result is.
+    """
+    connection = connections['itam']
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(SSCursor)
+    try:
+        # Without params the query is not %-formatted, so user SQL may contain '%'
+        cursor.execute(query, params or None)
+    except Exception:
+        cursor.close()
+        raise
+    columns = [col[0] for col in cursor.description]
+    fields = [col + (flags,) for col, flags in zip(cursor.description, cursor.description_flags)]
+
+    def batches():
+        try:
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_ROWS)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    return columns, batches(), fields
+
+
+def get_arrow_type(field, first_value=None):
+    """
+    Return the Arrow type of a result column from its field (see
+    open_query_stream). Text and binary columns share type codes, so a
+    column flagged binary is binary only when its first value is bytes, as
+    MySQLdb returns text of binary collations as str. JSON, ENUM, SET and
+    unknown types are strings.
+    """
+    import pyarrow as pa
+
+    name, type_code, display_size, internal_size, precision, scale, null_ok, flags = field
+    if type_code in (FIELD_TYPE.TINY, FIELD_TYPE.SHORT, FIELD_TYPE.INT24, FIELD_TYPE.LONG, FIELD_TYPE.YEAR):
+        return pa.int64()
+    if type_code == FIELD_TYPE.LONGLONG:
+        return pa.uint64() if flags & FLAG.UNSIGNED else pa.int64()
+    if type_code == FIELD_TYPE.FLOAT:
+        return pa.float32()
+    if type_code == FIELD_TYPE.DOUBLE:
+        return pa.float64()
+    if type_code in (FIELD_TYPE.DECIMAL, FIELD_TYPE.NEWDECIMAL):
+        # precision is the display length, which covers the digits, point and sign
+        precision = max(precision or 0, scale + 1)
+        return pa.decimal128(precision, scale) if precision <= 38 else pa.decimal256(min(precision, 76), scale)
+    if type_code in (FIELD_TYPE.DATE, FIELD_TYPE.NEWDATE):
+        return pa.date32()
+    if type_code in (FIELD_TYPE.DATETIME, FIELD_TYPE.TIMESTAMP):
+        return pa.timestamp('us')
+    if type_code == FIELD_TYPE.TIME:
+        return pa.duration('us')
+    if type_code in (FIELD_TYPE.BIT, FIELD_TYPE.GEOMETRY):
+        return pa.binary()
+    if type_code in (FIELD_TYPE.TINY_BLOB, FIELD_TYPE.MEDIUM_BLOB, FIELD_TYPE.LONG_BLOB, FIELD_TYPE.BLOB,
+                     FIELD_TYPE.VARCHAR, FIELD_TYPE.VAR_STRING, FIELD_TYPE.STRING):
+        return pa.binary() if flags & FLAG.BINARY and isinstance(first_value, bytes) else pa.string()
+    return pa.string()
+
+
+def to_record_batches(header, fields, batches):
+    """
+    Return the Arrow schema of a query result and an iterator converting its
+    batches of rows to Arrow record batches.
+    """
+    import pyarrow as pa
+
+    first_rows = next(batches, [])
+    first_values = [next((row[i] for row in first_rows if row[i] is not None), None) for i in range(len(header))]
+    schema = pa.schema([pa.field(name, get_arrow_type(field, value)) for name, field, value in zip(header, fields, first_values)])
+
+    def convert(rows):
+        arrays = []
+        for index, field in enumerate(schema):
+            values = [row[index] for row in rows]
+            if pa.types.is_string(field.type):
+                values = [
+                    value if value is None or isinstance(value, str)
+                    else value.decode('utf-8', 'replace') if isinstance(value, bytes)
+                    else ','.join(sorted(value)) if isinstance(value, (set, frozenset))
+                    else str(value)
+                    for value in values
+                ]
+            elif pa.types.is_binary(field.type):
+                values = [value.encode('utf-8') if isinstance(value, str) else value for value in values]
+            arrays.append(pa.array(values, type=field.type))
+        return pa.record_batch(arrays, schema=schema)
+
+    def record_batches():
+        if first_rows:
+            yield convert(first_rows)
+        for rows in batches:
+            yield convert(rows)
+
+    return schema, record_batches()
+
+
+class ChunkSink(io.RawIOBase):
+    """
+    Write-only file that holds what is written until it is taken, so a file
+    written front to back (Parquet, Arrow IPC) can be streamed as it grows.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def open_arrow_writer(export_type, file, schema, compression=PARQUET_COMPRESSIONS[0]):
+    """Open a Parquet or Arrow IPC stream writer on a file path or file object."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if export_type == 'parquet':
+        return pq.ParquetWriter(file, schema, compression=compression)
+    return pa.ipc.new_stream(file, schema)
+
+
+def write_record_batches(export_type, writer, record_batches):
+    """
+    Write record batches with a writer from open_arrow_writer, yielding the
+    number of rows after every write. Parquet batches are buffered into row
+    groups of PARQUET_ROW_GROUP_ROWS; Arrow IPC batches are written as they
+    come.
+    """
+    import pyarrow as pa
+
+    pending = []
+    pending_rows = 0
+    for record_batch in record_batches:
+        if export_type != 'parquet':
+            writer.write_batch(record_batch)
+            yield record_batch.num_rows
+            continue
+        pending.append(record_batch)
+        pending_rows += record_batch.num_rows
+        if pending_rows >= PARQUET_ROW_GROUP_ROWS:
+            writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+            yield pending_rows
+            pending, pending_rows = [], 0
+    if pending:
+        writer.write_table(pa.Table.from_batches(pending), row_group_size=pending_rows)
+        yield pending_rows
+
+
+def stream_arrow(export_type, header, fields, batches, compression=PARQUET_COMPRESSIONS[0]):
+    """
+    Yield a Parquet file or an Arrow IPC stream chunk by chunk, typed from
+    the query's fields: a chunk per Parquet row group or per IPC batch.
+    """
+    schema, record_batches = to_record_batches(header, fields, batches)
+    sink = ChunkSink()
+    writer = open_arrow_writer(export_type, sink, schema, compression)
+    rows_written = 0
+    try:
+        for rows in write_record_batches(export_type, writer, record_batches):
+            rows_written += rows
+            yield sink.take()
+    finally:
+        writer.close()
+    # The Parquet footer or end-of-stream marker
+    yield sink.take()
+    logger.info(f"Streamed {rows_written} rows as {export_type}")
+
+
+def write_arrow(export_type, header, fields, batches, file_path, compression=PARQUET_COMPRESSIONS[0]):
+    """Write a Parquet file or an Arrow IPC stream to file_path. Returns the number of rows."""
+    schema, record_batches = to_record_batches(header, fields, batches)
+    writer = open_arrow_writer(export_type, file_path, schema, compression)
+    try:
+        rows_written = sum(write_record_batches(export_type, writer, record_batches))
+    finally:
+        writer.close()
+    return rows_written
@@ -235,6 +235,39 @@ REST_FRAMEWORK = {
 }
 ########################################
 
+# ### Connector Settings ###
+# Replace the row counts estimated for tables changed outside the importer (Refresh on the
+# table page) with an exact COUNT(*) run as a scheduler job
+CONNECTOR_BACKGROUND_RECOUNT = str2bool(os.getenv('CONNECTOR_BACKGROUND_RECOUNT', 'True'))
+# Worker processes used to read and convert data files in parallel
+CONNECTOR_IMPORT_WORKERS = int(os.getenv('CONNECTOR_IMPORT_WORKERS', os.cpu_count() or 1))
+# Single CSV files at least this large are parsed in parallel byte ranges
+CONNECTOR_PARALLEL_CSV_MIN_SIZE = int(os.getenv('CONNECTOR_PARALLEL_CSV_MIN_SIZE', 256 * 1024 * 1024))
+CONNECTOR_PARALLEL_CSV_CHUNK_SIZE = int(os.getenv('CONNECTOR_PARALLEL_CSV_CHUNK_SIZE', 64 * 1024 * 1024))
+# Rows per batch when streaming compressed or JSON files, and per checkpointed load chunk
+CONNECTOR_IMPORT_CHUNK_ROWS = int(os.getenv('CONNECTOR_IMPORT_CHUNK_ROWS', 100000))
+# Unfinished imports checkpointed within this many hours are resumed instead of re-running the script
+CONNECTOR_IMPORT_RESUME_HOURS = int(os.getenv('CONNECTOR_IMPORT_RESUME_HOURS', 24))
+# Parquet snapshots of imported tables are archived under this directory
+CONNECTOR_SNAPSHOT_DIR = os.getenv('CONNECTOR_SNAPSHOT_DIR', os.path.join(BASE_DIR, 'snapshots'))
+# Imports whose changes are kept in a table's change feed
+CONNECTOR_CHANGE_FEED_RUNS = int(os.getenv('CONNECTOR_CHANGE_FEED_RUNS', 30))
+# Assumed insert rate used to estimate load time in profile-only runs
+CONNECTOR_LOAD_ROWS_PER_SECOND = int(os.getenv('CONNECTOR_LOAD_ROWS_PER_SECOND', 20000))
+
+# ### Reports Settings ###
+# Seconds a compiled report query stays cached; remapping the schema invalidates it sooner
+REPORTS_COMPILED_QUERY_SECONDS = int(os.getenv('REPORTS_COMPILED_QUERY_SECONDS', 3600))
+# Reports estimated by EXPLAIN to have at least this many rows show the estimate while the
+# exact count runs in the background; 0 always counts exactly
+REPORTS_COUNT_ESTIMATE_ROWS = int(os.getenv('REPORTS_COUNT_ESTIMATE_ROWS', 1000000))
+# Cached report counts older than this many days are deleted
+REPORTS_COUNT_RETENTION_DAYS = int(os.getenv('REPORTS_COUNT_RETENTION_DAYS', 7))
+# Queued exports run as scheduler jobs, at most this many at a time per process
+REPORTS_EXPORT_WORKERS = int(os.getenv('REPORTS_EXPORT_WORKERS', 2))
+# Queued export files are written under MEDIA_ROOT/exports and deleted after this many days unused
+REPORTS_EXPORT_RETENTION_DAYS = int(os.getenv('REPORTS_EXPORT_RETENTION_DAYS', 7))
+
 MESSAGE_TAGS = {
     messages.DEBUG: 'alert-info',
     messages.INFO: 'alert-info',
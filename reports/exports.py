@@ -0,0 +1,278 @@
+import io
+import os
+import csv
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import openpyxl
+from datetime import timedelta
+from django.conf import settings
+from django.db import connections, DatabaseError
+from django.utils import timezone
+from connector.writers import open_query_stream, write_arrow, PARQUET_COMPRESSIONS
+from scheduler.scheduler import run_once, is_lost, heartbeat
+from .models import ExportJob
+from .query_builder import get_count_key, get_exact_count, estimate_result_rows
+
+logger = logging.getLogger(__name__)
+
+# Rows per worksheet, including the header row, allowed by the xlsx format
+EXCEL_MAX_ROWS = 1048576
+
+# Exports are kept in memory up to this size before spilling to a temporary file
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+# Directory under MEDIA_ROOT that queued exports are written to
+EXPORT_DIR = 'exports'
+
+EXPORT_EXTENSIONS = {
+    'csv': 'csv',
+    'excel': 'xlsx',
+    'parquet': 'parquet',
+    'arrow': 'arrows',
+}
+
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'excel': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+# Limits the queued exports running at the same time in this process
+_export_slots = threading.BoundedSemaphore(max(1, settings.REPORTS_EXPORT_WORKERS))
+
+
+def order_columns(columns, column_order):
+    """
+    Return the result columns in column_order; columns missing from it
+    follow in query order and names the query does not return are ignored.
+    """
+    if not column_order:
+        return list(columns)
+    ordered_columns = [col for col in column_order if col in columns]
+    ordered_columns.extend([col for col in columns if col not in ordered_columns])
+    return ordered_columns
+
+
+def select_columns(batches, column_indexes):
+    """Reorder the values of each row to column_indexes."""
+    for rows in batches:
+        yield [[row[i] for i in column_indexes] for row in rows]
+
+
+def stream_csv(header, batches):
+    """Yield a CSV document chunk by chunk: the header row, then one chunk per batch of rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield buffer.getvalue()
+
+    rows_written = 0
+    for rows in batches:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(rows)
+        rows_written += len(rows)
+        yield buffer.getvalue()
+    logger.info(f"Streamed {rows_written} rows as CSV")
+
+
+def write_xlsx(header, batches, file):
+    """
+    Write rows to an xlsx file with openpyxl's write-only mode, which keeps
+    memory constant. A new worksheet, repeating the header, is started
+    whenever one reaches EXCEL_MAX_ROWS rows. Returns the number of rows.
+    """
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = None
+    sheet_rows = EXCEL_MAX_ROWS
+    rows_written = 0
+
+    for rows in batches:
+        for row in rows:
+            if sheet_rows >= EXCEL_MAX_ROWS:
+                sheet_number = len(workbook.worksheets) + 1
+                worksheet = workbook.create_sheet('Report' if sheet_number == 1 else f'Report {sheet_number}')
+                worksheet.append(header)
+                sheet_rows = 1
+            worksheet.append(row)
+            sheet_rows += 1
+        rows_written += len(rows)
+
+    if worksheet is None:
+        workbook.create_sheet('Report').append(header)
+    workbook.save(file)
+    logger.info(f"Wrote {rows_written} rows to xlsx in {len(workbook.worksheets)} sheets")
+    return rows_written
+
+
+def spool_xlsx(header, batches):
+    """Write an xlsx export to a spooled temporary file and return it rewound, for streaming."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        write_xlsx(header, batches, spool)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def write_csv(header, batches, file_path):
+    """Write rows to a CSV file. Returns the number of rows."""
+    rows_written = 0
+    with open(file_path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        for rows in batches:
+            writer.writerows(rows)
+            rows_written += len(rows)
+    return rows_written
+
+
+EXPORT_WRITERS = {
+    'csv': write_csv,
+    'excel': write_xlsx,
+}
+
+
+def track_progress(job_id, batches):
+    """Pass batches through, recording the rows written so far on the export job."""
+    rows_written = 0
+    for rows in batches:
+        yield rows
+        rows_written += len(rows)
+        ExportJob.objects.filter(id=job_id).update(rows_written=rows_written, updated_at=timezone.now())
+
+
+def run_export_job(job_id, query, params, header=None, column_order=None, compression=PARQUET_COMPRESSIONS[0]):
+    """
+    Write the rows of a query to an export job's file. header names the
+    columns the query returns; without it the query's own column names are
+    used, in column_order. compression is the Parquet codec. Intended to run
+    as a scheduler job, see queue_export.
+
+    The file is written under a temporary name and renamed when complete,
+    so a partial file is never served.
+    """
+    try:
+        with heartbeat(ExportJob.objects.filter(id=job_id)), _export_slots:
+            # The job may have been replaced while it waited for a slot
+            if not ExportJob.objects.filter(id=job_id, status='queued').update(status='running', updated_at=timezone.now()):
+                return
+            job = ExportJob.objects.get(id=job_id)
+            file_path = os.path.join(settings.MEDIA_ROOT, job.file)
+            partial_path = f'{file_path}.{job_id}.part'
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            try:
+                columns, batches, fields = open_query_stream(query, params)
+                if header is None:
+                    header = order_columns(columns, column_order)
+                    if header != columns:
+                        indexes = [columns.index(col) for col in header]
+                        batches = select_columns(batches, indexes)
+                        fields = [fields[i] for i in indexes]
+
+                batches = track_progress(job_id, batches)
+                if job.export_type in EXPORT_WRITERS:
+                    rows_written = EXPORT_WRITERS[job.export_type](header, batches, partial_path)
+                else:
+                    rows_written = write_arrow(job.export_type, header, fields, batches, partial_path, compression)
+                os.replace(partial_path, file_path)
+            finally:
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+            now = timezone.now()
+            ExportJob.objects.filter(id=job_id).update(status='completed', rows_written=rows_written, total_rows=rows_written, completed_at=now, updated_at=now)
+            logger.info(f"Export job {job_id} wrote {rows_written} rows to {file_path}")
+    except Exception as e:
+        logger.error(f"Error running export job {job_id}: {str(e)}", exc_info=True)
+        ExportJob.objects.filter(id=job_id).update(status='failed', error=str(e), updated_at=timezone.now())
+    finally:
+        connections.close_all()
+
+
+def get_export_job_id(job_id):
+    return f'reports_export_{job_id}'
+
+
+def fail_lost_export(job):
+    """
+    Mark a queued or running export job failed if it was lost with its
+    process, see scheduler.is_lost. Returns whether it was.
+    """
+    if job.status not in ('queued', 'running') or not is_lost(get_export_job_id(job.id), job.updated_at):
+        return False
+    logger.warning(f"Export job {job.id} was lost with its process")
+    job.status = 'failed'
+    job.error = 'The export stopped with the process running it, queue it again'
+    job.updated_at = timezone.now()
+    ExportJob.objects.filter(id=job.id, status__in=['queued', 'running']).update(status=job.status, error=job.error, updated_at=job.updated_at)
+    return True
+
+
+def delete_export(job):
+    if job.file:
+        file_path = os.path.join(settings.MEDIA_ROOT, job.file)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+    job.delete()
+
+
+def delete_expired_exports():
+    for job in ExportJob.objects.filter(status__in=['queued', 'running']):
+        fail_lost_export(job)
+    expired = timezone.now() - timedelta(days=settings.REPORTS_EXPORT_RETENTION_DAYS)
+    for job in ExportJob.objects.filter(updated_at__lt=expired).exclude(status__in=['queued', 'running']):
+        delete_export(job)
+
+
+def get_export_key(count_key, export_type, header=None, column_order=None, compression=PARQUET_COMPRESSIONS[0]):
+    # Only Parquet files depend on the compression codec
+    if export_type != 'parquet':
+        compression = None
+    return hashlib.sha256(json.dumps([count_key, export_type, header, column_order, compression]).encode('utf-8')).hexdigest()
+
+
+def queue_export(compiled, export_type, header=None, column_order=None, compression=PARQUET_COMPRESSIONS[0]):
+    """
+    Return the ExportJob writing a compiled report to a file in export_type,
+    see run_export_job for header, column_order and compression. Jobs are keyed by the
+    report's count key, which changes when one of its tables is imported
+    again, so an export of unchanged data is served from the file already
+    written or being written. A new job runs as a scheduler job.
+    """
+    delete_expired_exports()
+    count_key = get_count_key(compiled)
+    key = get_export_key(count_key, export_type, header, column_order, compression)
+
+    job = ExportJob.objects.filter(key=key).first()
+    if job is not None:
+        if job.status == 'completed' and os.path.exists(os.path.join(settings.MEDIA_ROOT, job.file)):
+            # Served again, so kept for another retention period
+            ExportJob.objects.filter(id=job.id).update(updated_at=timezone.now())
+            return job
+        if job.status in ('queued', 'running') and not fail_lost_export(job):
+            return job
+        delete_export(job)
+
+    total_rows = get_exact_count(count_key)
+    if total_rows is None and compiled['count_sql']:
+        try:
+            total_rows = estimate_result_rows(compiled)
+        except DatabaseError as e:
+            logger.warning(f"Could not estimate export rows: {str(e)}")
+
+    job, created = ExportJob.objects.get_or_create(key=key, defaults={
+        'export_type': export_type,
+        'file': f'{EXPORT_DIR}/{key}.{EXPORT_EXTENSIONS[export_type]}',
+        'total_rows': total_rows,
+    })
+    if created:
+        run_once(run_export_job, [job.id, compiled['select_sql'], compiled['params'], header, column_order, compression], get_export_job_id(job.id))
+        logger.info(f"Queued {export_type} export job {job.id}")
+    return job
@@ -1,18 +1,256 @@
+import math
+import heapq
+import threading
+import logging
 from collections import deque
-from django.db.models import Q
-from .models import Table, Relationship
+from django.db.models import F
+from .models import Table, Column, Relationship, SchemaVersion
+
+logger = logging.getLogger(__name__)
+
+# Weight multiplier for joins on columns that are unique on neither side,
+# which can multiply the rows of the result
+FANOUT_PENALTY = 4
+
+
+def relationship_weight(relationship):
+    """
+    Cost of joining along a relationship: grows with the size of the two
+    tables and is raised when neither join column is unique.
+    """
+    weight = 1 + math.log10(1 + relationship.from_table.row_estimate + relationship.to_table.row_estimate)
+    if not (relationship.from_column.is_unique or relationship.to_column.is_unique):
+        weight *= FANOUT_PENALTY
+    return weight
+
+
+class JoinPlan:
+    """
+    Join tree connecting a main table to a set of tables. joins holds
+    (relationship, table) pairs in join order, where table is the table the
+    relationship brings into the query; unreachable holds the tables no
+    relationship path leads to.
+    """
+
+    def __init__(self, main_table, joins, unreachable, cost):
+        self.main_table = main_table
+        self.joins = joins
+        self.unreachable = unreachable
+        self.cost = cost
+
+    def to_dict(self):
+        return {
+            'main_table': self.main_table.name,
+            'joins': [
+                {'table': table.name, 'relationship': str(relationship), 'weight': round(relationship_weight(relationship), 3)}
+                for relationship, table in self.joins
+            ],
+            'unreachable': [table.name for table in self.unreachable],
+            'cost': round(self.cost, 3),
+        }
+
+
+class SchemaGraph:
+    """
+    In-memory copy of the mapped schema: every Table, Column and
+    Relationship, with the relationships indexed by table for join path
+    lookups. Columns and relationships point at the graph's own Table and
+    Column objects, so following them never queries the database.
+    """
+
+    def __init__(self, version):
+        self.version = version
+        self.tables = {table.id: table for table in Table.objects.all()}
+        self.columns = {}
+        for column in Column.objects.all():
+            column.table = self.tables[column.table_id]
+            self.columns[column.id] = column
+
+        self.relationships = []
+        # table id -> [(neighbouring table id, relationship)]
+        self.adjacency = {table_id: [] for table_id in self.tables}
+        for relationship in Relationship.objects.all().order_by('id'):
+            relationship.from_table = self.tables[relationship.from_table_id]
+            relationship.to_table = self.tables[relationship.to_table_id]
+            relationship.from_column = self.columns[relationship.from_column_id]
+            relationship.to_column = self.columns[relationship.to_column_id]
+            self.relationships.append(relationship)
+            self.adjacency[relationship.from_table_id].append((relationship.to_table_id, relationship))
+            self.adjacency[relationship.to_table_id].append((relationship.from_table_id, relationship))
+
+        # (main table id, frozenset of table ids) -> JoinPlan
+        self.join_plans = {}
+
+    def get_table(self, table_id):
+        try:
+            return self.tables[int(table_id)]
+        except KeyError:
+            raise Table.DoesNotExist(f"Table with id {table_id} not found")
+
+    def get_column(self, column_id):
+        try:
+            return self.columns[int(column_id)]
+        except KeyError:
+            raise Column.DoesNotExist(f"Column with id {column_id} not found")
+
+    def get_primary_key(self, table_id):
+        """Return the primary key columns of a table, empty if it has none."""
+        return sorted(
+            (column for column in self.columns.values() if column.table_id == table_id and column.is_primary_key),
+            key=lambda column: column.id,
+        )
+
+    def get_relationship(self, table_id, other_table_id):
+        """Return the first relationship between two tables, in either direction."""
+        for neighbour_id, relationship in self.adjacency.get(table_id, []):
+            if neighbour_id == other_table_id:
+                return relationship
+        return None
+
+    def find_join_path(self, from_table_id, to_table_id):
+        """Return the relationships on a shortest path between two tables, or None."""
+        queue = deque([from_table_id])
+        previous = {from_table_id: None}
+        while queue:
+            table_id = queue.popleft()
+            if table_id == to_table_id:
+                path = []
+                while previous[table_id] is not None:
+                    table_id, relationship = previous[table_id]
+                    path.append(relationship)
+                return path[::-1]
+            for neighbour_id, relationship in self.adjacency.get(table_id, []):
+                if neighbour_id not in previous:
+                    previous[neighbour_id] = (table_id, relationship)
+                    queue.append(neighbour_id)
+        return None
+
+    def plan_joins(self, main_table_id, table_ids):
+        """
+        Return the JoinPlan of a minimal join tree from the main table to the
+        given tables, cached per main table and table set.
+
+        The tree is an approximate Steiner tree (shortest path heuristic):
+        starting from the main table, the table nearest to the tree is
+        repeatedly connected by its cheapest path, so paths the tables share
+        are joined once.
+        """
+        key = (main_table_id, frozenset(table_ids) - {main_table_id})
+        plan = self.join_plans.get(key)
+        if plan is None:
+            plan = self._build_join_plan(*key)
+            self.join_plans[key] = plan
+        return plan
+
+    def _build_join_plan(self, main_table_id, table_ids):
+        in_tree = {main_table_id}
+        tree_edges = []
+        remaining = set(table_ids)
+        cost = 0
+
+        while remaining:
+            # Dijkstra from every table already in the tree
+            distances = {table_id: 0 for table_id in in_tree}
+            previous = {}
+            heap = [(0, table_id) for table_id in in_tree]
+            nearest = None
+            while heap:
+                distance, table_id = heapq.heappop(heap)
+                if distance > distances[table_id]:
+                    continue
+                if table_id in remaining:
+                    nearest = table_id
+                    break
+                for neighbour_id, relationship in self.adjacency.get(table_id, []):
+                    new_distance = distance + relationship_weight(relationship)
+                    if new_distance < distances.get(neighbour_id, math.inf):
+                        distances[neighbour_id] = new_distance
+                        previous[neighbour_id] = (table_id, relationship)
+                        heapq.heappush(heap, (new_distance, neighbour_id))
+
+            if nearest is None:
+                break
+            cost += distances[nearest]
+            table_id = nearest
+            while table_id not in in_tree:
+                parent_id, relationship = previous[table_id]
+                tree_edges.append((parent_id, table_id, relationship))
+                in_tree.add(table_id)
+                table_id = parent_id
+            remaining -= in_tree
+
+        # Join order: breadth-first from the main table along the tree
+        children = {}
+        for parent_id, table_id, relationship in tree_edges:
+            children.setdefault(parent_id, []).append((table_id, relationship))
+        joins = []
+        queue = deque([main_table_id])
+        while queue:
+            for table_id, relationship in children.get(queue.popleft(), []):
+                joins.append((relationship, self.tables[table_id]))
+                queue.append(table_id)
+
+        unreachable = sorted((self.tables[table_id] for table_id in remaining), key=lambda table: table.name)
+        return JoinPlan(self.tables[main_table_id], joins, unreachable, cost)
+
+    def get_related_tables(self, start_table_id, max_depth=4):
+        if start_table_id not in self.tables:
+            raise ValueError(f"Table with id {start_table_id} not found")
+
+        depths = {start_table_id: 0}
+        queue = deque([start_table_id])
+        while queue:
+            table_id = queue.popleft()
+            if depths[table_id] == max_depth:
+                continue
+            for neighbour_id, relationship in self.adjacency[table_id]:
+                if neighbour_id not in depths:
+                    depths[neighbour_id] = depths[table_id] + 1
+                    queue.append(neighbour_id)
+
+        return {self.tables[table_id] for table_id in depths if table_id != start_table_id}
+
+
+_schema_graph = None
+_schema_graph_lock = threading.Lock()
+
+
+def get_schema_version():
+    return SchemaVersion.objects.values_list('version', flat=True).first() or 0
+
+
+def bump_schema_version():
+    """Invalidate the schema graphs cached by every process."""
+    schema_version, created = SchemaVersion.objects.get_or_create(pk=1)
+    SchemaVersion.objects.filter(pk=schema_version.pk).update(version=F('version') + 1)
+
+
+def get_schema_graph():
+    """
+    Return the process-wide schema graph, rebuilding it when the schema
+    version has changed since it was built.
+    """
+    global _schema_graph
+    version = get_schema_version()
+    graph = _schema_graph
+    if graph is not None and graph.version == version:
+        return graph
+
+    with _schema_graph_lock:
+        if _schema_graph is None or _schema_graph.version != version:
+            _schema_graph = SchemaGraph(version)
+            logger.info(f"Built schema graph version {version}: {len(_schema_graph.tables)} tables, {len(_schema_graph.relationships)} relationships")
+        return _schema_graph
 
 
 def get_join_conditions(path):
+    graph = get_schema_graph()
     join_conditions = []
     for i in range(len(path) - 1):
         from_table = path[i]
         to_table = path[i + 1]
-        
-        relationship = Relationship.objects.filter(
-            Q(from_table=from_table, to_table=to_table) |
-            Q(from_table=to_table, to_table=from_table)
-        ).select_related('from_table', 'to_column', 'to_table', 'from_column').first()
+
+        relationship = graph.get_relationship(from_table.id, to_table.id)
 
         if relationship:
             condition = f"{relationship.from_table.name}.{relationship.from_column.name} = {relationship.to_table.name}.{relationship.to_column.name}"
@@ -24,44 +262,9 @@ def get_join_conditions(path):
 def get_all_related_tables(start_table_id, max_depth=4):
     """
     Find all related tables up to a specified depth.
-    
+
     :param start_table_id: The ID of the starting Table
     :param max_depth: Maximum depth of relationships to traverse
     :return: Set of related Table objects
     """
-    # Fetch all tables and relationships upfront
-    all_tables = {table.id: table for table in Table.objects.all()}
-    all_relationships = list(Relationship.objects.all().values('from_table_id', 'to_table_id'))
-    
-    if start_table_id not in all_tables:
-        raise ValueError(f"Table with id {start_table_id} not found")
-
-    start_table = all_tables[start_table_id]
-    visited = set()
-    related_tables = set()
-    tables_to_process = [(start_table_id, 0)]
-    
-    # Create a dictionary to store relationships for quick lookup
-    relationship_dict = {}
-    for rel in all_relationships:
-        from_id, to_id = rel['from_table_id'], rel['to_table_id']
-        relationship_dict.setdefault(from_id, set()).add(to_id)
-        relationship_dict.setdefault(to_id, set()).add(from_id)
-    
-    while tables_to_process:
-        current_table_id, depth = tables_to_process.pop(0)
-        
-        if current_table_id in visited or depth > max_depth:
-            continue
-
-        visited.add(current_table_id)
-        current_table = all_tables[current_table_id]
-        if current_table != start_table:
-            related_tables.add(current_table)
-
-        if depth < max_depth:
-            for related_table_id in relationship_dict.get(current_table_id, []):
-                if related_table_id not in visited:
-                    tables_to_process.append((related_table_id, depth + 1))
-
-    return related_tables
+    return get_schema_graph().get_related_tables(start_table_id, max_depth)
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-19 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0008_schemaversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='row_estimate',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='column',
+            name='is_unique',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 16:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0009_table_row_estimate_column_is_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='column',
+            name='is_primary_key',
+            field=models.BooleanField(default=False),
+        ),
+    ]
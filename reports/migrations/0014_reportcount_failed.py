@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-19 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reports', '0013_alter_exportjob_export_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportcount',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -4,6 +4,7 @@ import json
 class Table(models.Model):
     name = models.CharField(max_length=255, unique=True)
     schema = models.CharField(max_length=255, default='public')
+    row_estimate = models.BigIntegerField(default=0)  # InnoDB estimate when the schema was mapped
 
     def __str__(self):
         return f"{self.schema}.{self.name}"
@@ -12,6 +13,8 @@ class Column(models.Model):
     name = models.CharField(max_length=255)
     table = models.ForeignKey(Table, on_delete=models.CASCADE, related_name='columns')
     data_type = models.CharField(max_length=50)
+    is_unique = models.BooleanField(default=False)  # has a single-column primary key or unique index
+    is_primary_key = models.BooleanField(default=False)  # part of the table's primary key
 
     def __str__(self):
         return f"{self.table.name}.{self.name}"
@@ -25,6 +28,56 @@ class Relationship(models.Model):
     def __str__(self):
         return f"{self.from_table.name}.{self.from_column.name} -> {self.to_table.name}.{self.to_column.name}"
     
+class SchemaVersion(models.Model):
+    # Single row, bumped by map_database_schema so cached schema graphs are rebuilt
+    version = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Schema version {self.version}"
+
+class ReportCount(models.Model):
+    # Total row count of a compiled report query for one version of its source data;
+    # total_count is NULL while the count is running in the background or if it failed
+    key = models.CharField(max_length=64, unique=True)
+    total_count = models.BigIntegerField(null=True, blank=True)
+    failed = models.BooleanField(default=False)  # the background count failed or was lost, it is not retried
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key}: {self.total_count}"
+
+class ExportJob(models.Model):
+    # Report export written to media storage by a scheduler job. key identifies the
+    # report, the version of its source data and the format, so a finished file is
+    # served again until one of the report's tables is imported again
+    EXPORT_TYPE_CHOICES = [
+        ('csv', 'CSV'),
+        ('excel', 'Excel'),
+        ('parquet', 'Parquet'),
+        ('arrow', 'Arrow IPC'),
+    ]
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+    key = models.CharField(max_length=64, unique=True)
+    export_type = models.CharField(max_length=10, choices=EXPORT_TYPE_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    rows_written = models.BigIntegerField(default=0)
+    total_rows = models.BigIntegerField(null=True, blank=True)  # exact or estimated, for progress
+    file = models.CharField(max_length=255, blank=True)  # path relative to MEDIA_ROOT
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.export_type} export {self.key}: {self.status}"
+
 class ReportConfiguration(models.Model):
     name = models.CharField(max_length=255, unique=True)
     configuration = models.TextField()
@@ -1,9 +1,22 @@
-from django.db.models import Q
-from .models import Table, Column, Relationship
-from django.db import connections
+from django.db.models import Q, Max, Sum
+from django.utils import timezone
+from connector.models import Table as ImportedTable
+from connector.transforms import tokenize_sql
+from connector.snapshots import resolve_table_runs
+from scheduler.scheduler import run_once, is_lost, heartbeat
+import MySQLdb
+from MySQLdb.cursors import SSCursor
+from .models import Table, Column, Relationship, ReportCount
+from django.db import connections, DatabaseError
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
 from django.core.paginator import Paginator
-from .graph_processor import get_all_related_tables
+from .graph_processor import get_schema_graph
+import hashlib
+import json
 import logging
+from datetime import timedelta
 import sys 
 
 
@@ -17,21 +30,26 @@ class QueryBuilder:
         logger.debug(f"QueryBuilder initialized with WHERE clause: {self.where_clause}")
         logger.debug(f"QueryBuilder initialized with params: {self.params}")
         self.pagination = pagination
-        self.tables = set(column.table for column in selected_columns)
+        self.graph = get_schema_graph()
+        # Use the graph's columns, whose tables are already loaded
+        self.selected_columns = [self.graph.columns.get(column.id, column) for column in selected_columns]
+        self.tables = set(column.table for column in self.selected_columns)
         self.all_related_tables = self._get_all_related_tables()
         self.main_table = self._identify_main_table(main_table_id)
         self.joined_tables = set([self.main_table.name])
+        # Set when a join can match several rows per main table row
+        self.fans_out = False
 
     def _get_all_related_tables(self):
         all_related_tables = set()
         for table in self.tables:
-            related = get_all_related_tables(table.id)
+            related = self.graph.get_related_tables(table.id)
             logger.debug(f"Related tables for {table.name}: {[t.name for t in related]}")
             all_related_tables.update(related)
         return all_related_tables
 
     def _identify_main_table(self, main_table_id):
-        main_table = Table.objects.get(id=main_table_id)
+        main_table = self.graph.get_table(main_table_id)
         logger.info(f"Using user-selected main table: {main_table.name}")
         return main_table
 
@@ -42,63 +60,24 @@ class QueryBuilder:
 
     def _build_join_clause(self):
         join_clause = ""
-        tables_to_join = self.tables.copy()
-        tables_to_join.remove(self.main_table)
-
-        logger.debug(f"Tables to join: {[t.name for t in tables_to_join]}")
-        for table in tables_to_join:
-            join_path = self._find_join_path(self.main_table, table)
-            logger.debug(f"Join path for {table.name}: {[r.from_table.name + ' -> ' + r.to_table.name for r in join_path] if join_path else 'No path found'}")
-            if join_path:
-                join_clause += self._process_join_path(join_path)
-            else:
-                logger.warning(f"Could not find join path to {table.name}")
-
-        logger.debug(f"Built JOIN clause: {join_clause}")
-        return join_clause
-
-    def _find_join_path(self, from_table, to_table):
-        logger.debug(f"Finding join path from {from_table.name} to {to_table.name}")
-        queue = [(from_table, [])]
-        visited = set()
-
-        while queue:
-            current_table, path = queue.pop(0)
-            if current_table == to_table:
-                logger.debug(f"Path found: {[r.from_table.name + ' -> ' + r.to_table.name for r in path]}")
-                return path
-
-            if current_table in visited:
-                continue
+        plan = self.graph.plan_joins(self.main_table.id, [table.id for table in self.tables])
+        logger.debug(f"Join plan: {plan.to_dict()}")
 
-            visited.add(current_table)
-
-            relationships = Relationship.objects.filter(Q(from_table=current_table) | Q(to_table=current_table))
-            logger.debug(f"Relationships for {current_table.name}: {relationships}")
-            for rel in relationships:
-                next_table = rel.to_table if rel.from_table == current_table else rel.from_table
-                if next_table not in visited:
-                    new_path = path + [rel]
-                    queue.append((next_table, new_path))
+        for relationship, table in plan.joins:
+            if table == relationship.to_table:
+                condition = f"{relationship.from_table.name}.{relationship.from_column.name} = {table.name}.{relationship.to_column.name}"
+            else:
+                condition = f"{relationship.to_table.name}.{relationship.to_column.name} = {table.name}.{relationship.from_column.name}"
+            join_clause += f" LEFT JOIN {table.name} ON {condition}"
+            self.joined_tables.add(table.name)
+            joined_column = relationship.to_column if table == relationship.to_table else relationship.from_column
+            if not joined_column.is_unique:
+                self.fans_out = True
 
-        logger.debug(f"No path found from {from_table.name} to {to_table.name}")
-        return None
+        for table in plan.unreachable:
+            logger.warning(f"Could not find join path to {table.name}")
 
-    def _process_join_path(self, join_path):
-        join_clause = ""
-        for relationship in join_path:
-            from_table = relationship.from_table
-            to_table = relationship.to_table
-            if to_table.name not in self.joined_tables:
-                condition = f"{from_table.name}.{relationship.from_column.name} = {to_table.name}.{relationship.to_column.name}"
-                join_clause += f" LEFT JOIN {to_table.name} ON {condition}"
-                self.joined_tables.add(to_table.name)
-                logger.debug(f"Added join: {join_clause}")
-            elif from_table.name not in self.joined_tables:
-                condition = f"{to_table.name}.{relationship.to_column.name} = {from_table.name}.{relationship.from_column.name}"
-                join_clause += f" LEFT JOIN {from_table.name} ON {condition}"
-                self.joined_tables.add(from_table.name)
-                logger.debug(f"Added join: {join_clause}")
+        logger.debug(f"Built JOIN clause: {join_clause}")
         return join_clause
 
     def _build_where_clause(self):
@@ -116,13 +95,17 @@ class QueryBuilder:
         return where_clause
         '''
     def _build_pagination_clause(self):
-        if not self.pagination:
-            return ""
-        limit = self.pagination.get('limit', 10)
-        offset = self.pagination.get('offset', 0)
-        pagination_clause = f" LIMIT {limit} OFFSET {offset}"
-        logger.debug(f"Built PAGINATION clause: {pagination_clause}")
-        return pagination_clause
+        return build_pagination_clause(self.pagination)
+
+    def get_key_columns(self):
+        """
+        Return the columns identifying each result row, for keyset
+        pagination: the main table's primary key, as long as no join can
+        repeat a main table row. Empty when rows cannot be identified.
+        """
+        if self.fans_out:
+            return []
+        return [f"{self.main_table.name}.{column.name}" for column in self.graph.get_primary_key(self.main_table.id)]
 
     def build_query(self, count_only=False):
         if count_only:
@@ -144,6 +127,15 @@ class QueryBuilder:
         logger.debug(f"Query params: {self.params}")
         return query
 
+def build_pagination_clause(pagination):
+    if not pagination:
+        return ""
+    limit = int(pagination.get('limit', 10))
+    offset = int(pagination.get('offset', 0))
+    pagination_clause = f" LIMIT {limit} OFFSET {offset}"
+    logger.debug(f"Built PAGINATION clause: {pagination_clause}")
+    return pagination_clause
+
 def build_query(selected_columns, main_table_id, where_clause='', params=None, pagination=None, count_only=False):
     query_builder = QueryBuilder(selected_columns, main_table_id, where_clause, params, pagination)
     return query_builder.build_query(count_only)
@@ -157,6 +149,7 @@ def translate_query_builder_rules(rules):
 
     where_clauses = []
     params = []
+    graph = get_schema_graph()
 
     def process_rule(rule):
         if 'condition' in rule:
@@ -169,7 +162,7 @@ def translate_query_builder_rules(rules):
             value = rule['value']
 
             # Get the actual column name and table name
-            column = Column.objects.get(id=column_id)
+            column = graph.get_column(column_id)
             field = f"{column.table.name}.{column.name}"
 
             if operator == 'equal':
@@ -260,22 +253,364 @@ def execute_query(query, params=None):
         return [dict(zip(columns, row)) for row in cursor.fetchall()]
 
 
-def get_paginated_results(selected_columns, main_table_id, where_clause, params, page=1, per_page=10):
-    pagination = {'limit': per_page, 'offset': (page - 1) * per_page}
-    
-    # Get total count
-    count_query = build_query(selected_columns, main_table_id, where_clause, params, count_only=True)
-    total_count = execute_query(count_query, params)
-    
+def get_config_hash(column_ids, main_table_id, filters):
+    configuration = {'columns': [int(column_id) for column_id in column_ids], 'main_table_id': int(main_table_id), 'filters': filters}
+    return hashlib.sha256(json.dumps(configuration, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def compile_query(column_ids, main_table_id, filters):
+    """
+    Return the compiled SQL of a report configuration as a dict with
+    select_sql (without pagination), count_sql and params, plus the parts
+    build_page_query needs. Compiled queries are cached by a hash of the
+    configuration and the schema version, so repeated requests for the same
+    report skip column loading, join planning and filter translation.
+    """
+    graph = get_schema_graph()
+    cache_key = f"reports:compiled_query:{graph.version}:{get_config_hash(column_ids, main_table_id, filters)}"
+    compiled = cache.get(cache_key)
+    if compiled is not None:
+        logger.debug(f"Using cached compiled query {cache_key}")
+        return compiled
+
+    selected_columns = [graph.get_column(column_id) for column_id in column_ids]
+    where_clause, params = translate_query_builder_rules(filters)
+    query_builder = QueryBuilder(selected_columns, main_table_id, where_clause, params)
+    select_clause = query_builder._build_select_clause()
+    from_clause = f" FROM {query_builder.main_table.name}{query_builder._build_join_clause()}"
+    where_sql = query_builder._build_where_clause()
+    compiled = {
+        'cache_key': cache_key,
+        # Tables the query reads, whose imports change its results
+        'tables': sorted(query_builder.joined_tables),
+        'select_sql': f"SELECT {select_clause}{from_clause}{where_sql}",
+        'count_sql': f"SELECT COUNT(*) as total_count{from_clause}{where_sql}",
+        'params': params,
+        'select_clause': select_clause,
+        'from_clause': from_clause,
+        'where_clause': where_clause,
+        # Result column name -> qualified column, for sorting
+        'sort_columns': {column.name: f"{column.table.name}.{column.name}" for column in reversed(query_builder.selected_columns)},
+        'key_columns': query_builder.get_key_columns(),
+    }
+    cache.set(cache_key, compiled, settings.REPORTS_COMPILED_QUERY_SECONDS)
+    return compiled
+
+
+def get_count_key(compiled):
+    """
+    Key of a compiled query's total count for the current data of its
+    tables. It changes whenever one of the tables is imported again. When
+    the tables are unknown (tables is None, e.g. for SQL reports), any
+    import changes it.
+    """
+    if compiled['tables'] is None:
+        data_version = list(map(str, ImportedTable.objects.aggregate(Max('last_import'), Sum('import_run')).values()))
+    else:
+        imports = ImportedTable.objects.filter(table_name__in=compiled['tables']).values_list('table_name', 'last_import', 'import_run')
+        data_version = sorted([table_name, str(last_import), import_run] for table_name, last_import, import_run in imports)
+    return hashlib.sha256(json.dumps([compiled['cache_key'], data_version]).encode('utf-8')).hexdigest()
+
+
+def estimate_result_rows(compiled):
+    """Estimate the rows of a compiled query from MariaDB's EXPLAIN row estimates."""
+    with connections['itam'].cursor() as cursor:
+        cursor.execute(f"EXPLAIN {compiled['select_sql']}", compiled['params'])
+        column_names = [col[0] for col in cursor.description]
+        plan = [dict(zip(column_names, row)) for row in cursor.fetchall()]
+
+    estimate = 1
+    for row in plan:
+        filtered = row.get('filtered')
+        estimate *= (row.get('rows') or 1) * (float(filtered) / 100 if filtered is not None else 1)
+    return int(estimate)
+
+
+def get_count_job_id(count_key):
+    return f'reports_count_{count_key}'
+
+
+def count_rows(count_key, count_sql, params):
+    """
+    Run a report's exact COUNT(*) and store it under count_key. Intended to
+    run as a scheduler job, see schedule_exact_count.
+    """
+    try:
+        with heartbeat(ReportCount.objects.filter(key=count_key)):
+            total_count = execute_query(count_sql, params)
+        ReportCount.objects.filter(key=count_key).update(total_count=total_count)
+        logger.info(f"Exact report count {count_key}: {total_count}")
+    except Exception as e:
+        logger.error(f"Error counting report rows for {count_key}: {str(e)}", exc_info=True)
+        # Kept as failed, so page requests do not schedule the same failing count again
+        ReportCount.objects.filter(key=count_key, total_count=None).update(failed=True)
+    finally:
+        connections.close_all()
+
+
+def schedule_exact_count(compiled, count_key):
+    report_count, created = ReportCount.objects.get_or_create(key=count_key)
+    if created:
+        run_once(count_rows, [count_key, compiled['count_sql'], compiled['params']], get_count_job_id(count_key))
+        logger.info(f"Scheduled background count for report {count_key}")
+
+
+def get_total_count(compiled):
+    """
+    Return (total_count, exact, count_key) for a compiled query. Exact counts
+    are stored per count key, so they are reused until one of the query's
+    tables is imported again. When no count is stored and EXPLAIN estimates
+    at least REPORTS_COUNT_ESTIMATE_ROWS rows, the estimate is returned and
+    the exact count runs in the background; poll it with get_count_status.
+    If that count failed, the estimate is returned from then on.
+    """
+    count_key = get_count_key(compiled)
+    total_count, failed = get_count_status(count_key)
+    if total_count is not None:
+        return total_count, True, count_key
+
+    ReportCount.objects.filter(updated_at__lt=timezone.now() - timedelta(days=settings.REPORTS_COUNT_RETENTION_DAYS)).delete()
+
+    if settings.REPORTS_COUNT_ESTIMATE_ROWS or failed:
+        try:
+            estimate = estimate_result_rows(compiled)
+        except DatabaseError as e:
+            logger.warning(f"Could not estimate report rows: {str(e)}")
+            estimate = 0
+        if failed:
+            return estimate, False, count_key
+        if estimate >= settings.REPORTS_COUNT_ESTIMATE_ROWS:
+            schedule_exact_count(compiled, count_key)
+            return estimate, False, count_key
+
+    total_count = execute_query(compiled['count_sql'], compiled['params'])
+    ReportCount.objects.update_or_create(key=count_key, defaults={'total_count': total_count})
+    return total_count, True, count_key
+
+
+def get_exact_count(count_key):
+    """Return the stored exact count for a count key, or None if it is not (yet) known."""
+    return get_count_status(count_key)[0]
+
+
+def get_count_status(count_key):
+    """
+    Return (total_count, failed) for a count key; total_count is None while
+    it is unknown. A background count lost with its process is marked failed.
+    """
+    report_count = ReportCount.objects.filter(key=count_key).first()
+    if report_count is None:
+        return None, False
+    if report_count.total_count is None and not report_count.failed and is_lost(get_count_job_id(count_key), report_count.updated_at):
+        logger.warning(f"Background count for report {count_key} was lost with its process")
+        ReportCount.objects.filter(key=count_key, total_count=None).update(failed=True)
+        report_count.failed = True
+    return report_count.total_count, report_count.failed
+
+
+def encode_cursor(values):
+    # Values that JSON cannot hold (dates, decimals) compare correctly as strings
+    values = [value if value is None or isinstance(value, (str, int, float)) else str(value) for value in values]
+    return signing.dumps(values, salt='reports.cursor', compress=True)
+
+
+def decode_cursor(token):
+    """Return the sort values of a cursor token; raises signing.BadSignature if it was tampered with."""
+    return signing.loads(token, salt='reports.cursor')
+
+
+def build_keyset_condition(sort_column, key_columns, after, descending=False):
+    """
+    Return the condition and params selecting the rows after `after` (the
+    sort values of the previous page's last row) in the order sort_column,
+    *key_columns. MariaDB sorts NULLs first ascending and last descending.
+    """
+    op = '<' if descending else '>'
+    key_values = list(after[-len(key_columns):])
+    key_condition = f"({', '.join(key_columns)}) {op} ({', '.join(['%s'] * len(key_columns))})"
+    if sort_column is None:
+        return key_condition, key_values
+
+    sort_value = after[0]
+    if sort_value is None:
+        if descending:
+            return f"({sort_column} IS NULL AND {key_condition})", key_values
+        return f"(({sort_column} IS NULL AND {key_condition}) OR {sort_column} IS NOT NULL)", key_values
+
+    null_rows = f" OR {sort_column} IS NULL" if descending else ""
+    condition = f"({sort_column} {op} %s OR ({sort_column} = %s AND {key_condition}){null_rows})"
+    return condition, [sort_value, sort_value] + key_values
+
+
+def build_page_query(compiled, per_page, sort=None, after=None, offset=0):
+    """
+    Return the SQL and params of one page of a compiled query, ordered by the
+    sort column (a result column name) and the key columns. With key columns
+    the page after the row `after` is selected by keyset (seek) pagination,
+    so deep pages cost the same as the first; otherwise, or for the first
+    request of a page without a cursor, by OFFSET. The sort values of each
+    row are returned as hidden __key_<n> columns.
+    """
+    sort = sort or {}
+    sort_column = compiled['sort_columns'].get(sort.get('column'))
+    descending = sort.get('dir') == 'desc'
+    key_columns = compiled['key_columns']
+    order_columns = ([sort_column] if sort_column else []) + key_columns
+
+    select_clause = compiled['select_clause'] + ''.join(f", {column} AS `__key_{i}`" for i, column in enumerate(order_columns))
+    conditions = [f"({compiled['where_clause']})"] if compiled['where_clause'] else []
+    params = list(compiled['params'])
+    if after is not None and key_columns:
+        condition, condition_params = build_keyset_condition(sort_column, key_columns, after, descending)
+        conditions.append(condition)
+        params.extend(condition_params)
+        offset = 0
+
+    query = f"SELECT {select_clause}{compiled['from_clause']}"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if order_columns:
+        query += " ORDER BY " + ", ".join(f"{column}{' DESC' if descending else ''}" for column in order_columns)
+    query += build_pagination_clause({'limit': per_page, 'offset': offset})
+    return query, params
+
+
+def get_paginated_results(column_ids, main_table_id, filters, page=1, per_page=10, sort=None, cursor=None):
+    compiled = compile_query(column_ids, main_table_id, filters)
+
+    # Get total count, or an estimate while it is counted in the background
+    total_count, count_exact, count_key = get_total_count(compiled)
+
     # Get paginated results
-    results_query = build_query(selected_columns, main_table_id, where_clause, params, pagination)
+    after = decode_cursor(cursor) if cursor else None
+    results_query, params = build_page_query(compiled, per_page, sort, after, (page - 1) * per_page)
     results = execute_query(results_query, params)
-    
+
+    # Strip the sort values, keeping the last row's for the next page's cursor
+    last_keys = None
+    for row in results:
+        last_keys = [row.pop(key) for key in [key for key in row if key.startswith('__key_')]]
+    next_cursor = None
+    if compiled['key_columns'] and last_keys is not None and len(results) == per_page:
+        next_cursor = encode_cursor(last_keys)
+
     paginator = Paginator(range(total_count), per_page)
     page_obj = paginator.get_page(page)
-    
+
     return {
         'results': results or [], # Ensure this is always a list
         'total_count': total_count,
         'page_obj': page_obj,
-    }
\ No newline at end of file
+        'next_cursor': next_cursor,
+        'pagination': 'keyset' if compiled['key_columns'] else 'offset',
+        'count_exact': count_exact,
+        'count_key': count_key,
+    }
+
+
+def compile_sql_report(sql_query):
+    """
+    Return a compiled query, as compile_query does, for the SQL of an SQL
+    report. The query is only rewritten when it is a single SELECT: a
+    top-level LIMIT can then be added to it directly, so an ORDER BY keeps
+    working, or it is wrapped as a derived table if it has its own LIMIT.
+    Other statements (SHOW, DESCRIBE...) are run as they are and paged on
+    the client's side of a server-side cursor.
+
+    The user's SQL is run without params, so '%' in it needs no escaping.
+    References to earlier runs of imported tables (devices@41) are replaced
+    with their snapshot tables.
+    """
+    sql_query = resolve_table_runs(sql_query.strip().rstrip(';').strip())
+    depth = 0
+    words = []
+    for kind, text in tokenize_sql(sql_query):
+        if kind != 'code':
+            continue
+        for part in text.replace('(', ' ( ').replace(')', ' ) ').split():
+            if part == '(':
+                depth += 1
+            elif part == ')':
+                depth -= 1
+            elif depth == 0:
+                words.append(part.upper())
+
+    is_select = bool(words) and words[0] in ('SELECT', 'WITH')
+    return {
+        'cache_key': hashlib.sha256(sql_query.encode('utf-8')).hexdigest(),
+        'tables': None,
+        'select_sql': sql_query,
+        'count_sql': f"SELECT COUNT(*) FROM ({sql_query}) AS report_query" if is_select else None,
+        'params': None,
+        'limit_allowed': is_select and 'LIMIT' not in words,
+        'wrap': is_select and 'LIMIT' in words,
+    }
+
+
+def fetch_page(query, limit, offset=0):
+    """
+    Run a query on an unbuffered server-side cursor and return the column
+    names, the rows offset to offset + limit and the total number of rows.
+    Rows outside the page are discarded as they arrive, so at most one page
+    is held in memory.
+    """
+    connection = connections['itam']
+    connection.ensure_connection()
+    cursor = connection.connection.cursor(SSCursor)
+    try:
+        cursor.execute(query)
+        columns = [col[0] for col in cursor.description]
+        total_count = 0
+        while total_count < offset:
+            skipped = cursor.fetchmany(min(offset - total_count, 10000))
+            if not skipped:
+                break
+            total_count += len(skipped)
+        rows = cursor.fetchmany(limit)
+        total_count += len(rows)
+        while True:
+            remaining = cursor.fetchmany(10000)
+            if not remaining:
+                break
+            total_count += len(remaining)
+    finally:
+        cursor.close()
+    return columns, rows, total_count
+
+
+def get_sql_report_page(sql_query, page=1, per_page=10):
+    """
+    Return one page of an SQL report with its total count, see
+    get_paginated_results. A query that fails as a derived table (e.g. a
+    SELECT * over a join, whose duplicate column names a derived table
+    cannot have) is paged and counted while streaming it unwrapped, as
+    other statements are.
+    """
+    compiled = compile_sql_report(sql_query)
+    per_page = int(per_page)
+    offset = (int(page) - 1) * per_page
+    unwrappable_key = f"reports:sql_unwrappable:{compiled['cache_key']}"
+
+    count_exact, count_key = True, None
+    if compiled['count_sql'] and not cache.get(unwrappable_key):
+        try:
+            if compiled['limit_allowed']:
+                columns, rows, _ = fetch_page(f"{compiled['select_sql']} LIMIT {per_page} OFFSET {offset}", per_page)
+            else:
+                columns, rows, _ = fetch_page(f"SELECT * FROM ({compiled['select_sql']}) AS report_query LIMIT {per_page} OFFSET {offset}", per_page)
+            total_count, count_exact, count_key = get_total_count(compiled)
+        except (DatabaseError, MySQLdb.Error) as e:
+            logger.warning(f"SQL report cannot be paged as a derived table, streaming it instead: {str(e)}")
+            cache.set(unwrappable_key, True, settings.REPORTS_COMPILED_QUERY_SECONDS)
+            count_exact, count_key = True, None
+            columns, rows, total_count = fetch_page(compiled['select_sql'], per_page, offset)
+    else:
+        # Statements that cannot be paged or counted in SQL are counted while streaming
+        columns, rows, total_count = fetch_page(compiled['select_sql'], per_page, offset)
+
+    return {
+        'results': [dict(zip(columns, row)) for row in rows],
+        'total_count': total_count,
+        'count_exact': count_exact,
+        'count_key': count_key,
+    }
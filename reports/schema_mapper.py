@@ -1,9 +1,16 @@
 from django.db import connections, transaction
 from .models import Table, Column, Relationship
+from .graph_processor import bump_schema_version
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Names of the importer's internal tables in the itam database: staging and
+# replaced tables, dictionary encoded tables and their dictionaries, change
+# tables, table format snapshots, transform row hashes and import checkpoints.
+# Other tables, even ones starting with "_", are user tables
+INTERNAL_TABLE_PATTERN = r'^_(staging|old|enc|dict|changes|rowhash|newhash|changed)_|^_snap[0-9]+_|^_import_checkpoints$'
+
 def map_database_schema():
     try:
         with transaction.atomic():
@@ -13,26 +20,44 @@ def map_database_schema():
                 Column.objects.all().delete()
                 Relationship.objects.all().delete()
 
-                # Get all tables
+                # Get all tables, skipping the importer's internal tables
                 cursor.execute("""
-                    SELECT TABLE_NAME, TABLE_SCHEMA
+                    SELECT TABLE_NAME, TABLE_SCHEMA, TABLE_ROWS
                     FROM INFORMATION_SCHEMA.TABLES
-                    WHERE TABLE_SCHEMA = DATABASE()
-                """)
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME NOT REGEXP %s
+                """, [INTERNAL_TABLE_PATTERN])
                 tables = cursor.fetchall()
 
                 table_objects = []
                 column_objects = []
                 relationship_objects = []
 
-                for table_name, schema in tables:
-                    table = Table(name=table_name, schema=schema)
+                for table_name, schema, row_estimate in tables:
+                    table = Table(name=table_name, schema=schema, row_estimate=row_estimate or 0)
                     table_objects.append(table)
 
                 Table.objects.bulk_create(table_objects)
                 table_dict = {table.name: table for table in Table.objects.all()}
 
-                for table_name, schema in tables:
+                # Columns with a single-column primary key or unique index,
+                # which the join planner prefers to join on
+                cursor.execute("""
+                    SELECT TABLE_NAME, MIN(COLUMN_NAME)
+                    FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND NON_UNIQUE = 0
+                    GROUP BY TABLE_NAME, INDEX_NAME
+                    HAVING COUNT(*) = 1
+                """)
+                unique_columns = set(cursor.fetchall())
+
+                cursor.execute("""
+                    SELECT TABLE_NAME, COLUMN_NAME
+                    FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND INDEX_NAME = 'PRIMARY'
+                """)
+                primary_key_columns = set(cursor.fetchall())
+
+                for table_name, schema, row_estimate in tables:
                     # Get columns for each table
                     cursor.execute("""
                         SELECT COLUMN_NAME, DATA_TYPE
@@ -42,7 +67,13 @@ def map_database_schema():
                     columns = cursor.fetchall()
 
                     for column_name, data_type in columns:
-                        column = Column(name=column_name, table=table_dict[table_name], data_type=data_type)
+                        column = Column(
+                            name=column_name,
+                            table=table_dict[table_name],
+                            data_type=data_type,
+                            is_unique=(table_name, column_name) in unique_columns,
+                            is_primary_key=(table_name, column_name) in primary_key_columns,
+                        )
                         column_objects.append(column)
 
                 Column.objects.bulk_create(column_objects)
@@ -79,6 +110,7 @@ def map_database_schema():
                     relationship_objects.append(relationship)
 
                 Relationship.objects.bulk_create(relationship_objects)
+                bump_schema_version()
 
         logger.info("Database schema mapping completed successfully.")
     except Exception as e:
@@ -1,3 +1,256 @@
-from django.test import TestCase
+import io
+import re
+import openpyxl
+from datetime import date, timedelta
+from decimal import Decimal
+from unittest import mock
+from django.core import signing
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
 
-# Create your tests here.
+from scheduler.scheduler import STALE_SECONDS
+from .models import Table, Column, Relationship, ReportCount, ExportJob
+from .exports import fail_lost_export, get_export_key, queue_export, write_xlsx, spool_xlsx
+from .schema_mapper import INTERNAL_TABLE_PATTERN
+from .graph_processor import SchemaGraph
+from .query_builder import build_keyset_condition, encode_cursor, decode_cursor, get_count_status
+
+
+class CursorTests(SimpleTestCase):
+    def test_round_trip_keeps_nulls(self):
+        values = [None, 'abc', 3, 1.5]
+        self.assertEqual(decode_cursor(encode_cursor(values)), values)
+
+    def test_non_json_values_are_encoded_as_strings(self):
+        token = encode_cursor([date(2024, 5, 1), Decimal('10.50'), None])
+        self.assertEqual(decode_cursor(token), ['2024-05-01', '10.50', None])
+
+    def test_tampered_cursor_is_rejected(self):
+        token = encode_cursor([1, 2])
+        with self.assertRaises(signing.BadSignature):
+            decode_cursor(token[:-1] + ('A' if token[-1] != 'A' else 'B'))
+
+
+class KeysetConditionTests(SimpleTestCase):
+    def test_key_columns_only(self):
+        condition, params = build_keyset_condition(None, ['d.id'], [42])
+        self.assertEqual(condition, "(d.id) > (%s)")
+        self.assertEqual(params, [42])
+
+    def test_composite_key_descending(self):
+        condition, params = build_keyset_condition(None, ['d.site', 'd.id'], ['ams', 7], descending=True)
+        self.assertEqual(condition, "(d.site, d.id) < (%s, %s)")
+        self.assertEqual(params, ['ams', 7])
+
+    def test_sort_value(self):
+        condition, params = build_keyset_condition('d.name', ['d.id'], ['host1', 5])
+        self.assertEqual(condition, "(d.name > %s OR (d.name = %s AND (d.id) > (%s)))")
+        self.assertEqual(params, ['host1', 'host1', 5])
+
+    def test_sort_value_descending_includes_null_rows(self):
+        # NULLs sort last descending, so they all follow a non-NULL value
+        condition, params = build_keyset_condition('d.name', ['d.id'], ['host1', 5], descending=True)
+        self.assertEqual(condition, "(d.name < %s OR (d.name = %s AND (d.id) < (%s)) OR d.name IS NULL)")
+        self.assertEqual(params, ['host1', 'host1', 5])
+
+    def test_null_sort_value_ascending(self):
+        # NULLs sort first ascending: the remaining NULL rows, then every non-NULL row
+        condition, params = build_keyset_condition('d.name', ['d.id'], [None, 5])
+        self.assertEqual(condition, "((d.name IS NULL AND (d.id) > (%s)) OR d.name IS NOT NULL)")
+        self.assertEqual(params, [5])
+
+    def test_null_sort_value_descending(self):
+        condition, params = build_keyset_condition('d.name', ['d.id'], [None, 5], descending=True)
+        self.assertEqual(condition, "(d.name IS NULL AND (d.id) < (%s))")
+        self.assertEqual(params, [5])
+
+    def test_decoded_cursor_builds_condition(self):
+        after = decode_cursor(encode_cursor([None, 5]))
+        self.assertEqual(build_keyset_condition('d.name', ['d.id'], after)[1], [5])
+
+
+class JoinPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # devices -> installations -> software, and a cheaper path
+        # devices -> catalog -> software through small tables
+        cls.devices = Table.objects.create(name='devices', row_estimate=1000)
+        cls.installations = Table.objects.create(name='installations', row_estimate=100000)
+        cls.software = Table.objects.create(name='software', row_estimate=500)
+        cls.catalog = Table.objects.create(name='catalog', row_estimate=10)
+        cls.orphans = Table.objects.create(name='orphans', row_estimate=10)
+
+        def column(table, name, is_unique=False):
+            return Column.objects.create(table=table, name=name, data_type='int', is_unique=is_unique, is_primary_key=is_unique)
+
+        def relate(from_column, to_column):
+            return Relationship.objects.create(
+                from_table=from_column.table, from_column=from_column,
+                to_table=to_column.table, to_column=to_column,
+            )
+
+        device_id = column(cls.devices, 'id', is_unique=True)
+        software_id = column(cls.software, 'id', is_unique=True)
+        catalog_id = column(cls.catalog, 'id', is_unique=True)
+        column(cls.orphans, 'id', is_unique=True)
+        relate(column(cls.installations, 'device_id'), device_id)
+        relate(column(cls.installations, 'software_id'), software_id)
+        relate(column(cls.devices, 'catalog_id'), catalog_id)
+        relate(column(cls.catalog, 'software_id'), software_id)
+
+    def plan(self, *tables):
+        return SchemaGraph(version=1).plan_joins(self.devices.id, {table.id for table in tables})
+
+    def joined_tables(self, plan):
+        return [table.name for relationship, table in plan.joins]
+
+    def test_cheapest_path(self):
+        plan = self.plan(self.software)
+        self.assertEqual(self.joined_tables(plan), ['catalog', 'software'])
+        self.assertEqual(plan.unreachable, [])
+
+    def test_shared_path_is_joined_once(self):
+        # Once installations is joined, software is one join away from the tree
+        plan = self.plan(self.installations, self.software)
+        self.assertEqual(self.joined_tables(plan), ['installations', 'software'])
+        self.assertEqual(plan.joins[1][0].from_table.name, 'installations')
+
+    def test_unreachable_tables(self):
+        plan = self.plan(self.software, self.orphans)
+        self.assertEqual(self.joined_tables(plan), ['catalog', 'software'])
+        self.assertEqual([table.name for table in plan.unreachable], ['orphans'])
+
+    def test_main_table_only(self):
+        plan = self.plan(self.devices)
+        self.assertEqual(plan.joins, [])
+        self.assertEqual(plan.cost, 0)
+
+    def test_plans_are_cached(self):
+        graph = SchemaGraph(version=1)
+        plan = graph.plan_joins(self.devices.id, [self.software.id])
+        self.assertIs(graph.plan_joins(self.devices.id, {self.software.id, self.devices.id}), plan)
+
+
+class CountStatusTests(TestCase):
+    def setUp(self):
+        ReportCount.objects.create(key='report')
+
+    def age(self, seconds):
+        ReportCount.objects.filter(key='report').update(updated_at=timezone.now() - timedelta(seconds=seconds))
+
+    @mock.patch('scheduler.scheduler.is_queued', return_value=False)
+    def test_running_count_is_pending(self, is_queued):
+        self.assertEqual(get_count_status('report'), (None, False))
+
+    @mock.patch('scheduler.scheduler.is_queued', return_value=True)
+    def test_queued_count_is_pending(self, is_queued):
+        self.age(STALE_SECONDS + 60)
+        self.assertEqual(get_count_status('report'), (None, False))
+
+    @mock.patch('scheduler.scheduler.is_queued', return_value=False)
+    def test_lost_count_is_failed(self, is_queued):
+        self.age(STALE_SECONDS + 60)
+        self.assertEqual(get_count_status('report'), (None, True))
+        self.assertTrue(ReportCount.objects.get(key='report').failed)
+
+    def test_unknown_key(self):
+        self.assertEqual(get_count_status('other'), (None, False))
+
+
+class LostExportTests(TestCase):
+    def setUp(self):
+        self.job = ExportJob.objects.create(key='report', export_type='csv', status='running')
+        ExportJob.objects.filter(id=self.job.id).update(updated_at=timezone.now() - timedelta(seconds=STALE_SECONDS + 60))
+        self.job.refresh_from_db()
+
+    @mock.patch('scheduler.scheduler.is_queued', return_value=False)
+    def test_lost_export_is_failed(self, is_queued):
+        self.assertTrue(fail_lost_export(self.job))
+        self.assertEqual(ExportJob.objects.get(id=self.job.id).status, 'failed')
+
+    @mock.patch('scheduler.scheduler.is_queued', return_value=True)
+    def test_queued_export_is_kept(self, is_queued):
+        self.assertFalse(fail_lost_export(self.job))
+        self.assertEqual(ExportJob.objects.get(id=self.job.id).status, 'running')
+
+    @mock.patch('scheduler.scheduler.is_queued', return_value=False)
+    def test_completed_export_is_kept(self, is_queued):
+        ExportJob.objects.filter(id=self.job.id).update(status='completed')
+        self.job.refresh_from_db()
+        self.assertFalse(fail_lost_export(self.job))
+
+
+class InternalTableTests(SimpleTestCase):
+    def test_internal_tables(self):
+        for table_name in ('_staging_devices', '_old_devices', '_enc_devices', '_dict_devices_os', '_changes_devices',
+                           '_snap41_devices', '_rowhash_devices', '_newhash_devices', '_changed_devices', '_import_checkpoints'):
+            self.assertRegex(table_name, INTERNAL_TABLE_PATTERN)
+
+    def test_user_tables_starting_with_underscore(self):
+        for table_name in ('_devices', '_snapshots', '_import_checkpoints_archive', 'devices'):
+            self.assertIsNone(re.search(INTERNAL_TABLE_PATTERN, table_name))
+
+
+class ExportKeyTests(SimpleTestCase):
+    def test_compression_only_matters_for_parquet(self):
+        self.assertNotEqual(get_export_key('count', 'parquet', compression='zstd'), get_export_key('count', 'parquet', compression='snappy'))
+        self.assertEqual(get_export_key('count', 'csv', compression='zstd'), get_export_key('count', 'csv', compression='snappy'))
+
+    def test_report_data_and_columns(self):
+        key = get_export_key('count', 'csv', header=['id', 'name'])
+        self.assertNotEqual(key, get_export_key('other count', 'csv', header=['id', 'name']))
+        self.assertNotEqual(key, get_export_key('count', 'excel', header=['id', 'name']))
+        self.assertNotEqual(key, get_export_key('count', 'csv', header=['name', 'id']))
+        self.assertNotEqual(key, get_export_key('count', 'csv', column_order=['id', 'name']))
+
+
+@mock.patch('reports.exports.get_exact_count', return_value=10)
+@mock.patch('reports.exports.get_count_key', return_value='count')
+@mock.patch('reports.exports.run_once')
+class QueueExportTests(TestCase):
+    compiled = {'select_sql': 'SELECT id FROM devices', 'params': [], 'count_sql': None}
+
+    def test_same_export_is_queued_once(self, run_once, get_count_key, get_exact_count):
+        job = queue_export(self.compiled, 'parquet', header=['id'])
+        self.assertEqual(queue_export(self.compiled, 'parquet', header=['id']), job)
+        run_once.assert_called_once()
+        self.assertEqual(run_once.call_args[0][1], [job.id, 'SELECT id FROM devices', [], ['id'], None, 'zstd'])
+
+    def test_other_compression_is_another_export(self, run_once, get_count_key, get_exact_count):
+        zstd_job = queue_export(self.compiled, 'parquet', header=['id'])
+        snappy_job = queue_export(self.compiled, 'parquet', header=['id'], compression='snappy')
+        self.assertNotEqual(snappy_job, zstd_job)
+        self.assertEqual(run_once.call_args[0][1][-1], 'snappy')
+
+    def test_completed_export_without_file_is_queued_again(self, run_once, get_count_key, get_exact_count):
+        job = queue_export(self.compiled, 'csv', header=['id'])
+        ExportJob.objects.filter(id=job.id).update(status='completed')
+        self.assertNotEqual(queue_export(self.compiled, 'csv', header=['id']).id, job.id)
+        self.assertEqual(run_once.call_count, 2)
+
+
+@mock.patch('reports.exports.EXCEL_MAX_ROWS', 3)
+class ExcelSheetTests(SimpleTestCase):
+    def sheets(self, file):
+        workbook = openpyxl.load_workbook(file, read_only=True)
+        return {sheet.title: [list(row) for row in sheet.iter_rows(values_only=True)] for sheet in workbook.worksheets}
+
+    def test_rows_are_split_over_sheets(self):
+        file = io.BytesIO()
+        batches = iter([[(1, 'a'), (2, 'b'), (3, 'c')], [(4, 'd'), (5, 'e')]])
+        self.assertEqual(write_xlsx(['id', 'name'], batches, file), 5)
+        # Every sheet repeats the header and holds at most EXCEL_MAX_ROWS rows with it
+        self.assertEqual(self.sheets(file), {
+            'Report': [['id', 'name'], [1, 'a'], [2, 'b']],
+            'Report 2': [['id', 'name'], [3, 'c'], [4, 'd']],
+            'Report 3': [['id', 'name'], [5, 'e']],
+        })
+
+    def test_full_last_sheet_adds_no_empty_sheet(self):
+        file = io.BytesIO()
+        write_xlsx(['id'], iter([[(1,), (2,)]]), file)
+        self.assertEqual(self.sheets(file), {'Report': [['id'], [1], [2]]})
+
+    def test_no_rows(self):
+        spool = spool_xlsx(['id', 'name'], iter([]))
+        self.assertEqual(self.sheets(spool), {'Report': [['id', 'name']]})
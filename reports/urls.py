@@ -9,11 +9,17 @@ urlpatterns = [
     path('get_tables/', views.get_tables, name='get_tables'),
     path('get_columns/<int:table_id>/', views.get_columns, name='get_columns'),
     path('get_related_tables/<int:table_id>/', views.get_related_tables, name='get_related_tables'),
+    path('join_plan/', views.get_join_plan, name='join_plan'),
     path('generate_report/', views.generate_report, name='generate_report'),
+    path('report_count/', views.get_report_count, name='report_count'),
     path('generate_report_sql/', views.generate_report_sql, name='generate_report_sql'),
     path('get_filter_options/', views.get_filter_options, name='get_filter_options'),
     path('export_report/', views.export_report, name='export_report'),
     path('export_report_sql/', views.export_report_sql, name='export_report_sql'),
+    path('queue_export_report/', views.queue_export_report, name='queue_export_report'),
+    path('queue_export_report_sql/', views.queue_export_report_sql, name='queue_export_report_sql'),
+    path('export_job/<int:job_id>/', views.get_export_job, name='export_job'),
+    path('download_export/<int:job_id>/', views.download_export, name='download_export'),
     path('save-configuration/', views.save_configuration, name='save_configuration'),
     path('get-configurations/', views.get_configurations, name='get_configurations'),
     path('load-configuration/<int:config_id>/', views.load_configuration, name='load_configuration'),
@@ -1,17 +1,22 @@
 from django.core.paginator import Paginator
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse, FileResponse
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.db import connections, DatabaseError
-from .models import Table, Column, Relationship, ReportConfiguration
-from .graph_processor import get_all_related_tables
-from .query_builder import build_query, get_paginated_results, translate_query_builder_rules, execute_query
+from django.core.signing import BadSignature
+from django.conf import settings
+from django.urls import reverse
+from .models import Table, Column, Relationship, ReportConfiguration, ExportJob
+from .graph_processor import get_all_related_tables, get_schema_graph
+from .exports import order_columns, select_columns, stream_csv, spool_xlsx, queue_export, fail_lost_export, EXPORT_EXTENSIONS, EXPORT_CONTENT_TYPES
+from connector.writers import open_query_stream, stream_arrow, PARQUET_COMPRESSIONS
+from connector.snapshots import resolve_table_runs
+from .query_builder import compile_query, compile_sql_report, get_paginated_results, get_sql_report_page, get_count_status
 from datetime import datetime, date
+import os
 import json
 import logging
-import csv
-import openpyxl
 
 
 logger = logging.getLogger(__name__)
@@ -126,6 +131,30 @@ def get_related_tables(request, table_id):
         return JsonResponse({'error': 'An error occurred while fetching related tables'}, status=500)
     
 
+@require_http_methods(["GET"])
+def get_join_plan(request):
+    """
+    Debug view: the join tree the query builder uses for a main table and a
+    set of tables, e.g. ?main_table_id=1&table_ids=2,3
+    """
+    try:
+        main_table_id = int(request.GET['main_table_id'])
+        table_ids = [int(table_id) for table_id in request.GET.get('table_ids', '').split(',') if table_id.strip()]
+        graph = get_schema_graph()
+        graph.get_table(main_table_id)
+        for table_id in table_ids:
+            graph.get_table(table_id)
+        plan = graph.plan_joins(main_table_id, table_ids)
+        return JsonResponse({'schema_version': graph.version, **plan.to_dict()})
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'main_table_id and a comma separated list of table_ids are required'}, status=400)
+    except Table.DoesNotExist as e:
+        return JsonResponse({'error': str(e)}, status=404)
+    except Exception as e:
+        logger.error(f"Error planning joins: {str(e)}")
+        return JsonResponse({'error': 'An error occurred while planning joins'}, status=500)
+
+
 @require_http_methods(["POST"])
 @csrf_exempt
 def generate_report(request):
@@ -138,6 +167,10 @@ def generate_report(request):
         
         page = data.get('page', 1)
         per_page = data.get('per_page', 10)
+        # Result column name and direction, e.g. {'column': 'hostname', 'dir': 'asc'}
+        sort = data.get('sort')
+        # Cursor token of the requested page, returned as next_cursor with the page before it
+        cursor = data.get('cursor')
 
         logger.debug(f"Received filters: {filters}")
 
@@ -147,14 +180,11 @@ def generate_report(request):
         if not main_table_id:
             return JsonResponse({'error': 'No main table selected'}, status=400)
 
-        selected_columns = Column.objects.filter(id__in=selected_column_ids)
-
         try:
-            where_clause, params = translate_query_builder_rules(filters)
-            logger.debug(f"Generated WHERE clause: {where_clause}")
-            logger.debug(f"Generated params: {params}")
-            paginated_results = get_paginated_results(selected_columns, main_table_id, where_clause, params, page, per_page)
-        except ValueError as e:
+            paginated_results = get_paginated_results(selected_column_ids, main_table_id, filters, page, per_page, sort, cursor)
+        except BadSignature:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+        except (ValueError, Column.DoesNotExist, Table.DoesNotExist) as e:
             return JsonResponse({'error': str(e)}, status=400)
         except Exception as e:
             logger.error(f"Error generating report: {str(e)}")
@@ -167,6 +197,10 @@ def generate_report(request):
             'num_pages': paginated_results['page_obj'].paginator.num_pages,
             'has_next': paginated_results['page_obj'].has_next(),
             'has_previous': paginated_results['page_obj'].has_previous(),
+            'next_cursor': paginated_results['next_cursor'],
+            'pagination': paginated_results['pagination'],
+            'count_exact': paginated_results['count_exact'],
+            'count_key': paginated_results['count_key'],
         })
     except json.JSONDecodeError:
         return JsonResponse({'error': 'Invalid JSON in request body'}, status=400)
@@ -175,6 +209,13 @@ def generate_report(request):
         return JsonResponse({'error': f'Unexpected error: {str(e)}'}, status=500)
     
 
+@require_http_methods(["GET"])
+def get_report_count(request):
+    """Poll for the exact count of a report that generate_report returned an estimate for."""
+    total_count, failed = get_count_status(request.GET.get('key', ''))
+    return JsonResponse({'ready': total_count is not None, 'failed': failed, 'total_count': total_count})
+
+
 @csrf_exempt    
 def generate_report_sql(request):
     if request.method == 'POST':
@@ -184,22 +225,8 @@ def generate_report_sql(request):
         per_page = data.get('per_page', 10)
 
         try:
-            with connections['itam'].cursor() as cursor:
-                cursor.execute(sql_query)
-                columns = [col[0] for col in cursor.description]
-                rows = cursor.fetchall()
-
-            total_count = len(rows)
-            start = (page - 1) * per_page
-            end = start + per_page
-            paginated_rows = rows[start:end]
-
-            results = [dict(zip(columns, row)) for row in paginated_rows]
-
-            return JsonResponse({
-                'results': results,
-                'total_count': total_count
-            })
+            page_results = get_sql_report_page(sql_query, page, per_page)
+            return JsonResponse(page_results)
         except Exception as e:
             return JsonResponse({'error': str(e)}, status=400)
 
@@ -216,6 +243,44 @@ def get_filter_options(request):
         return JsonResponse({'error': 'An error occurred while fetching filter options'}, status=500)
     
 
+def get_ordered_columns(selected_column_ids, column_order):
+    """Return the selected Columns in the order of the column names in column_order."""
+    # Get selected columns
+    selected_columns = list(Column.objects.filter(id__in=selected_column_ids))
+
+    # Create a dictionary mapping column names to Column objects
+    column_dict = {col.name: col for col in selected_columns}
+
+    # Sort columns based on the received order
+    ordered_columns = [column_dict[col_name] for col_name in column_order if col_name in column_dict]
+
+    # Add any columns that were selected but not in the order (shouldn't happen, but just in case)
+    ordered_columns.extend([col for col in selected_columns if col not in ordered_columns])
+    return ordered_columns
+
+
+def get_export_response(export_type, header, batches, fields, compression):
+    filename = f'report_export.{EXPORT_EXTENSIONS[export_type]}'
+    if export_type == 'excel':
+        # Written in constant memory, then streamed from the spooled file
+        return FileResponse(
+            spool_xlsx(header, batches),
+            as_attachment=True,
+            filename=filename,
+            content_type=EXPORT_CONTENT_TYPES[export_type],
+        )
+
+    # Rows are written as they arrive from the server
+    if export_type == 'csv':
+        content = stream_csv(header, batches)
+    else:
+        # Parquet and Arrow IPC are typed from the cursor description
+        content = stream_arrow(export_type, header, fields, batches, compression)
+    response = StreamingHttpResponse(content, content_type=EXPORT_CONTENT_TYPES[export_type])
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
 @require_http_methods(["POST"])
 @csrf_exempt
 def export_report(request):
@@ -226,6 +291,8 @@ def export_report(request):
         export_type = data.get('export_type', 'csv')
         column_order = data.get('column_order', [])
         filters = data.get('filters')  # Add this line to get the filters
+        # Parquet compression codec
+        compression = data.get('compression', PARQUET_COMPRESSIONS[0])
 
         if not selected_column_ids:
             return JsonResponse({'error': 'No columns selected'}, status=400)
@@ -233,47 +300,22 @@ def export_report(request):
         if not main_table_id:
             return JsonResponse({'error': 'No main table selected'}, status=400)
 
-        # Get selected columns
-        selected_columns = list(Column.objects.filter(id__in=selected_column_ids))
-
-        # Create a dictionary mapping column names to Column objects
-        column_dict = {col.name: col for col in selected_columns}
-
-        # Sort columns based on the received order
-        ordered_columns = [column_dict[col_name] for col_name in column_order if col_name in column_dict]
-
-        # Add any columns that were selected but not in the order (shouldn't happen, but just in case)
-        ordered_columns.extend([col for col in selected_columns if col not in ordered_columns])
-
-        # Translate the filters to a WHERE clause and params
-        where_clause, params = translate_query_builder_rules(filters)
-
-        # Build the query with filters
-        query = build_query(ordered_columns, main_table_id, where_clause=where_clause)
-
-        # Execute the query with filters
-        results = execute_query(query, params)
-
-        if export_type == 'csv':
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = 'attachment; filename="report_export.csv"'
-            writer = csv.writer(response)
-            writer.writerow([col.name for col in ordered_columns])
-            for row in results:
-                writer.writerow([row.get(col.name, '') for col in ordered_columns])
-        elif export_type == 'excel':
-            workbook = openpyxl.Workbook()
-            worksheet = workbook.active
-            worksheet.append([col.name for col in ordered_columns])
-            for row in results:
-                worksheet.append([row.get(col.name, '') for col in ordered_columns])
-            response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename="report_export.xlsx"'
-            workbook.save(response)
-        else:
+        if export_type not in EXPORT_EXTENSIONS:
             return JsonResponse({'error': 'Invalid export type'}, status=400)
 
-        return response
+        if compression not in PARQUET_COMPRESSIONS:
+            return JsonResponse({'error': 'Invalid compression'}, status=400)
+
+        ordered_columns = get_ordered_columns(selected_column_ids, column_order)
+
+        # Build the query with filters; it selects the columns in export order
+        compiled = compile_query([col.id for col in ordered_columns], main_table_id, filters)
+
+        # Execute the query with filters on a server-side cursor
+        columns, batches, fields = open_query_stream(compiled['select_sql'], compiled['params'])
+        header = [col.name for col in ordered_columns]
+
+        return get_export_response(export_type, header, batches, fields, compression)
     except Exception as e:
         logger.error(f"Unexpected error in export_report: {str(e)}")
         return JsonResponse({'error': f'Unexpected error: {str(e)}'}, status=500)
@@ -288,49 +330,145 @@ def export_report_sql(request):
         sql_query = data.get('sql_query')
         export_type = data.get('export_type', 'csv')
         column_order = data.get('column_order', [])
+        # Parquet compression codec
+        compression = data.get('compression', PARQUET_COMPRESSIONS[0])
 
         if not sql_query:
             return JsonResponse({'error': 'SQL query is required'}, status=400)
 
-        # Execute the SQL query
-        with connections['itam'].cursor() as cursor:
-            cursor.execute(sql_query)
-            columns = [col[0] for col in cursor.description]
-            results = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        if export_type not in EXPORT_EXTENSIONS:
+            return JsonResponse({'error': 'Invalid export type'}, status=400)
+
+        if compression not in PARQUET_COMPRESSIONS:
+            return JsonResponse({'error': 'Invalid compression'}, status=400)
+
+        # Execute the SQL query on a server-side cursor
+        columns, batches, fields = open_query_stream(resolve_table_runs(sql_query))
 
         # If column_order is provided, use it to order the columns
-        if column_order:
-            ordered_columns = [col for col in column_order if col in columns]
-            # Add any columns that were in the query but not in the order
-            ordered_columns.extend([col for col in columns if col not in ordered_columns])
-        else:
-            ordered_columns = columns
-
-        if export_type == 'csv':
-            response = HttpResponse(content_type='text/csv')
-            response['Content-Disposition'] = 'attachment; filename="report_export.csv"'
-            writer = csv.writer(response)
-            writer.writerow(ordered_columns)
-            for row in results:
-                writer.writerow([row.get(col, '') for col in ordered_columns])
-        elif export_type == 'excel':
-            workbook = openpyxl.Workbook()
-            worksheet = workbook.active
-            worksheet.append(ordered_columns)
-            for row in results:
-                worksheet.append([row.get(col, '') for col in ordered_columns])
-            response = HttpResponse(content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
-            response['Content-Disposition'] = 'attachment; filename="report_export.xlsx"'
-            workbook.save(response)
-        else:
-            return JsonResponse({'error': 'Invalid export type'}, status=400)
+        ordered_columns = order_columns(columns, column_order)
+        if ordered_columns != columns:
+            indexes = [columns.index(col) for col in ordered_columns]
+            batches = select_columns(batches, indexes)
+            fields = [fields[i] for i in indexes]
 
-        return response
+        return get_export_response(export_type, ordered_columns, batches, fields, compression)
+    except ValueError as e:
+        # e.g. a table@run reference that cannot be queried
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
         logger.error(f"Unexpected error in export_report: {str(e)}")
         return JsonResponse({'error': f'Unexpected error: {str(e)}'}, status=500)
 
 
+def get_export_job_status(job):
+    status = {
+        'id': job.id,
+        'status': job.status,
+        'export_type': job.export_type,
+        'rows_written': job.rows_written,
+        'total_rows': job.total_rows,
+        'error': job.error,
+        'download_url': None,
+    }
+    if job.status == 'completed':
+        status['download_url'] = reverse('reports:download_export', args=[job.id])
+    return status
+
+
+@require_http_methods(["POST"])
+@csrf_exempt
+def queue_export_report(request):
+    """Queue a background export of a report; the response is the job's status, see get_export_job."""
+    try:
+        data = json.loads(request.body)
+        selected_column_ids = data.get('columns', [])
+        main_table_id = data.get('main_table_id')
+        export_type = data.get('export_type', 'csv')
+        column_order = data.get('column_order', [])
+        filters = data.get('filters')
+        # Parquet compression codec
+        compression = data.get('compression', PARQUET_COMPRESSIONS[0])
+
+        if not selected_column_ids:
+            return JsonResponse({'error': 'No columns selected'}, status=400)
+
+        if not main_table_id:
+            return JsonResponse({'error': 'No main table selected'}, status=400)
+
+        if export_type not in EXPORT_EXTENSIONS:
+            return JsonResponse({'error': 'Invalid export type'}, status=400)
+
+        if compression not in PARQUET_COMPRESSIONS:
+            return JsonResponse({'error': 'Invalid compression'}, status=400)
+
+        ordered_columns = get_ordered_columns(selected_column_ids, column_order)
+        compiled = compile_query([col.id for col in ordered_columns], main_table_id, filters)
+        job = queue_export(compiled, export_type, header=[col.name for col in ordered_columns], compression=compression)
+        return JsonResponse(get_export_job_status(job))
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON in request body'}, status=400)
+    except (ValueError, Column.DoesNotExist, Table.DoesNotExist) as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Unexpected error in queue_export_report: {str(e)}")
+        return JsonResponse({'error': f'Unexpected error: {str(e)}'}, status=500)
+
+
+@require_http_methods(["POST"])
+@csrf_exempt
+def queue_export_report_sql(request):
+    """Queue a background export of an SQL report, see queue_export_report."""
+    try:
+        data = json.loads(request.body)
+        sql_query = data.get('sql_query')
+        export_type = data.get('export_type', 'csv')
+        column_order = data.get('column_order', [])
+        # Parquet compression codec
+        compression = data.get('compression', PARQUET_COMPRESSIONS[0])
+
+        if not sql_query:
+            return JsonResponse({'error': 'SQL query is required'}, status=400)
+
+        if export_type not in EXPORT_EXTENSIONS:
+            return JsonResponse({'error': 'Invalid export type'}, status=400)
+
+        if compression not in PARQUET_COMPRESSIONS:
+            return JsonResponse({'error': 'Invalid compression'}, status=400)
+
+        job = queue_export(compile_sql_report(sql_query), export_type, column_order=column_order, compression=compression)
+        return JsonResponse(get_export_job_status(job))
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'Invalid JSON in request body'}, status=400)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        logger.error(f"Unexpected error in queue_export_report_sql: {str(e)}")
+        return JsonResponse({'error': f'Unexpected error: {str(e)}'}, status=500)
+
+
+@require_http_methods(["GET"])
+def get_export_job(request, job_id):
+    """Poll the progress of a queued export."""
+    job = get_object_or_404(ExportJob, id=job_id)
+    fail_lost_export(job)
+    return JsonResponse(get_export_job_status(job))
+
+
+@require_http_methods(["GET"])
+def download_export(request, job_id):
+    job = get_object_or_404(ExportJob, id=job_id, status='completed')
+    file_path = os.path.join(settings.MEDIA_ROOT, job.file)
+    if not os.path.exists(file_path):
+        return JsonResponse({'error': 'Export file no longer exists, queue the export again'}, status=404)
+    return FileResponse(
+        open(file_path, 'rb'),
+        as_attachment=True,
+        filename=f'report_export.{EXPORT_EXTENSIONS[job.export_type]}',
+        content_type=EXPORT_CONTENT_TYPES[job.export_type],
+    )
+
+
 @require_http_methods(["POST"])
 @csrf_exempt
 def save_configuration(request):
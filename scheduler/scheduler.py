@@ -6,12 +6,22 @@ from django.dispatch import receiver
 from django.conf import settings  # Add this import
 from django.apps import apps
 from django.db import connection
+from django.utils import timezone
+from contextlib import contextmanager
+from datetime import timedelta
+import threading
 import logging
 
 
 logger = logging.getLogger(__name__)
 scheduler = None
 
+# Background work started with run_once touches its row this often while it runs
+HEARTBEAT_SECONDS = 30
+
+# Background work neither queued nor touched for this long was lost with its process
+STALE_SECONDS = 4 * HEARTBEAT_SECONDS
+
 def get_scheduler():
     global scheduler
     if scheduler is None:
@@ -124,4 +134,63 @@ def remove_job(script_id, app_name):
             scheduler.remove_job(job_id)
             logger.info(f"Removed job {job_id} from scheduler")
         else:
-            logger.warning(f"Job {job_id} not found in scheduler")
\ No newline at end of file
+            logger.warning(f"Job {job_id} not found in scheduler")
+
+
+def run_once(func, args, job_id):
+    """
+    Run func(*args) once, as soon as a scheduler thread is free. The job is
+    stored in the job store until it starts, so work still queued when the
+    process stops runs once the scheduler starts again. Adding a job_id that
+    is still queued replaces it.
+    """
+    scheduler = get_scheduler()
+    if not scheduler:
+        raise RuntimeError("Scheduler not initialized")
+    scheduler.add_job(func, 'date', args=args, id=job_id, replace_existing=True, misfire_grace_time=None)
+    logger.info(f"Queued background job {job_id}")
+
+
+def is_queued(job_id):
+    scheduler = get_scheduler()
+    return bool(scheduler and scheduler.get_job(job_id))
+
+
+def is_lost(job_id, updated_at):
+    """
+    Whether work queued with run_once under job_id was lost with its process:
+    it has left the job store, and its row (last updated at updated_at) has
+    not been touched by its heartbeat for STALE_SECONDS.
+    """
+    if updated_at >= timezone.now() - timedelta(seconds=STALE_SECONDS):
+        return False
+    return not is_queued(job_id)
+
+
+@contextmanager
+def heartbeat(rows):
+    """
+    Touch the updated_at of a queryset's rows every HEARTBEAT_SECONDS while
+    the block runs, starting on entry, so is_lost tells running work from
+    work that stopped with its process.
+    """
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while True:
+                rows.update(updated_at=timezone.now())
+                if stop.wait(HEARTBEAT_SECONDS):
+                    break
+        except Exception as e:
+            logger.error(f"Error updating heartbeat: {str(e)}")
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()